@@ -237,7 +237,7 @@ export default function ConversationsPage() {
   useEffect(() => {
     if (!lastJsonMessage) return;
 
-    const { type, message, contact: updatedContactData } = lastJsonMessage;
+    const { type, message, statuses, contact: updatedContactData } = lastJsonMessage;
 
     if (type === 'new_message' && message) {
       setMessages(prevMessages => {
@@ -249,6 +249,15 @@ export default function ConversationsPage() {
         }
         return [...prevMessages, message];
       });
+    } else if (type === 'message_statuses' && Array.isArray(statuses)) {
+      // Batched delivery/read updates; only the status fields change.
+      const statusesById = new Map(statuses.map(s => [s.id, s]));
+      setMessages(prevMessages =>
+        prevMessages.map(msg => {
+          const update = statusesById.get(msg.id);
+          return update ? { ...msg, status: update.status, status_timestamp: update.status_timestamp } : msg;
+        })
+      );
     } else if (type === 'contact_updated' && updatedContactData && selectedContact?.id === updatedContactData.id) {
       // Update the selected contact in the main panel
       setSelectedContact(updatedContactData);
@@ -46,7 +46,7 @@ class MessageInline(admin.TabularInline): # Or admin.StackedInline for a differe
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('id', 'contact_link', 'direction', 'message_type', 'status', 'timestamp', 'wamid_short', 'app_config')
     list_filter = ('timestamp', 'direction', 'message_type', 'status', 'contact__name', 'app_config') # Add 'app_config' if using the FK
-    search_fields = ('wamid', 'text_content', 'contact__whatsapp_id', 'contact__name', 'content_payload') # Be careful with JSON search
+    search_fields = ('wamid', 'text_content', 'contact__whatsapp_id', 'contact__name') # content_payload is stored compressed and can't be searched
     readonly_fields = ('contact', 'app_config', 'wamid', 'direction', 'message_type', 'content_payload', 'timestamp', 'status_timestamp', 'error_details') # 'app_config'
     date_hierarchy = 'timestamp'
     list_per_page = 25
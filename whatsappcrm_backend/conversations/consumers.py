@@ -7,7 +7,7 @@ from django.utils import timezone
 
 from .models import Contact, Message
 from .serializers import ContactDetailSerializer, MessageSerializer
-from meta_integration.tasks import send_whatsapp_message_task
+from meta_integration.sequencer import dispatch_outgoing_messages
 from meta_integration.models import MetaAppConfig
 
 logger = logging.getLogger(__name__)
@@ -43,8 +43,8 @@ def create_and_dispatch_message(contact, user, message_text):
             status='pending_dispatch',
         )
         # The post_save signal on the Message model will broadcast this.
-        # We can also explicitly trigger the send task here.
-        send_whatsapp_message_task.delay(message.id, active_config.id)
+        # We can also explicitly queue it in the contact's send sequencer here.
+        dispatch_outgoing_messages(contact.id, [message.id], active_config.id)
         return message
     except Exception as e:
         logger.error(f"Error creating/dispatching message from user {user.id} to contact {contact.id}: {e}", exc_info=True)
@@ -142,3 +142,10 @@ class ConversationConsumer(AsyncJsonWebsocketConsumer):
         """
         await self.send_json({'type': 'new_message', 'message': event['message']})
 
+    async def message_statuses(self, event):
+        """
+        Handler for coalesced delivery status updates (see meta_integration.status_pipeline).
+        One event carries every status change in this conversation since the last flush.
+        """
+        await self.send_json({'type': 'message_statuses', 'statuses': event['statuses']})
+
@@ -0,0 +1,182 @@
+# whatsappcrm_backend/conversations/contact_cache.py
+"""
+Resolves WhatsApp IDs to contacts on the webhook path without writing the contact row on every message.
+
+A process-local LRU backed by Redis maps wa_id -> (contact id, name, associated_app_config_id).
+The row is only written when the incoming profile name or app config differs from what is known,
+and new contacts are created with a single INSERT ... ON CONFLICT. Both writes send post_save, so
+Contact's listeners (activity feed, dashboards) still run. Entries are invalidated when a contact
+is saved or deleted elsewhere (see conversations.signals).
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models.signals import post_save
+
+from whatsappcrm_backend.redis_client import get_redis_client
+from .models import Contact
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = "contacts:wa:{wa_id}"
+
+# Other processes can change a contact (admin edits) without reaching this process's LRU,
+# so local entries live briefly; Redis entries are deleted on every save/delete.
+_LOCAL_MAX_ENTRIES = 20000
+_LOCAL_TTL_SECONDS = 60
+
+_LOADED_FIELDS = ['id', 'whatsapp_id', 'name', 'associated_app_config_id']
+
+
+class _LocalCache:
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_local_cache = _LocalCache(_LOCAL_MAX_ENTRIES, _LOCAL_TTL_SECONDS)
+
+
+def _ttl() -> int:
+    return getattr(settings, 'CONTACT_CACHE_TTL_SECONDS', 3600)
+
+
+def _get_cached(wa_id: str) -> Optional[tuple]:
+    entry = _local_cache.get(wa_id)
+    if entry is not None:
+        return entry
+    try:
+        raw = get_redis_client().get(CACHE_KEY.format(wa_id=wa_id))
+    except Exception as e:
+        logger.warning(f"Contact cache unavailable for {wa_id}: {e}")
+        return None
+    if raw:
+        entry = tuple(json.loads(raw))
+        _local_cache.set(wa_id, entry)
+        return entry
+    return None
+
+
+def _set_cached(wa_id: str, entry: tuple) -> None:
+    _local_cache.set(wa_id, entry)
+    try:
+        get_redis_client().set(CACHE_KEY.format(wa_id=wa_id), json.dumps(entry), ex=_ttl())
+    except Exception as e:
+        logger.warning(f"Could not cache contact {wa_id}: {e}")
+
+
+def invalidate(wa_id: str) -> None:
+    _local_cache.discard(wa_id)
+    try:
+        get_redis_client().delete(CACHE_KEY.format(wa_id=wa_id))
+    except Exception as e:
+        logger.warning(f"Could not invalidate cached contact {wa_id}: {e}")
+
+
+def _as_contact(wa_id: str, entry: tuple) -> Contact:
+    # A deferred instance: other fields load on access, and save() only writes the loaded fields,
+    # so a caller saving it can't overwrite columns it never read.
+    contact_id, name, app_config_id = entry
+    return Contact.from_db(Contact.objects.db, _LOADED_FIELDS, [contact_id, wa_id, name, app_config_id])
+
+
+def _insert_contact(wa_id: str, name: Optional[str], app_config_id: Optional[int]) -> Optional[Contact]:
+    """
+    Creates the contact with one INSERT ... ON CONFLICT (whatsapp_id) DO NOTHING and sends post_save
+    as save() would. Returns None, without sending anything, if the contact already existed.
+    """
+    contact = Contact(whatsapp_id=wa_id, name=name, associated_app_config_id=app_config_id)
+    using = router.db_for_write(Contact)
+    connection = connections[using]
+    fields = [field for field in Contact._meta.concrete_fields if not field.primary_key]
+    # pre_save() fills auto_now/auto_now_add timestamps, as save() would.
+    values = [field.get_db_prep_save(field.pre_save(contact, True), connection) for field in fields]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {Contact._meta.db_table} ({', '.join(field.column for field in fields)}) "
+            f"VALUES ({', '.join(['%s'] * len(fields))}) "
+            f"ON CONFLICT (whatsapp_id) DO NOTHING RETURNING id",
+            values,
+        )
+        inserted = cursor.fetchone()
+    if inserted is None:
+        return None
+    contact.pk = inserted[0]
+    contact._state.adding = False
+    contact._state.db = using
+    post_save.send(sender=Contact, instance=contact, created=True, update_fields=None, raw=False, using=using)
+    return contact
+
+
+def resolve_contact(wa_id: str, name: Optional[str] = None, app_config_id: Optional[int] = None) -> Tuple[Contact, bool]:
+    """
+    Returns (contact, created) for a WhatsApp ID, creating the contact if needed and updating its name
+    and app config only when they changed. No database query at all when the contact is cached and unchanged.
+    """
+    entry = _get_cached(wa_id)
+    created = False
+    stale = entry is None
+    if entry is None:
+        row = Contact.objects.filter(whatsapp_id=wa_id).values_list('id', 'name', 'associated_app_config_id').first()
+        if row is None:
+            new_contact = _insert_contact(wa_id, name, app_config_id)
+            if new_contact is None:
+                # Lost the race with a concurrent delivery for the same new contact: use its row.
+                row = Contact.objects.filter(whatsapp_id=wa_id).values_list('id', 'name', 'associated_app_config_id').get()
+            else:
+                row = (new_contact.pk, name, app_config_id)
+                created = True
+                logger.info(f"Created new contact: {name or 'Unknown'} ({wa_id})")
+        entry = tuple(row)
+
+    contact = _as_contact(wa_id, entry)
+    contact_id, cached_name, cached_app_config_id = entry
+    changes = {}
+    if name and name != cached_name:
+        logger.info(f"Updating contact name for {wa_id} from '{cached_name}' to '{name}'.")
+        changes['name'] = name
+    if app_config_id and app_config_id != cached_app_config_id:
+        changes['associated_app_config_id'] = app_config_id
+    if changes:
+        for field, value in changes.items():
+            setattr(contact, field, value)
+        # A real save (not .update()) so post_save listeners see the change; only the changed columns are written.
+        contact.save(update_fields=list(changes))
+        entry = (contact_id, contact.name, contact.associated_app_config_id)
+        stale = True
+
+    if stale:
+        # Only cache what has been committed: the webhook path runs in a transaction that may roll back.
+        transaction.on_commit(lambda: _set_cached(wa_id, entry))
+    return contact, created
@@ -0,0 +1,117 @@
+# whatsappcrm_backend/conversations/last_seen.py
+"""
+Coalesces Contact.last_seen updates. Messages record their timestamp per contact in Redis (the
+newest one wins) and a debounced task applies everything pending every
+CONTACT_LAST_SEEN_FLUSH_INTERVAL_SECONDS with one UPDATE ... FROM (VALUES ...), instead of one
+UPDATE of the contact row per message save. Updates are monotonic: last_seen never moves back.
+"""
+import logging
+from datetime import datetime, timezone as dt_timezone
+from typing import Dict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from whatsappcrm_backend.redis_client import get_redis_client
+from .models import Contact
+
+logger = logging.getLogger(__name__)
+
+PENDING_LAST_SEEN_KEY = "contacts:last_seen:pending"
+FLUSH_SCHEDULED_KEY = "contacts:last_seen:flush_scheduled"
+
+# Keeps the highest timestamp recorded for each contact.
+_RECORD_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local current = redis.call('hget', KEYS[1], ARGV[i])
+    if not current or tonumber(current) < tonumber(ARGV[i + 1]) then
+        redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+return 1
+"""
+# Takes everything pending and clears the flush flag in one step, so timestamps recorded
+# after this point schedule a new flush.
+_DRAIN_SCRIPT = """
+local pending = redis.call('hgetall', KEYS[1])
+redis.call('del', KEYS[1], KEYS[2])
+return pending
+"""
+
+
+def _flush_interval() -> int:
+    return getattr(settings, 'CONTACT_LAST_SEEN_FLUSH_INTERVAL_SECONDS', 5)
+
+
+def record_last_seen(contact_timestamps: Dict[int, datetime]) -> None:
+    """
+    Records interactions as {contact_id: timestamp}. Applied by the next flush; if Redis is
+    unavailable they are written directly (still monotonic).
+    """
+    from .tasks import flush_contact_last_seen_task
+
+    contact_timestamps = {contact_id: ts for contact_id, ts in contact_timestamps.items() if contact_id and ts}
+    if not contact_timestamps:
+        return
+    args = []
+    for contact_id, ts in contact_timestamps.items():
+        args.extend([contact_id, ts.timestamp()])
+    try:
+        client = get_redis_client()
+        client.eval(_RECORD_SCRIPT, 1, PENDING_LAST_SEEN_KEY, *args)
+        interval = _flush_interval()
+        # Debounce: only the first interaction of a window schedules the flush. The flag expires on its
+        # own in case the flush task is lost.
+        if client.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=interval + 60):
+            flush_contact_last_seen_task.apply_async(countdown=interval)
+    except Exception as e:
+        logger.error(f"Could not queue last_seen for {len(contact_timestamps)} contact(s) in Redis: {e}. Writing directly.", exc_info=True)
+        apply_last_seen(contact_timestamps)
+
+
+def apply_last_seen(contact_timestamps: Dict[int, datetime]) -> int:
+    """Moves each contact's last_seen forward to the given timestamp. Returns the number of rows updated."""
+    if not contact_timestamps:
+        return 0
+    if connection.vendor != 'postgresql':
+        updated = 0
+        for contact_id, ts in contact_timestamps.items():
+            updated += Contact.objects.filter(pk=contact_id, last_seen__lt=ts).update(last_seen=ts)
+        return updated
+
+    table = Contact._meta.db_table
+    values_sql = ', '.join(['(%s, %s::timestamptz)'] * len(contact_timestamps))
+    params = []
+    for contact_id in sorted(contact_timestamps):
+        params.extend([contact_id, contact_timestamps[contact_id]])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE "{table}" AS c SET last_seen = v.last_seen '
+            f'FROM (VALUES {values_sql}) AS v(id, last_seen) '
+            'WHERE c.id = v.id AND (c.last_seen IS NULL OR c.last_seen < v.last_seen)',
+            params
+        )
+        return cursor.rowcount
+
+
+def flush_pending_last_seen(batch_size: int = 1000) -> int:
+    """Applies all pending last_seen timestamps, one UPDATE per batch. Returns the number of rows updated."""
+    pending = get_redis_client().eval(_DRAIN_SCRIPT, 2, PENDING_LAST_SEEN_KEY, FLUSH_SCHEDULED_KEY)
+    contact_timestamps = {
+        int(contact_id): datetime.fromtimestamp(float(ts), tz=dt_timezone.utc)
+        for contact_id, ts in zip(pending[::2], pending[1::2])
+    }
+    contact_ids = sorted(contact_timestamps)
+    updated = 0
+    for start in range(0, len(contact_ids), batch_size):
+        batch = {contact_id: contact_timestamps[contact_id] for contact_id in contact_ids[start:start + batch_size]}
+        try:
+            with transaction.atomic():
+                updated += apply_last_seen(batch)
+        except Exception as e:
+            logger.error(f"Failed to flush last_seen for {len(contact_ids) - start} contact(s): {e}. Re-queueing them.", exc_info=True)
+            record_last_seen({contact_id: contact_timestamps[contact_id] for contact_id in contact_ids[start:]})
+            raise
+    if contact_timestamps:
+        logger.debug(f"Flushed last_seen for {len(contact_timestamps)} contact(s), {updated} row(s) moved forward.")
+    return updated
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.7 on 2026-10-17 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0002_contact_intervention_requested_at_and_more'),
+        ('meta_integration', '0004_payloadblob_webhookeventlog_payload_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='payload_blob',
+            field=models.ForeignKey(blank=True, help_text='Compressed raw message payload from/to Meta API.', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='meta_integration.payloadblob'),
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 5.1.7 on 2026-10-18 11:40
+
+import hashlib
+import json
+import zlib
+
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 1000
+
+
+# Frozen copy of the payload_store encoding as of this migration; later changes there must not alter it.
+def encode(payload):
+    raw = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest(), 'zlib', zlib.compress(raw, 6), len(raw)
+
+
+def decode(codec, data):
+    if codec != 'zlib':
+        raise ValueError(f"Unknown payload codec '{codec}'.")
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+def move_payloads(apps, schema_editor):
+    """Copies each message's JSON payload into the blob store. Every batch commits on its own."""
+    PayloadBlob = apps.get_model('meta_integration', 'PayloadBlob')
+    Message = apps.get_model('conversations', 'Message')
+    using = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        batch = list(
+            Message.objects.using(using)
+            .filter(pk__gt=last_pk, payload_blob__isnull=True, content_payload__isnull=False)
+            .order_by('pk').only('pk', 'content_payload')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        blobs = {}
+        for message in batch:
+            digest, codec, data, size = encode(message.content_payload)
+            blobs.setdefault(digest, PayloadBlob(digest=digest, codec=codec, data=data, size=size))
+            message.payload_blob_id = digest
+        with transaction.atomic(using=using):
+            PayloadBlob.objects.using(using).bulk_create(blobs.values(), ignore_conflicts=True)
+            Message.objects.using(using).bulk_update(batch, ['payload_blob'])
+        last_pk = batch[-1].pk
+
+
+def restore_payloads(apps, schema_editor):
+    """Writes each message's blob back into its JSON column. Messages without a blob get an empty object."""
+    PayloadBlob = apps.get_model('meta_integration', 'PayloadBlob')
+    Message = apps.get_model('conversations', 'Message')
+    using = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        batch = list(
+            Message.objects.using(using)
+            .filter(pk__gt=last_pk, content_payload__isnull=True)
+            .order_by('pk').only('pk', 'payload_blob')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        digests = {message.payload_blob_id for message in batch if message.payload_blob_id}
+        blobs = PayloadBlob.objects.using(using).in_bulk(digests)
+        for message in batch:
+            blob = blobs.get(message.payload_blob_id)
+            message.content_payload = decode(blob.codec, blob.data) if blob is not None else {}
+        with transaction.atomic(using=using):
+            Message.objects.using(using).bulk_update(batch, ['content_payload'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+    # Each batch commits separately, so a large table is neither locked nor rewritten in one transaction.
+    atomic = False
+
+    dependencies = [
+        ('conversations', '0003_message_payload_blob'),
+    ]
+
+    operations = [
+        # Nullable while both representations exist; the reverse restores NOT NULL once the JSON is back.
+        migrations.AlterField(
+            model_name='message',
+            name='content_payload',
+            field=models.JSONField(help_text='Raw message payload from/to Meta API.', null=True),
+        ),
+        migrations.RunPython(move_payloads, restore_payloads),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-18 11:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0004_move_message_payloads'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='content_payload',
+        ),
+    ]
@@ -6,6 +6,7 @@ from django.utils import timezone
 # It's good practice to link conversations to the MetaAppConfig if you might have multiple,
 # or just to know which configuration handled this conversation.
 # from meta_integration.models import MetaAppConfig # This is removed to prevent circular import
+from meta_integration.payload_store import PayloadProperty, PayloadStoreMixin
 
 class Contact(models.Model):
     """
@@ -59,7 +60,7 @@ class Contact(models.Model):
         verbose_name_plural = "Contacts"
 
 
-class Message(models.Model):
+class Message(PayloadStoreMixin, models.Model):
     """
     Represents a single message in a conversation.
     """
@@ -129,7 +130,13 @@ class Message(models.Model):
     )
     # Store the raw message object from Meta for incoming, or the payload sent for outgoing.
     # This is useful for debugging, reprocessing, or accessing fields not explicitly modeled.
-    content_payload = models.JSONField(help_text="Raw message payload from/to Meta API.")
+    # Kept compressed and deduplicated in meta_integration's payload store; `content_payload` reads and
+    # writes it like the JSON column it replaces. bulk_create() callers must call store_payloads() first.
+    payload_blob = models.ForeignKey(
+        'meta_integration.PayloadBlob', on_delete=models.DO_NOTHING, null=True, blank=True, related_name='+',
+        help_text="Compressed raw message payload from/to Meta API."
+    )
+    content_payload = PayloadProperty('payload_blob', doc="Raw message payload from/to Meta API.")
     
     # For quick access to text content if it's a text message
     text_content = models.TextField(blank=True, null=True, help_text="Text content if it's a text message.")
@@ -183,20 +190,30 @@ class Message(models.Model):
         contact_name = self.contact.name or self.contact.whatsapp_id
         return f"Msg {self.id} {direction_arrow} {contact_name} ({self.message_type}) at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
 
-    def save(self, *args, **kwargs):
-        # If it's a text message and text_content is not set, try to populate it from content_payload
+    def populate_text_content(self):
+        """
+        If it's a text message and text_content is not set, populate it from content_payload.
+        Called by save(); callers using bulk_create() must call it themselves.
+        """
         if self.message_type == 'text' and not self.text_content and isinstance(self.content_payload, dict):
             if self.direction == 'in': # Incoming message structure
                 self.text_content = self.content_payload.get('text', {}).get('body')
             elif self.direction == 'out': # Outgoing message structure
                 self.text_content = self.content_payload.get('body') # Assuming 'body' is at the top level of the text object
 
-        # Update contact's last_seen timestamp
-        if self.contact_id: # Ensure contact is associated
-            Contact.objects.filter(pk=self.contact_id).update(last_seen=self.timestamp)
+    def save(self, *args, **kwargs):
+        from .last_seen import record_last_seen
+
+        self.populate_text_content()
+        update_fields = kwargs.get('update_fields')
+        # Status-only saves don't move the contact's last_seen; the others are coalesced (see last_seen).
+        records_interaction = self._state.adding or update_fields is None or 'timestamp' in update_fields
 
         super().save(*args, **kwargs)
 
+        if self.contact_id and records_interaction:
+            record_last_seen({self.contact_id: self.timestamp})
+
     class Meta:
         ordering = ['timestamp'] # Order messages chronologically by default
         verbose_name = "Message"
@@ -6,7 +6,7 @@ from django.db import transaction
 import logging
 
 from .models import Contact, Message, Broadcast, BroadcastRecipient
-from meta_integration.tasks import send_whatsapp_message_task
+from meta_integration.sequencer import dispatch_outgoing_messages
 from meta_integration.models import MetaAppConfig
 
 logger = logging.getLogger(__name__)
@@ -47,6 +47,8 @@ class MessageSerializer(serializers.ModelSerializer):
     contact_details = ContactSerializer(source='contact', read_only=True)
     # For write operations (creating a message), frontend will send contact PK
     contact = serializers.PrimaryKeyRelatedField(queryset=Contact.objects.all(), write_only=True)
+    # content_payload is a property backed by the compressed payload store, so it is declared explicitly to stay writable.
+    content_payload = serializers.JSONField()
     
     message_type_display = serializers.CharField(source='get_message_type_display', read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
@@ -93,10 +95,8 @@ class MessageSerializer(serializers.ModelSerializer):
             message = Message.objects.create(**validated_data)
             active_config = MetaAppConfig.objects.get_active_config()
             if active_config:
-                # Use on_commit to ensure the task is only queued if the DB transaction succeeds.
-                transaction.on_commit(
-                    lambda: send_whatsapp_message_task.delay(message.id, active_config.id)
-                )
+                # Queued in the contact's send sequencer once the DB transaction commits.
+                dispatch_outgoing_messages(message.contact_id, [message.id], active_config.id)
             else:
                 logger.error(f"No active MetaAppConfig found. Message {message.id} cannot be dispatched.")
                 message.status = 'failed'
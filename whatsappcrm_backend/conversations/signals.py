@@ -1,10 +1,11 @@
 # conversations/signals.py
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
-from .models import Message
+from .models import Contact, Message
+from .contact_cache import invalidate as invalidate_cached_contact
 from .serializers import MessageSerializer
 
 import logging
@@ -35,4 +36,11 @@ def on_new_or_updated_message(sender, instance, created, **kwargs):
         )
         logger.info(f"Broadcasted message {instance.id} to group {conversation_group_name}")
     except Exception as e:
-        logger.error(f"Error in on_new_or_updated_message signal for message {instance.id}: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"Error in on_new_or_updated_message signal for message {instance.id}: {e}", exc_info=True)
+
+
+@receiver(post_save, sender=Contact)
+@receiver(post_delete, sender=Contact)
+def on_contact_changed(sender, instance, **kwargs):
+    # The webhook path resolves contacts from a cache (contact_cache); drop the entry so it is reloaded.
+    invalidate_cached_contact(instance.whatsapp_id)
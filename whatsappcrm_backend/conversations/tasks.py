@@ -6,7 +6,9 @@ from django.db import transaction
 
 from .models import Broadcast, BroadcastRecipient, Contact, Message
 from meta_integration.models import MetaAppConfig
-from meta_integration.tasks import send_whatsapp_message_task
+from meta_integration.payload_store import store_payloads
+from meta_integration.rate_limiter import LANE_BROADCAST
+from meta_integration.sequencer import dispatch_outgoing_messages
 # from flows.services import _resolve_value # For advanced personalization
 
 logger = logging.getLogger(__name__)
@@ -54,13 +56,16 @@ def dispatch_broadcast_task(self, broadcast_id, contact_ids, language_code, comp
                 )
                 messages_to_create.append(message)
 
+            store_payloads(messages_to_create) # One blob: every recipient gets the same template payload.
             created_messages = Message.objects.bulk_create(messages_to_create)
             
             broadcast_recipients = [BroadcastRecipient(broadcast=broadcast, contact=msg.contact, message=msg) for msg in created_messages]
             BroadcastRecipient.objects.bulk_create(broadcast_recipients)
 
+            # Queued per contact once the transaction commits, behind anything already queued for them,
+            # on the broadcast rate-limit budget so conversations keep their share of the throughput.
             for message in created_messages:
-                send_whatsapp_message_task.delay(message.id, active_config.id)
+                dispatch_outgoing_messages(message.contact_id, [message.id], active_config.id, lane=LANE_BROADCAST)
 
             broadcast.status = 'completed'
             broadcast.pending_dispatch_count = contacts.count()
@@ -76,3 +81,13 @@ def dispatch_broadcast_task(self, broadcast_id, contact_ids, language_code, comp
         logger.error(f"Error dispatching broadcast {broadcast_id}: {exc}. Retrying...")
         Broadcast.objects.filter(pk=broadcast_id).update(status='failed')
         raise self.retry(exc=exc, countdown=60)
+
+
+@shared_task
+def flush_contact_last_seen_task():
+    """
+    Applies the Contact.last_seen timestamps coalesced by `last_seen.record_last_seen` since the last flush.
+    Scheduled (debounced) by record_last_seen itself.
+    """
+    from .last_seen import flush_pending_last_seen
+    flush_pending_last_seen()
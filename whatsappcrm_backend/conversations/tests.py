@@ -1,3 +1,43 @@
+from datetime import timedelta
+from unittest import mock
+
 from django.test import TestCase
+from django.utils import timezone
+
+from . import last_seen
+from .models import Contact
+
+
+class LastSeenFlushTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seen_at = timezone.now() - timedelta(hours=1)
+        cls.contact = Contact.objects.create(whatsapp_id='263770000005', name='Nyasha')
+        cls.other_contact = Contact.objects.create(whatsapp_id='263770000006', name='Farai')
+        # last_seen is auto_now; pin it to a known value without going through save().
+        Contact.objects.filter(pk__in=[cls.contact.pk, cls.other_contact.pk]).update(last_seen=cls.seen_at)
+
+    def _last_seen(self, contact):
+        return Contact.objects.values_list('last_seen', flat=True).get(pk=contact.pk)
+
+    def test_newer_timestamp_moves_last_seen_forward(self):
+        newer = self.seen_at + timedelta(minutes=5)
+        self.assertEqual(last_seen.apply_last_seen({self.contact.pk: newer}), 1)
+        self.assertEqual(self._last_seen(self.contact), newer)
+
+    def test_older_timestamp_is_ignored(self):
+        self.assertEqual(last_seen.apply_last_seen({self.contact.pk: self.seen_at - timedelta(minutes=5)}), 0)
+        self.assertEqual(last_seen.apply_last_seen({self.contact.pk: self.seen_at}), 0)
+        self.assertEqual(self._last_seen(self.contact), self.seen_at)
+
+    def test_mixed_batch_only_moves_contacts_forward(self):
+        newer = self.seen_at + timedelta(minutes=1)
+        updated = last_seen.apply_last_seen({self.contact.pk: newer, self.other_contact.pk: self.seen_at - timedelta(days=1)})
+        self.assertEqual(updated, 1)
+        self.assertEqual(self._last_seen(self.contact), newer)
+        self.assertEqual(self._last_seen(self.other_contact), self.seen_at)
 
-# Create your tests here.
+    def test_direct_write_without_redis_is_monotonic(self):
+        with mock.patch.object(last_seen, 'get_redis_client', side_effect=ConnectionError('down')):
+            last_seen.record_last_seen({self.contact.pk: self.seen_at - timedelta(minutes=1)})
+        self.assertEqual(self._last_seen(self.contact), self.seen_at)
@@ -112,7 +112,7 @@ class ContactViewSet(viewsets.ModelViewSet):
         elif self.action == 'retrieve':
             # For the detail view, prefetch messages in chronological order
             queryset = queryset.prefetch_related(
-                Prefetch('messages', queryset=Message.objects.order_by('timestamp'))
+                Prefetch('messages', queryset=Message.objects.select_related('payload_blob').order_by('timestamp'))
             )
         else:
             # Fallback for other actions, use default ordering
@@ -124,7 +124,7 @@ class ContactViewSet(viewsets.ModelViewSet):
     def list_messages_for_contact(self, request, pk=None):
         contact = get_object_or_404(Contact, pk=pk)
         # Return messages in REVERSE chronological order for pagination (most recent first)
-        messages_queryset = Message.objects.filter(contact=contact).select_related('contact').order_by('-timestamp')
+        messages_queryset = Message.objects.filter(contact=contact).select_related('contact', 'payload_blob').order_by('-timestamp')
         
         page = self.paginate_queryset(messages_queryset)
         if page is not None:
@@ -177,7 +177,7 @@ class MessageViewSet(
     mixins.CreateModelMixin,
     viewsets.GenericViewSet
 ):
-    queryset = Message.objects.all().select_related('contact').order_by('-timestamp')
+    queryset = Message.objects.all().select_related('contact', 'payload_blob').order_by('-timestamp')
     permission_classes = [permissions.IsAuthenticated, CanCreateMessagesOrAdminOnly]
 
     def get_serializer_class(self):
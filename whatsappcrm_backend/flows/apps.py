@@ -11,3 +11,5 @@ class FlowsConfig(AppConfig):
         # This ensures that your custom flow actions are discovered and registered
         # automatically when the Django application starts.
         import flows.actions
+        # Keep compiled flow graphs in sync with edits to flows, steps and transitions.
+        import flows.signals  # noqa
@@ -0,0 +1,225 @@
+# whatsappcrm_backend/flows/conditions.py
+
+import json
+import logging
+import re
+from typing import Any, Callable, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HUMAN_REQUEST_KEYWORDS = ['help', 'support', 'agent', 'human', 'operator']
+
+
+class InboundEvent:
+    """
+    An incoming message normalised once per message, so that question-reply parsing and every
+    transition predicate share the same extracted values instead of re-parsing `message_data`.
+    """
+    __slots__ = ('type', 'text', 'text_lower', 'interactive_id', 'nfm_data', 'media_id', 'raw')
+
+    def __init__(self, message_data: dict):
+        message_data = message_data if isinstance(message_data, dict) else {}
+        self.raw = message_data
+        self.type = message_data.get('type')
+        self.text = ""
+        self.interactive_id = None
+        self.nfm_data = None
+        self.media_id = None
+
+        if self.type == 'text' and isinstance(message_data.get('text'), dict):
+            self.text = (message_data['text'].get('body') or '').strip()
+        elif self.type == 'interactive' and isinstance(message_data.get('interactive'), dict):
+            interactive_payload = message_data['interactive']
+            interactive_type = interactive_payload.get('type')
+            reply_payload = interactive_payload.get(interactive_type)
+            if interactive_type in ('button_reply', 'list_reply') and isinstance(reply_payload, dict):
+                self.interactive_id = reply_payload.get('id')
+            elif interactive_type == 'nfm_reply' and isinstance(reply_payload, dict):
+                response_json_str = reply_payload.get('response_json')
+                if response_json_str:
+                    try:
+                        self.nfm_data = json.loads(response_json_str)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Could not parse nfm_reply response_json: {str(response_json_str)[:200]}")
+        elif self.type in ('image', 'document', 'audio', 'video', 'sticker') and isinstance(message_data.get(self.type), dict):
+            self.media_id = message_data[self.type].get('id')
+
+        self.text_lower = self.text.lower()
+
+    @property
+    def is_internal(self) -> bool:
+        return (self.type or '').startswith('internal_')
+
+
+# A predicate takes (event, flow_context, contact) and returns whether the transition should be taken.
+ConditionPredicate = Callable[[InboundEvent, dict, Any], bool]
+
+
+def _never(event, flow_context, contact) -> bool:
+    return False
+
+
+def _always(event, flow_context, contact) -> bool:
+    return True
+
+
+def _split_path(variable_path: Any) -> Tuple[str, Tuple[str, ...]]:
+    variable_path = str(variable_path)
+    return variable_path, tuple(variable_path.split('.')) if variable_path else ()
+
+
+def _has_template_syntax(value: str) -> bool:
+    return '{{' in value or '{%' in value or '{#' in value
+
+
+def compile_condition(transition) -> ConditionPredicate:
+    """
+    Compiles a FlowTransition.condition_config into a predicate. All per-config work (regex compilation,
+    keyword normalisation, variable path splitting) happens here, once per compiled flow version.
+    """
+    # Imported lazily: services imports the graph module, which compiles conditions.
+    from .services import _get_value_from_path_parts, _resolve_value
+
+    config = transition.condition_config
+    if not isinstance(config, dict):
+        logger.warning(f"Transition {transition.id} has invalid condition_config (not a dict): {config}")
+        return _never
+    condition_type = config.get('type')
+
+    if not condition_type: return _never # No condition type means no specific condition to evaluate beyond default
+    if condition_type == 'always_true': return _always
+
+    value_for_condition = config.get('value') # Expected value for comparison
+
+    if condition_type in ('user_reply_matches_keyword', 'user_reply_contains_keyword'):
+        keyword = str(config.get('keyword', '')).strip()
+        if not keyword: return _never # Cannot match empty keyword
+        case_sensitive = config.get('case_sensitive', False)
+        expected = keyword if case_sensitive else keyword.lower()
+        if condition_type == 'user_reply_matches_keyword':
+            if case_sensitive:
+                return lambda event, flow_context, contact: expected == event.text
+            return lambda event, flow_context, contact: expected == event.text_lower
+        if case_sensitive:
+            return lambda event, flow_context, contact: expected in event.text
+        return lambda event, flow_context, contact: expected in event.text_lower
+
+    elif condition_type == 'interactive_reply_id_equals':
+        expected_id = str(value_for_condition)
+        return lambda event, flow_context, contact: event.interactive_id is not None and event.interactive_id == expected_id
+
+    elif condition_type == 'message_type_is':
+        expected_type = str(value_for_condition)
+        return lambda event, flow_context, contact: event.type == expected_type
+
+    elif condition_type == 'user_reply_matches_regex':
+        regex = config.get('regex')
+        if not regex: return _never
+        try:
+            pattern = re.compile(regex)
+        except (re.error, TypeError) as e:
+            logger.error(f"Invalid regex in transition {transition.id}: {regex}. Error: {e}")
+            return _never
+        return lambda event, flow_context, contact: bool(event.text) and bool(pattern.match(event.text))
+
+    elif condition_type == 'variable_equals':
+        if config.get('variable_name') is None: return _never
+        variable_path, parts = _split_path(config['variable_name'])
+        expected_str = str(value_for_condition)
+
+        def variable_equals(event, flow_context, contact):
+            actual_value = _get_value_from_path_parts(parts, variable_path, flow_context, contact)
+            # Compare as strings for simplicity and predictability in flow logic
+            result = str(actual_value) == expected_str
+            logger.debug(
+                f"Transition {transition.id}: Condition 'variable_equals' check for '{variable_path}'. "
+                f"Actual: '{actual_value}' (type: {type(actual_value).__name__}), "
+                f"Expected: '{value_for_condition}' (type: {type(value_for_condition).__name__}). "
+                f"Result (str comparison): {result}"
+            )
+            return result
+        return variable_equals
+
+    elif condition_type == 'variable_exists':
+        variable_name_template = config.get('variable_name')
+        if variable_name_template is None: return _never
+        is_dynamic_path = isinstance(variable_name_template, str) and _has_template_syntax(variable_name_template)
+        static_path, static_parts = (None, None) if is_dynamic_path else _split_path(variable_name_template)
+
+        def variable_exists(event, flow_context, contact):
+            if is_dynamic_path:
+                # Dynamic paths like 'list.{{ index }}' still have to be rendered per message.
+                variable_path, parts = _split_path(_resolve_value(variable_name_template, flow_context, contact))
+            else:
+                variable_path, parts = static_path, static_parts
+            actual_value = _get_value_from_path_parts(parts, variable_path, flow_context, contact)
+            result = actual_value is not None
+            logger.debug(
+                f"Transition {transition.id}: Condition 'variable_exists' check for '{variable_path}'. "
+                f"Value: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}). Result: {result}"
+            )
+            return result
+        return variable_exists
+
+    elif condition_type == 'variable_contains':
+        if config.get('variable_name') is None: return _never
+        variable_path, parts = _split_path(config['variable_name'])
+        expected_item = value_for_condition
+
+        def variable_contains(event, flow_context, contact):
+            actual_value = _get_value_from_path_parts(parts, variable_path, flow_context, contact)
+            result = False
+            if isinstance(actual_value, str) and isinstance(expected_item, str): result = expected_item in actual_value
+            elif isinstance(actual_value, list) and expected_item is not None: result = expected_item in actual_value
+            logger.debug(
+                f"Transition {transition.id}: Condition 'variable_contains' check for '{variable_path}'. "
+                f"Container: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}), "
+                f"Expected item: '{expected_item}'. Result: {result}"
+            )
+            return result
+        return variable_contains
+
+    elif condition_type == 'nfm_response_field_equals':
+        field_path = config.get('field_path')
+        if not field_path: return _never
+        field_parts = tuple(str(field_path).split('.'))
+
+        def nfm_response_field_equals(event, flow_context, contact):
+            if not event.nfm_data: return False
+            actual_val_from_nfm = event.nfm_data
+            for part in field_parts:
+                if isinstance(actual_val_from_nfm, dict): actual_val_from_nfm = actual_val_from_nfm.get(part)
+                else: actual_val_from_nfm = None; break
+            return actual_val_from_nfm == value_for_condition
+        return nfm_response_field_equals
+
+    elif condition_type == 'question_reply_is_valid':
+        # A question step saves a valid reply to its variable; with value True this checks that it was set,
+        # with any other value that it was not.
+        def question_reply_is_valid(event, flow_context, contact):
+            question_expectation = flow_context.get('_question_awaiting_reply_for')
+            if question_expectation and isinstance(question_expectation, dict):
+                is_var_set = question_expectation.get('variable_name') in flow_context
+                return is_var_set if value_for_condition is True else not is_var_set
+            return False # No question was being awaited or config mismatch
+        return question_reply_is_valid
+
+    elif condition_type == 'user_requests_human':
+        human_request_keywords = config.get('keywords', DEFAULT_HUMAN_REQUEST_KEYWORDS)
+        if not isinstance(human_request_keywords, list): return _never
+        normalized_keywords = [
+            (keyword, keyword.strip().lower()) for keyword in human_request_keywords
+            if isinstance(keyword, str) and keyword.strip()
+        ]
+
+        def user_requests_human(event, flow_context, contact):
+            if not event.text: return False
+            for keyword, keyword_lower in normalized_keywords:
+                if keyword_lower in event.text_lower:
+                    logger.info(f"User requested human agent with keyword: '{keyword}'")
+                    return True
+            return False
+        return user_requests_human
+
+    logger.warning(f"Unknown or unhandled condition type: '{condition_type}' for transition {transition.id}. It will never match.")
+    return _never
@@ -362,7 +362,8 @@ LEAD_GENERATION_FLOW = {
                         "category__name__icontains": "{{ inquiry_topic_from_trigger }}"
                     },
                     "order_by": ["name"],
-                    "limit": 3
+                    "limit": 3,
+                    "cache_ttl": 300
                 }]
             },
             "transitions": [
@@ -374,7 +375,7 @@ LEAD_GENERATION_FLOW = {
             "name": "query_all_products",
             "type": "action",
             "config": {
-                "actions_to_run": [{"action_type": "query_model", "app_label": "products_and_services", "model_name": "SoftwareProduct", "variable_name": "product_options", "filters_template": {"is_active": True}, "order_by": ["name"], "limit": 3}]
+                "actions_to_run": [{"action_type": "query_model", "app_label": "products_and_services", "model_name": "SoftwareProduct", "variable_name": "product_options", "filters_template": {"is_active": True}, "order_by": ["name"], "limit": 3, "cache_ttl": 300}]
             },
             "transitions": [
                 {"to_step": "present_product_options", "priority": 0, "condition_config": {"type": "variable_exists", "variable_name": "product_options.0"}},
@@ -594,7 +595,7 @@ LEAD_GENERATION_FLOW = {
             "name": "query_all_services",
             "type": "action",
             "config": {
-                "actions_to_run": [{"action_type": "query_model", "app_label": "products_and_services", "model_name": "ProfessionalService", "variable_name": "service_options", "filters_template": {"is_active": True}, "order_by": ["name"], "limit": 3}]
+                "actions_to_run": [{"action_type": "query_model", "app_label": "products_and_services", "model_name": "ProfessionalService", "variable_name": "service_options", "filters_template": {"is_active": True}, "order_by": ["name"], "limit": 3, "cache_ttl": 300}]
             },
             "transitions": [
                 {"to_step": "present_service_options", "priority": 0, "condition_config": {"type": "variable_exists", "variable_name": "service_options.0"}},
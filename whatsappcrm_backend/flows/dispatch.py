@@ -0,0 +1,125 @@
+# whatsappcrm_backend/flows/dispatch.py
+
+import logging
+import uuid
+from typing import Optional
+
+from django.conf import settings
+
+from whatsappcrm_backend.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = "flows:contact:{contact_id}:pending"
+LOCK_KEY = "flows:contact:{contact_id}:lock"
+# Contacts that may have pending messages, for sweep_flow_queues.
+ACTIVE_CONTACTS_KEY = "flows:contacts:active"
+
+# Release/refresh the lock only if we still own it, so an expired lock taken over by another worker is never touched.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_REFRESH_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def is_partitioned_dispatch_enabled() -> bool:
+    return getattr(settings, 'FLOW_PARTITIONED_DISPATCH', False)
+
+
+def _lock_timeout() -> int:
+    return getattr(settings, 'FLOW_DISPATCH_LOCK_TIMEOUT_SECONDS', 300)
+
+
+def dispatch_flow_processing(message_id: int, contact_id: int) -> None:
+    """
+    Queues an incoming message for the flow engine.
+
+    In partitioned mode the message is appended to the contact's pending list and a drain task is queued;
+    only the worker holding the contact's lock processes the list, one message at a time and in order.
+    Otherwise the message goes straight to `process_flow_for_message_task`.
+    """
+    from .tasks import process_flow_for_message_task, drain_contact_flow_queue_task
+
+    if not is_partitioned_dispatch_enabled():
+        process_flow_for_message_task.delay(message_id)
+        return
+
+    try:
+        client = get_redis_client()
+        pending_key = PENDING_KEY.format(contact_id=contact_id)
+        pipe = client.pipeline()
+        pipe.rpush(pending_key, message_id)
+        pipe.expire(pending_key, 24 * 60 * 60) # Never leave an orphaned list behind forever
+        pipe.sadd(ACTIVE_CONTACTS_KEY, contact_id)
+        pipe.execute()
+    except Exception as e:
+        # Redis being unavailable must not drop the message; fall back to unordered dispatch.
+        logger.error(f"Could not enqueue message {message_id} for contact {contact_id} in Redis: {e}. Dispatching without ordering.", exc_info=True)
+        process_flow_for_message_task.delay(message_id)
+        return
+
+    drain_contact_flow_queue_task.delay(contact_id)
+
+
+class ContactProcessingLock:
+    """A Redis lock that serialises flow processing for one contact across all workers."""
+
+    def __init__(self, contact_id: int, timeout: Optional[int] = None):
+        self.client = get_redis_client()
+        self.key = LOCK_KEY.format(contact_id=contact_id)
+        self.timeout = timeout or _lock_timeout()
+        self.token = uuid.uuid4().hex
+
+    def acquire(self) -> bool:
+        return bool(self.client.set(self.key, self.token, nx=True, ex=self.timeout))
+
+    def refresh(self) -> bool:
+        return bool(self.client.eval(_REFRESH_LOCK_SCRIPT, 1, self.key, self.token, self.timeout))
+
+    def release(self) -> None:
+        self.client.eval(_RELEASE_LOCK_SCRIPT, 1, self.key, self.token)
+
+
+def peek_pending_message(contact_id: int) -> Optional[int]:
+    """The contact's next pending message; it stays at the head of the list until `ack_pending_message`."""
+    message_id = get_redis_client().lindex(PENDING_KEY.format(contact_id=contact_id), 0)
+    return int(message_id) if message_id is not None else None
+
+
+def ack_pending_message(contact_id: int) -> None:
+    """Removes the processed head of the contact's pending list."""
+    get_redis_client().lpop(PENDING_KEY.format(contact_id=contact_id))
+
+
+def has_pending_messages(contact_id: int) -> bool:
+    return get_redis_client().llen(PENDING_KEY.format(contact_id=contact_id)) > 0
+
+
+def sweep_flow_queues() -> int:
+    """
+    Restarts the drain of contacts whose pending messages have no lock holder (a worker died while
+    draining; its lock has since expired). Returns the number of contacts restarted.
+    """
+    from .tasks import drain_contact_flow_queue_task
+
+    client = get_redis_client()
+    restarted = 0
+    for contact_id in client.smembers(ACTIVE_CONTACTS_KEY):
+        if client.exists(LOCK_KEY.format(contact_id=contact_id)):
+            continue
+        if not client.llen(PENDING_KEY.format(contact_id=contact_id)):
+            client.srem(ACTIVE_CONTACTS_KEY, contact_id)
+            continue
+        drain_contact_flow_queue_task.delay(int(contact_id))
+        restarted += 1
+    if restarted:
+        logger.warning(f"Flow queue sweep restarted {restarted} stalled contact queue(s).")
+    return restarted
@@ -0,0 +1,129 @@
+# whatsappcrm_backend/flows/graph.py
+
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Tuple
+
+from .models import Flow, FlowStep, FlowTransition
+from .step_configs import ParsedStepConfig, parse_step_config
+from .conditions import ConditionPredicate, compile_condition
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CompiledFlow:
+    """
+    An immutable, in-memory snapshot of a Flow's graph (steps, ordered transitions and entry point),
+    along with each step's config validated and each transition's condition compiled once.
+    A snapshot is only valid for the `version` (Flow.updated_at) it was built from.
+    """
+    flow: Flow
+    version: Optional[datetime]
+    steps: Mapping[int, FlowStep]
+    transitions: Mapping[int, Tuple[FlowTransition, ...]]
+    entry_point: Optional[FlowStep] = None
+    step_configs: Mapping[int, ParsedStepConfig] = field(default_factory=dict)
+    conditions: Mapping[int, ConditionPredicate] = field(default_factory=dict)
+
+    @property
+    def flow_id(self) -> int:
+        return self.flow.pk
+
+    def get_step(self, step_id: int) -> Optional[FlowStep]:
+        return self.steps.get(step_id)
+
+    def get_step_config(self, step_id: int) -> Optional[ParsedStepConfig]:
+        return self.step_configs.get(step_id)
+
+    def get_condition(self, transition_id: int) -> Optional[ConditionPredicate]:
+        return self.conditions.get(transition_id)
+
+    def transitions_from(self, step_id: int) -> Tuple[FlowTransition, ...]:
+        """Returns the outgoing transitions of a step, ordered by priority (lowest first)."""
+        return self.transitions.get(step_id, ())
+
+
+def compile_flow(flow: Flow) -> CompiledFlow:
+    """
+    Loads a flow's steps and transitions in two queries and links them together in memory,
+    so that walking the graph (step.flow, transition.current_step, transition.next_step)
+    never triggers a lazy database lookup.
+    """
+    steps: Dict[int, FlowStep] = {}
+    step_configs: Dict[int, ParsedStepConfig] = {}
+    entry_point = None
+    for step in FlowStep.objects.filter(flow_id=flow.pk).order_by('created_at', 'id'):
+        step.flow = flow
+        steps[step.pk] = step
+        step_configs[step.pk] = parse_step_config(step.step_type, step.config)
+        if not step_configs[step.pk].is_valid:
+            logger.warning(f"Step '{step.name}' (ID: {step.pk}) in flow '{flow.name}' has an invalid config. It will be logged and skipped when executed.")
+        if step.is_entry_point and entry_point is None:
+            entry_point = step
+
+    transitions: Dict[int, list] = {}
+    conditions: Dict[int, ConditionPredicate] = {}
+    for transition in FlowTransition.objects.filter(current_step__flow_id=flow.pk).order_by('priority', 'id'):
+        current_step = steps.get(transition.current_step_id)
+        next_step = steps.get(transition.next_step_id)
+        if current_step is None or next_step is None:
+            logger.warning(f"Transition {transition.pk} in flow '{flow.name}' references a step outside the flow. Skipping.")
+            continue
+        transition.current_step = current_step
+        transition.next_step = next_step
+        transitions.setdefault(current_step.pk, []).append(transition)
+        conditions[transition.pk] = compile_condition(transition)
+
+    logger.debug(f"Compiled flow '{flow.name}' (ID: {flow.pk}) with {len(steps)} steps at version {flow.updated_at}.")
+    return CompiledFlow(
+        flow=flow,
+        version=flow.updated_at,
+        steps=MappingProxyType(steps),
+        transitions=MappingProxyType({step_id: tuple(items) for step_id, items in transitions.items()}),
+        entry_point=entry_point,
+        step_configs=MappingProxyType(step_configs),
+        conditions=MappingProxyType(conditions),
+    )
+
+
+class FlowGraphCache:
+    """
+    Per-process cache of CompiledFlow objects keyed by flow ID.
+    An entry is reused only while its version matches the Flow.updated_at of the caller's Flow row,
+    so edits made by other processes are picked up on the next message without extra queries.
+    """
+    def __init__(self):
+        self._graphs: Dict[int, CompiledFlow] = {}
+        self._lock = threading.Lock()
+
+    def get(self, flow: Flow) -> CompiledFlow:
+        graph = self._graphs.get(flow.pk)
+        if graph is not None and graph.version == flow.updated_at:
+            return graph
+
+        graph = compile_flow(flow)
+        with self._lock:
+            self._graphs[flow.pk] = graph
+        return graph
+
+    def peek(self, flow_id: int) -> Optional[CompiledFlow]:
+        """Returns the cached graph for a flow without any version check or compilation."""
+        return self._graphs.get(flow_id)
+
+    def invalidate(self, flow_id: Optional[int] = None) -> None:
+        with self._lock:
+            if flow_id is None:
+                self._graphs.clear()
+            else:
+                self._graphs.pop(flow_id, None)
+
+
+flow_graph_cache = FlowGraphCache()
+
+
+def get_compiled_flow(flow: Flow) -> CompiledFlow:
+    return flow_graph_cache.get(flow)
@@ -3,6 +3,7 @@ import importlib
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from flows.models import Flow, FlowStep, FlowTransition
+from flows.step_configs import parse_step_config
 import logging
 
 logger = logging.getLogger(__name__)
@@ -117,4 +118,17 @@ class Command(BaseCommand):
                         self.stderr.write(self.style.ERROR(f"Error creating transition from '{current_step_name}' to '{next_step_name}': {e}"))
                         raise
 
+        # 5. Validate step configs against their schemas, as the flow engine will when it compiles the flows
+        self.stdout.write("\nValidating step configs...")
+        invalid_steps = 0
+        for step_key, step_instance in step_map.items():
+            parsed_config = parse_step_config(step_instance.step_type, step_instance.config)
+            if parsed_config.is_valid:
+                continue
+            invalid_steps += 1
+            error = parsed_config.error or parsed_config.message_error
+            self.stderr.write(self.style.WARNING(f"  Step '{step_key}' has an invalid config and will be skipped at runtime: {error.errors()}"))
+        if not invalid_steps:
+            self.stdout.write(self.style.SUCCESS("...All step configs are valid."))
+
         self.stdout.write(self.style.SUCCESS("\nFlow synchronization completed successfully!"))
\ No newline at end of file
@@ -0,0 +1,144 @@
+# whatsappcrm_backend/flows/metrics.py
+
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from prometheus_client import Histogram
+
+logger = logging.getLogger(__name__)
+
+_QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 250, 500)
+_ITERATION_BUCKETS = (0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 30)
+
+MESSAGE_SECONDS = Histogram(
+    'flow_engine_message_seconds', 'Wall time spent processing one incoming message in the flow engine.', ['flow'],
+)
+MESSAGE_QUERIES = Histogram(
+    'flow_engine_message_queries', 'Database queries executed while processing one incoming message.', ['flow'],
+    buckets=_QUERY_BUCKETS,
+)
+MESSAGE_ITERATIONS = Histogram(
+    'flow_engine_message_iterations', 'Main-loop (fall-through) iterations per incoming message.', ['flow'],
+    buckets=_ITERATION_BUCKETS,
+)
+STEP_SECONDS = Histogram(
+    'flow_engine_step_seconds', 'Wall time spent executing one flow step.', ['flow', 'step_type'],
+)
+STEP_QUERIES = Histogram(
+    'flow_engine_step_queries', 'Database queries executed by one flow step.', ['flow', 'step_type'],
+    buckets=_QUERY_BUCKETS,
+)
+ACTION_SECONDS = Histogram(
+    'flow_engine_action_seconds', 'Wall time spent running one action of an action step.', ['flow', 'action_type'],
+)
+ACTION_QUERIES = Histogram(
+    'flow_engine_action_queries', 'Database queries executed by one action of an action step.', ['flow', 'action_type'],
+    buckets=_QUERY_BUCKETS,
+)
+TEMPLATE_RENDER_SECONDS = Histogram(
+    'flow_engine_template_render_seconds', 'Wall time spent rendering one Jinja template.', ['flow'],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+
+# The flow currently being processed, used to label metrics recorded deep inside the engine.
+_current_flow = contextvars.ContextVar('flow_metrics_current_flow', default='none')
+
+
+def current_flow_label() -> str:
+    return _current_flow.get()
+
+
+class QueryCounter:
+    """A connection.execute_wrapper() that counts the queries run while it is installed."""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MessageMetrics:
+    """
+    Measures one run of `process_message_for_flow`: wall time, query count and main-loop iterations,
+    labelled with the flow the message ended up in. Warns when the query count exceeds FLOW_QUERY_BUDGET.
+    """
+    def __init__(self, contact_id=None, message_id=None):
+        self.contact_id = contact_id
+        self.message_id = message_id
+        self.flow_label = 'none'
+        self.iterations = 0
+        self.queries = QueryCounter()
+        self._wrapper = None
+        self._token = None
+        self._started_at = None
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        self._token = _current_flow.set(self.flow_label)
+        self._wrapper = connection.execute_wrapper(self.queries)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._wrapper.__exit__(exc_type, exc, tb)
+        _current_flow.reset(self._token)
+        elapsed = time.perf_counter() - self._started_at
+        try:
+            MESSAGE_SECONDS.labels(flow=self.flow_label).observe(elapsed)
+            MESSAGE_QUERIES.labels(flow=self.flow_label).observe(self.queries.count)
+            MESSAGE_ITERATIONS.labels(flow=self.flow_label).observe(self.iterations)
+        except Exception as e:
+            logger.debug(f"Could not record flow engine metrics: {e}")
+
+        budget = getattr(settings, 'FLOW_QUERY_BUDGET', None)
+        if budget and self.queries.count > budget:
+            logger.warning(
+                f"Flow engine query budget exceeded for contact {self.contact_id} (message {self.message_id}) in flow "
+                f"'{self.flow_label}': {self.queries.count} queries (budget {budget}), {self.iterations} iteration(s), {elapsed:.3f}s."
+            )
+        return False
+
+    def set_flow(self, flow) -> None:
+        if flow is not None:
+            self.flow_label = flow.name
+            _current_flow.set(self.flow_label)
+
+    def iteration(self) -> None:
+        self.iterations += 1
+
+
+@contextmanager
+def _measure(seconds_histogram, queries_histogram, **labels):
+    counter = QueryCounter()
+    started_at = time.perf_counter()
+    try:
+        with connection.execute_wrapper(counter):
+            yield counter
+    finally:
+        try:
+            seconds_histogram.labels(**labels).observe(time.perf_counter() - started_at)
+            queries_histogram.labels(**labels).observe(counter.count)
+        except Exception as e:
+            logger.debug(f"Could not record flow engine metrics: {e}")
+
+
+def measure_step(step_type: str):
+    return _measure(STEP_SECONDS, STEP_QUERIES, flow=current_flow_label(), step_type=step_type or 'unknown')
+
+
+def measure_action(action_type: str):
+    return _measure(ACTION_SECONDS, ACTION_QUERIES, flow=current_flow_label(), action_type=action_type or 'unknown')
+
+
+@contextmanager
+def measure_template_render():
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        TEMPLATE_RENDER_SECONDS.labels(flow=current_flow_label()).observe(time.perf_counter() - started_at)
@@ -0,0 +1,81 @@
+# whatsappcrm_backend/flows/query_cache.py
+
+import hashlib
+import json
+import logging
+from typing import Any, Callable, List
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Models whose query_model results may be cached. Saves/deletes of these models invalidate their entries.
+DEFAULT_CACHEABLE_MODELS = [
+    'products_and_services.offeringcategory',
+    'products_and_services.softwareproduct',
+    'products_and_services.softwaremodule',
+    'products_and_services.professionalservice',
+    'products_and_services.device',
+]
+
+_GENERATION_KEY = "flows:query_model:gen:{label}"
+_RESULT_KEY = "flows:query_model:{label}:{generation}:{digest}"
+
+
+def _cache():
+    return caches[getattr(settings, 'FLOW_QUERY_CACHE_ALIAS', 'default')]
+
+
+def cacheable_models() -> set:
+    return {label.lower() for label in getattr(settings, 'FLOW_QUERY_CACHE_MODELS', DEFAULT_CACHEABLE_MODELS)}
+
+
+def is_cacheable(model) -> bool:
+    return model._meta.label_lower in cacheable_models()
+
+
+def _generation(label: str) -> int:
+    # Entries are keyed by the model's current generation; bumping it orphans every cached result at once.
+    return _cache().get_or_set(_GENERATION_KEY.format(label=label), 1, timeout=None)
+
+
+def bump_generation(model) -> None:
+    """Invalidates all cached query_model results for a model."""
+    label = model._meta.label_lower
+    key = _GENERATION_KEY.format(label=label)
+    try:
+        try:
+            _cache().incr(key)
+        except ValueError: # Key doesn't exist yet: nothing cached for this model
+            _cache().set(key, 1, timeout=None)
+        logger.debug(f"Invalidated cached query_model results for {label}.")
+    except Exception as e:
+        logger.warning(f"Could not invalidate cached query_model results for {label}: {e}")
+
+
+def get_or_query(model, cache_ttl: int, key_parts: dict, run_query: Callable[[], List[Any]]) -> List[Any]:
+    """
+    Returns the cached result of a query_model action, or runs `run_query` and caches it for `cache_ttl` seconds.
+    `key_parts` must contain everything that affects the result (resolved filters, order_by, limit, fields).
+    The cache is best-effort: any cache error falls back to running the query.
+    """
+    label = model._meta.label_lower
+    try:
+        digest = hashlib.sha1(json.dumps(key_parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        key = _RESULT_KEY.format(label=label, generation=_generation(label), digest=digest)
+        cached = _cache().get(key)
+    except Exception as e:
+        logger.warning(f"query_model cache unavailable for {label}: {e}. Querying the database.")
+        return run_query()
+
+    if cached is not None:
+        logger.debug(f"query_model cache hit for {label} ({key}).")
+        return cached
+
+    results = run_query()
+    try:
+        _cache().set(key, results, timeout=cache_ttl)
+    except Exception as e:
+        logger.warning(f"Could not cache query_model results for {label}: {e}")
+    return results
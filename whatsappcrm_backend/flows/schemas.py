@@ -177,6 +177,9 @@ class ActionItem(BaseModel):
     filters_template: Optional[Dict[str, Any]] = None
     order_by: Optional[List[str]] = None
     limit: Optional[int] = None
+    fields_to_return: Optional[List[str]] = None
+    # Opt-in: cache the query results for this many seconds (see FLOW_QUERY_CACHE_MODELS)
+    cache_ttl: Optional[int] = Field(None, ge=1)
     # Used by custom actions
     params_template: Optional[Dict[str, Any]] = None
 
@@ -2,6 +2,7 @@
 from django.db import models
 import logging
 import re
+from functools import lru_cache
 from typing import List, Dict, Any, Optional, Union, Literal
 
 from django.utils import timezone
@@ -10,7 +11,7 @@ from django.db import transaction
 from django.apps import apps
 from django.forms.models import model_to_dict
 from django.db.models.fields.files import ImageFieldFile, FileField
-from jinja2 import Environment, select_autoescape, Undefined, pass_context
+from jinja2 import Environment, Template, select_autoescape, Undefined, pass_context
 from django.core.exceptions import ValidationError as DjangoValidationError # Renamed to avoid conflict with Pydantic
 from pydantic import ValidationError
 from django.conf import settings
@@ -22,6 +23,12 @@ import json
 
 from conversations.models import Contact, Message
 from .models import Flow, FlowStep, FlowTransition, ContactFlowState
+from .graph import get_compiled_flow, flow_graph_cache
+from .triggers import get_trigger_index
+from .step_configs import ParsedMessage, ParsedStepConfig, parse_step_config
+from .conditions import InboundEvent, compile_condition
+from .session import FlowStateSession
+from . import query_cache, metrics
 from customer_data.models import CustomerProfile
 
 # Import Pydantic schemas from the new file
@@ -122,9 +129,9 @@ def to_interactive_rows_filter(context, value, row_template=None):
     for item in value:
         # For each item in the list, render the id, title, and description from the template
         rendered_row = {
-            "id": jinja_env.from_string(row_template.get('id', '')).render(item=item),
-            "title": jinja_env.from_string(row_template.get('title', '')).render(item=item),
-            "description": jinja_env.from_string(row_template.get('description', '')).render(item=item)
+            "id": get_compiled_template(row_template.get('id', '')).render(item=item),
+            "title": get_compiled_template(row_template.get('title', '')).render(item=item),
+            "description": get_compiled_template(row_template.get('description', '')).render(item=item)
         }
         rows_list.append(rendered_row)
 
@@ -141,13 +148,42 @@ jinja_env.filters['truncatewords'] = truncatewords_filter # Add the filter
 jinja_env.filters['to_interactive_rows'] = to_interactive_rows_filter # Add the new filter
 jinja_env.globals['now'] = timezone.now # Make 'now' globally available for date comparisons
 
+# --- Compiled Template Cache ---
+# Step configs reuse the same few hundred template strings for every message, so compiled
+# templates are kept in a bounded LRU keyed by their source text.
+FLOW_TEMPLATE_CACHE_SIZE = getattr(settings, 'FLOW_TEMPLATE_CACHE_SIZE', 1024)
+
+@lru_cache(maxsize=FLOW_TEMPLATE_CACHE_SIZE)
+def get_compiled_template(source: str) -> Template:
+    return jinja_env.from_string(source)
+
+def template_cache_info():
+    """Returns the (hits, misses, maxsize, currsize) counters of the compiled template cache."""
+    return get_compiled_template.cache_info()
+
+def _is_plain_string(value: str) -> bool:
+    """True if the string has no Jinja syntax and would render to itself."""
+    return '{{' not in value and '{%' not in value and '{#' not in value
+
+def _render_plain_string(value: str) -> str:
+    # Mirror Jinja's handling of template data: it drops a single trailing newline
+    # (keep_trailing_newline=False). Strings with '\r' are left to Jinja to normalise.
+    return value[:-1] if value.endswith('\n') else value
+
 def _get_value_from_context_or_contact(variable_path: str, flow_context: dict, contact: Contact) -> Any:
     """
     Resolves a variable path (e.g., 'contact.name', 'flow_context.user_email') to its value.
     Safely accesses attributes on Django models and keys in dictionaries. Does NOT execute methods.
     """
     if not variable_path: return None
-    parts = variable_path.split('.')
+    return _get_value_from_path_parts(tuple(variable_path.split('.')), variable_path, flow_context, contact)
+
+def _get_value_from_path_parts(parts: tuple, variable_path: str, flow_context: dict, contact: Contact) -> Any:
+    """
+    Same as `_get_value_from_context_or_contact`, for a path that has already been split on '.'.
+    Compiled transition conditions split their paths once and call this directly.
+    """
+    if not parts: return None
     current_value = None
     source_object_name = parts[0]
 
@@ -208,16 +244,20 @@ def _resolve_value(template_value: Any, flow_context: dict, contact: Contact) ->
     Provides 'contact', 'customer_profile', and the flow_context to the template.
     """
     if isinstance(template_value, str):
+        # Fast path: strings without any template syntax don't need to go through Jinja.
+        if _is_plain_string(template_value) and '\r' not in template_value:
+            return _render_plain_string(template_value)
         # Use Jinja2 for powerful string templating, supporting loops, conditionals, and filters.
         try:
-            template = jinja_env.from_string(template_value)
+            template = get_compiled_template(template_value)
             # The context for Jinja includes the contact, their profile, and the flow context flattened.
             render_context = {
                 **flow_context, # type: ignore
                 'contact': contact,
                 'customer_profile': getattr(contact, 'customer_profile', None)
             }
-            return template.render(render_context)
+            with metrics.measure_template_render():
+                return template.render(render_context)
         except Exception as e:
             logger.error(f"Jinja2 template rendering failed for contact {contact.id}: {e}. Template: '{template_value}'", exc_info=False)
             return template_value # Return original on error
@@ -289,10 +329,123 @@ def _initiate_paynow_giving_payment(contact: Contact, amount_str: str, payment_t
         "paynow_initiation_error": None
     }
 
-def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict, suppress_prompt: bool = False) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
+def _get_step_config(step: FlowStep) -> ParsedStepConfig:
+    """
+    Returns the validated config of a step. Steps coming from a compiled flow graph reuse the config
+    parsed when the graph was built; ad-hoc steps (e.g. fallback actions) are parsed on the spot.
+    """
+    if step.pk and step.flow_id:
+        graph = flow_graph_cache.peek(step.flow_id)
+        if graph is not None and graph.get_step(step.pk) is step:
+            parsed_config = graph.get_step_config(step.pk)
+            if parsed_config is not None:
+                return parsed_config
+    return parse_step_config(step.step_type, step.config)
+
+def _build_send_message_actions(parsed_message: ParsedMessage, step: FlowStep, contact: Contact, current_step_context: dict) -> List[Dict[str, Any]]:
+    """
+    Builds the 'send_whatsapp_message' action for an already validated message config.
+    Used by send_message steps, question prompts and end_flow final messages.
+    """
+    actions_to_perform = []
+    send_message_config = parsed_message.config
+    actual_message_type = send_message_config.message_type
+    final_api_data_structure = {}
+    cacheable_link = False
+
+    if actual_message_type == "text" and send_message_config.text:
+        text_content = send_message_config.text
+        resolved_body = _resolve_value(text_content.body, current_step_context, contact)
+        final_api_data_structure = {'body': resolved_body, 'preview_url': text_content.preview_url}
+
+    elif actual_message_type in ['image', 'document', 'audio', 'video', 'sticker'] and getattr(send_message_config, actual_message_type):
+        media_conf: MediaMessageContent = getattr(send_message_config, actual_message_type)
+        media_data_to_send = {}
+
+        valid_source_found = False
+        if MEDIA_ASSET_ENABLED and media_conf.asset_pk:
+            try:
+                asset = MediaAsset.objects.get(pk=media_conf.asset_pk)
+                if asset.status == 'synced' and asset.whatsapp_media_id and not asset.is_whatsapp_id_potentially_expired():
+                    media_data_to_send['id'] = asset.whatsapp_media_id
+                    valid_source_found = True
+                    logger.info(f"Contact {contact.id}: Using MediaAsset {asset.pk} ('{asset.name}') with WA ID: {asset.whatsapp_media_id} for step {step.id}.")
+                else: 
+                    logger.warning(f"Contact {contact.id}: MediaAsset {asset.pk} ('{asset.name}') not usable for step {step.id} (Status: {asset.status}, Expired: {asset.is_whatsapp_id_potentially_expired()}). Trying direct id/link from config.")
+            except MediaAsset.DoesNotExist:
+                logger.error(f"Contact {contact.id}: MediaAsset pk={media_conf.asset_pk} not found for step {step.id}. Trying direct id/link from config.")
+
+        if not valid_source_found: # Try direct id or link if asset_pk didn't work or wasn't provided
+            if media_conf.id:
+                media_data_to_send['id'] = _resolve_value(media_conf.id, current_step_context, contact)
+                valid_source_found = True
+            elif media_conf.link:
+                resolved_link = _resolve_value(media_conf.link, current_step_context, contact)
+                # If the link is relative (e.g., from Django's media files), make it absolute.
+                if resolved_link and resolved_link.startswith('/'):
+                    domain = getattr(settings, 'BACKEND_DOMAIN_FOR_CSP', None)
+                    if not domain:
+                        logger.error(f"Contact {contact.id}: Cannot form absolute URL for media link '{resolved_link}' because BACKEND_DOMAIN_FOR_CSP is not set in settings.")
+                        resolved_link = None # Prevent sending a broken link
+                    else:
+                        resolved_link = f"https://{domain}{resolved_link}"
+
+                if resolved_link:
+                    media_data_to_send['link'] = resolved_link
+                    # Only a fixed link can share one upload; a templated one may point at a different file per contact.
+                    cacheable_link = _is_plain_string(media_conf.link)
+                    valid_source_found = True
+
+        if not valid_source_found:
+            logger.error(f"Contact {contact.id}: No valid media source (asset_pk, id, or link) for {actual_message_type} in step '{step.name}' (ID: {step.id}).")
+        else:
+            if media_conf.caption:
+                media_data_to_send['caption'] = _resolve_value(media_conf.caption, current_step_context, contact)
+            if actual_message_type == 'document' and media_conf.filename:
+                media_data_to_send['filename'] = _resolve_value(media_conf.filename, current_step_context, contact)
+            final_api_data_structure = media_data_to_send
+
+    elif actual_message_type == "interactive" and parsed_message.payload:
+        # The payload was dumped once when the config was parsed; resolving builds a new structure.
+        final_api_data_structure = _resolve_value(parsed_message.payload, current_step_context, contact)
+
+    elif actual_message_type == "template" and parsed_message.payload:
+        template_payload_dict = dict(parsed_message.payload) # Shallow copy: 'components' is replaced below
+        if 'components' in template_payload_dict and template_payload_dict['components']:
+            template_payload_dict['components'] = _resolve_template_components(
+                template_payload_dict['components'], current_step_context, contact
+            )
+        final_api_data_structure = template_payload_dict
+
+    elif actual_message_type == "contacts" and parsed_message.payload:
+        resolved_contacts = _resolve_value(parsed_message.payload, current_step_context, contact)
+        final_api_data_structure = {"contacts": resolved_contacts}
+
+    elif actual_message_type == "location" and parsed_message.payload:
+        final_api_data_structure = {"location": _resolve_value(parsed_message.payload, current_step_context, contact)}
+
+    if final_api_data_structure:
+        actions_to_perform.append({
+            'type': 'send_whatsapp_message',
+            'recipient_wa_id': contact.whatsapp_id,
+            'message_type': actual_message_type,
+            'data': final_api_data_structure,
+            'cacheable_link': cacheable_link
+        })
+    elif actual_message_type: # If type was specified but no payload generated
+         logger.warning(f"Contact {contact.id}: No data payload generated for message_type '{actual_message_type}' in step '{step.name}' (ID: {step.id}). Pydantic Config: {send_message_config.model_dump_json(indent=2) if send_message_config else None}")
+    return actions_to_perform
+
+def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict, suppress_prompt: bool = False, parsed_config: Optional[ParsedStepConfig] = None) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    with metrics.measure_step(step.step_type):
+        return _run_step_actions(step, contact, flow_context, suppress_prompt, parsed_config)
+
+def _run_step_actions(step: FlowStep, contact: Contact, flow_context: dict, suppress_prompt: bool, parsed_config: Optional[ParsedStepConfig]) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
     actions_to_perform = []
     raw_step_config = step.config or {} 
     current_step_context = flow_context.copy() 
+    if parsed_config is None:
+        parsed_config = _get_step_config(step)
 
     logger.debug(
         f"Contact {contact.id}: Executing actions for step '{step.name}' (ID: {step.id}, Type: {step.step_type}). "
@@ -300,143 +453,49 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
     )
 
     if step.step_type == 'send_message':
+        # The config for a 'send_message' step IS the message config (flat structure).
+        if not raw_step_config:
+            logger.error(f"Contact {contact.id}: 'send_message' step '{step.name}' (ID: {step.id}) has an empty config. Step cannot be executed.")
+            return actions_to_perform, current_step_context
+        if parsed_config.error:
+            logger.error(f"Contact {contact.id}: Pydantic validation error for 'send_message' step '{step.name}' (ID: {step.id}) config: {parsed_config.error.errors()}. Raw config: {raw_step_config}", exc_info=False)
+            return actions_to_perform, current_step_context
         try:
-            # The config for a 'send_message' step IS the message config.
-            # The previous implementation incorrectly expected it to be nested under a 'message_config' key.
-            # This change aligns the service with the model and serializer validations.
-            message_config_data = raw_step_config
-            if not message_config_data:
-                logger.error(f"Contact {contact.id}: 'send_message' step '{step.name}' (ID: {step.id}) has an empty config. Step cannot be executed.")
-                return actions_to_perform, current_step_context
-
-            send_message_config = StepConfigSendMessage.model_validate(message_config_data)
-            actual_message_type = send_message_config.message_type
-            final_api_data_structure = {}
-
-            if actual_message_type == "text" and send_message_config.text:
-                text_content = send_message_config.text
-                resolved_body = _resolve_value(text_content.body, current_step_context, contact)
-                final_api_data_structure = {'body': resolved_body, 'preview_url': text_content.preview_url}
-            
-            elif actual_message_type in ['image', 'document', 'audio', 'video', 'sticker'] and getattr(send_message_config, actual_message_type):
-                media_conf: MediaMessageContent = getattr(send_message_config, actual_message_type)
-                media_data_to_send = {}
-                
-                valid_source_found = False
-                if MEDIA_ASSET_ENABLED and media_conf.asset_pk:
-                    try:
-                        asset = MediaAsset.objects.get(pk=media_conf.asset_pk)
-                        if asset.status == 'synced' and asset.whatsapp_media_id and not asset.is_whatsapp_id_potentially_expired():
-                            media_data_to_send['id'] = asset.whatsapp_media_id
-                            valid_source_found = True
-                            logger.info(f"Contact {contact.id}: Using MediaAsset {asset.pk} ('{asset.name}') with WA ID: {asset.whatsapp_media_id} for step {step.id}.")
-                        else: 
-                            logger.warning(f"Contact {contact.id}: MediaAsset {asset.pk} ('{asset.name}') not usable for step {step.id} (Status: {asset.status}, Expired: {asset.is_whatsapp_id_potentially_expired()}). Trying direct id/link from config.")
-                    except MediaAsset.DoesNotExist:
-                        logger.error(f"Contact {contact.id}: MediaAsset pk={media_conf.asset_pk} not found for step {step.id}. Trying direct id/link from config.")
-                
-                if not valid_source_found: # Try direct id or link if asset_pk didn't work or wasn't provided
-                    if media_conf.id:
-                        media_data_to_send['id'] = _resolve_value(media_conf.id, current_step_context, contact)
-                        valid_source_found = True
-                    elif media_conf.link:
-                        resolved_link = _resolve_value(media_conf.link, current_step_context, contact)
-                        # If the link is relative (e.g., from Django's media files), make it absolute.
-                        if resolved_link and resolved_link.startswith('/'):
-                            domain = getattr(settings, 'BACKEND_DOMAIN_FOR_CSP', None)
-                            if not domain:
-                                logger.error(f"Contact {contact.id}: Cannot form absolute URL for media link '{resolved_link}' because BACKEND_DOMAIN_FOR_CSP is not set in settings.")
-                                resolved_link = None # Prevent sending a broken link
-                            else:
-                                resolved_link = f"https://{domain}{resolved_link}"
-                        
-                        if resolved_link:
-                            media_data_to_send['link'] = resolved_link
-                            valid_source_found = True
-                
-                if not valid_source_found:
-                    logger.error(f"Contact {contact.id}: No valid media source (asset_pk, id, or link) for {actual_message_type} in step '{step.name}' (ID: {step.id}).")
-                else:
-                    if media_conf.caption:
-                        media_data_to_send['caption'] = _resolve_value(media_conf.caption, current_step_context, contact)
-                    if actual_message_type == 'document' and media_conf.filename:
-                        media_data_to_send['filename'] = _resolve_value(media_conf.filename, current_step_context, contact)
-                    final_api_data_structure = media_data_to_send
-            
-            elif actual_message_type == "interactive" and send_message_config.interactive:
-                interactive_payload_validated = send_message_config.interactive # Already validated by StepConfigSendMessage
-                interactive_payload_dict = interactive_payload_validated.model_dump(exclude_none=True, by_alias=True)
-                
-                # Resolve templates directly within the dictionary structure
-                final_api_data_structure = _resolve_value(interactive_payload_dict, current_step_context, contact)
-
-            elif actual_message_type == "template" and send_message_config.template:
-                template_payload_validated = send_message_config.template
-                template_payload_dict = template_payload_validated.model_dump(exclude_none=True, by_alias=True)
-                if 'components' in template_payload_dict and template_payload_dict['components']:
-                    template_payload_dict['components'] = _resolve_template_components(
-                        template_payload_dict['components'], current_step_context, contact
-                    )
-                final_api_data_structure = template_payload_dict
-            
-            elif actual_message_type == "contacts" and send_message_config.contacts:
-                contacts_list_of_objects = send_message_config.contacts
-                contacts_list_of_dicts = [c.model_dump(exclude_none=True, by_alias=True) for c in contacts_list_of_objects]
-                resolved_contacts = _resolve_value(contacts_list_of_dicts, current_step_context, contact)
-                final_api_data_structure = {"contacts": resolved_contacts}
-
-            elif actual_message_type == "location" and send_message_config.location:
-                location_obj = send_message_config.location
-                location_dict = location_obj.model_dump(exclude_none=True, by_alias=True)
-                final_api_data_structure = {"location": _resolve_value(location_dict, current_step_context, contact)}
-
-            if final_api_data_structure:
-                actions_to_perform.append({
-                    'type': 'send_whatsapp_message',
-                    'recipient_wa_id': contact.whatsapp_id,
-                    'message_type': actual_message_type,
-                    'data': final_api_data_structure
-                })
-            elif actual_message_type: # If type was specified but no payload generated
-                 logger.warning(f"Contact {contact.id}: No data payload generated for message_type '{actual_message_type}' in step '{step.name}' (ID: {step.id}). Pydantic Config: {send_message_config.model_dump_json(indent=2) if send_message_config else None}")
-
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation error for 'send_message' step '{step.name}' (ID: {step.id}) config: {e.errors()}. Raw config: {raw_step_config}", exc_info=False)
+            actions_to_perform.extend(_build_send_message_actions(parsed_config.message, step, contact, current_step_context))
         except Exception as e:
             logger.error(f"Contact {contact.id}: Unexpected error processing 'send_message' step '{step.name}' (ID: {step.id}): {e}", exc_info=True)
 
     elif step.step_type == 'question':
-        try:
-            question_config = StepConfigQuestion.model_validate(raw_step_config)
-            if question_config.message_config and not suppress_prompt: # Only send prompt if not suppressed
+        if parsed_config.error:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'question' step '{step.name}' (ID: {step.id}) failed: {parsed_config.error.errors()}", exc_info=False)
+            return actions_to_perform, current_step_context
+        question_config = parsed_config.config
+        if question_config.message_config and not suppress_prompt: # Only send prompt if not suppressed
+            if parsed_config.message_error:
+                logger.error(f"Contact {contact.id}: Pydantic validation error for 'message_config' within 'question' step '{step.name}' (ID: {step.id}): {parsed_config.message_error.errors()}", exc_info=False)
+            else:
                 try:
-                    temp_msg_pydantic_config = StepConfigSendMessage.model_validate(question_config.message_config)
-                    # The config for a send_message step is the message config itself (flat structure).
-                    dummy_config = temp_msg_pydantic_config.model_dump(exclude_none=True, by_alias=True)
-                    dummy_send_step = FlowStep(
-                        name=f"{step.name}_prompt", step_type="send_message", config=dummy_config
-                    )
-                    send_actions, _ = _execute_step_actions(dummy_send_step, contact, current_step_context)
-                    actions_to_perform.extend(send_actions)
-                except ValidationError as ve:
-                    logger.error(f"Contact {contact.id}: Pydantic validation error for 'message_config' within 'question' step '{step.name}' (ID: {step.id}): {ve.errors()}", exc_info=False)
-            
-            if question_config.reply_config: # This part is always active for a question step
-                current_step_context['_question_awaiting_reply_for'] = {
-                    'variable_name': question_config.reply_config.save_to_variable,
-                    'expected_type': question_config.reply_config.expected_type,
-                    'validation_regex': question_config.reply_config.validation_regex,
-                    'original_question_step_id': step.id 
-                }
-                logger.debug(f"Step '{step.name}' is a question, awaiting reply for: {question_config.reply_config.save_to_variable}")
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'question' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
+                    actions_to_perform.extend(_build_send_message_actions(parsed_config.message, step, contact, current_step_context))
+                except Exception as e:
+                    logger.error(f"Contact {contact.id}: Unexpected error sending prompt of 'question' step '{step.name}' (ID: {step.id}): {e}", exc_info=True)
+
+        if question_config.reply_config: # This part is always active for a question step
+            current_step_context['_question_awaiting_reply_for'] = {
+                'variable_name': question_config.reply_config.save_to_variable,
+                'expected_type': question_config.reply_config.expected_type,
+                'validation_regex': question_config.reply_config.validation_regex,
+                'original_question_step_id': step.id 
+            }
+            logger.debug(f"Step '{step.name}' is a question, awaiting reply for: {question_config.reply_config.save_to_variable}")
 
     elif step.step_type == 'action':
-        try:
-            action_step_config = StepConfigAction.model_validate(raw_step_config)
-            for action_item_conf in action_step_config.actions_to_run:
-                action_type = action_item_conf.action_type
+        if parsed_config.error:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'action' step '{step.name}' (ID: {step.id}) failed: {parsed_config.error.errors()}", exc_info=False)
+            return actions_to_perform, current_step_context
+        action_step_config = parsed_config.config
+        for action_item_conf in action_step_config.actions_to_run:
+            action_type = action_item_conf.action_type
+            with metrics.measure_action(action_type):
                 # Handle custom actions registered in flow_action_registry
                 custom_action_func = flow_action_registry.get(action_type)
                 if custom_action_func:
@@ -464,7 +523,7 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                     if not message_body:
                         logger.warning(f"Contact {contact.id}: 'send_admin_notification' message_template resolved to an empty string. Skipping.")
                         continue
-                    
+                
                     notification_action = {
                         'type': 'send_whatsapp_message', 'recipient_wa_id': admin_number,
                         'message_type': 'text', 'data': {'body': message_body}
@@ -475,11 +534,11 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                     app_label = action_item_conf.app_label
                     model_name = action_item_conf.model_name
                     variable_name = action_item_conf.variable_name
-                    
+                
                     if not app_label or not model_name or not variable_name:
                         logger.error(f"Contact {contact.id}: 'query_model' action in step {step.id} is missing required fields. Skipping.")
                         continue
-                    
+                
                     try:
                         Model = apps.get_model(app_label, model_name)
 
@@ -487,42 +546,55 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                         if not isinstance(filters, dict):
                             logger.warning(f"Contact {contact.id}: 'filters_template' for query_model did not resolve to a dictionary. Using empty filters. Resolved value: {filters}")
                             filters = {}
-                            
-                        queryset = Model.objects.filter(**filters)
                         
-                        order_by_fields = action_item_conf.order_by
-                        if order_by_fields and isinstance(order_by_fields, list):
-                            queryset = queryset.order_by(*order_by_fields)
-                            
-                        if action_item_conf.limit is not None and isinstance(action_item_conf.limit, int):
-                            queryset = queryset[:action_item_conf.limit]
-                            
-                        # --- OPTIMIZATION: Use .values() for performance ---
-                        fields_to_return = getattr(action_item_conf, 'fields_to_return', None)
-                        if fields_to_return and isinstance(fields_to_return, list):
-                            # OPTIMIZED PATH: Use .values() for much faster serialization. This is the recommended approach.
-                            results_list = list(queryset.values(*fields_to_return))
-                            # .values() handles Decimal and basic types. Dates need manual conversion for JSON.
-                            for item in results_list:
-                                for key, value in item.items():
-                                    if isinstance(value, (date, datetime)):
-                                        item[key] = value.isoformat()
+                        order_by_fields = action_item_conf.order_by if isinstance(action_item_conf.order_by, list) else None
+                        fields_to_return = action_item_conf.fields_to_return
+
+                        def run_query():
+                            queryset = Model.objects.filter(**filters)
+                    
+                            if order_by_fields:
+                                queryset = queryset.order_by(*order_by_fields)
+                        
+                            if action_item_conf.limit is not None and isinstance(action_item_conf.limit, int):
+                                queryset = queryset[:action_item_conf.limit]
+                        
+                            # --- OPTIMIZATION: Use .values() for performance ---
+                            if fields_to_return and isinstance(fields_to_return, list):
+                                # OPTIMIZED PATH: Use .values() for much faster serialization. This is the recommended approach.
+                                results_list = list(queryset.values(*fields_to_return))
+                                # .values() handles Decimal and basic types. Dates need manual conversion for JSON.
+                                for item in results_list:
+                                    for key, value in item.items():
+                                        if isinstance(value, (date, datetime)):
+                                            item[key] = value.isoformat()
+                            else:
+                                # BACKWARD COMPATIBILITY PATH: Use model_to_dict (slower)
+                                logger.warning(f"Contact {contact.id}: 'query_model' in step {step.id} is not using 'fields_to_return'. "
+                                               f"Using slower model_to_dict. Consider specifying fields for performance.")
+                                results_list = []
+                                for obj in queryset:
+                                    dict_obj = model_to_dict(obj)
+                                    # Post-process to ensure all values are JSON serializable
+                                    for key, value in dict_obj.items():
+                                        if isinstance(value, (date, datetime)): dict_obj[key] = value.isoformat()
+                                        elif isinstance(value, Decimal): dict_obj[key] = str(value)
+                                        elif isinstance(value, (ImageFieldFile, FileField)):
+                                            try: dict_obj[key] = value.url if value else None
+                                            except ValueError: dict_obj[key] = None
+                                    results_list.append(dict_obj)
+                            return results_list
+
+                        if action_item_conf.cache_ttl and query_cache.is_cacheable(Model):
+                            results_list = query_cache.get_or_query(Model, action_item_conf.cache_ttl, {
+                                'filters': filters, 'order_by': order_by_fields,
+                                'limit': action_item_conf.limit, 'fields_to_return': fields_to_return,
+                            }, run_query)
                         else:
-                            # BACKWARD COMPATIBILITY PATH: Use model_to_dict (slower)
-                            logger.warning(f"Contact {contact.id}: 'query_model' in step {step.id} is not using 'fields_to_return'. "
-                                           f"Using slower model_to_dict. Consider specifying fields for performance.")
-                            results_list = []
-                            for obj in queryset:
-                                dict_obj = model_to_dict(obj)
-                                # Post-process to ensure all values are JSON serializable
-                                for key, value in dict_obj.items():
-                                    if isinstance(value, (date, datetime)): dict_obj[key] = value.isoformat()
-                                    elif isinstance(value, Decimal): dict_obj[key] = str(value)
-                                    elif isinstance(value, (ImageFieldFile, FileField)):
-                                        try: dict_obj[key] = value.url if value else None
-                                        except ValueError: dict_obj[key] = None
-                                results_list.append(dict_obj)
-                            
+                            if action_item_conf.cache_ttl:
+                                logger.warning(f"Contact {contact.id}: 'query_model' in step {step.id} sets cache_ttl, but {Model._meta.label} is not in FLOW_QUERY_CACHE_MODELS. Not caching.")
+                            results_list = run_query()
+
                         current_step_context[variable_name] = results_list
                         logger.info(f"Contact {contact.id}: Action in step {step.id} queried {model_name} and stored {len(results_list)} items in '{variable_name}'.")
                     except LookupError:
@@ -531,74 +603,66 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                         logger.error(f"Contact {contact.id}: 'query_model' action in step {step.id} failed with error: {e}", exc_info=True)
                 else:
                     logger.warning(f"Contact {contact.id}: Unknown or misconfigured action_type '{action_type}' in step '{step.name}' (ID: {step.id}).")
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'action' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
 
     elif step.step_type == 'switch_flow':
-        try:
-            switch_config = StepConfigSwitchFlow.model_validate(raw_step_config)
-            
-            # Start with the initial context from the config and resolve any templates in it
-            initial_context = _resolve_value(switch_config.initial_context_template or {}, current_step_context, contact)
-            if not isinstance(initial_context, dict):
-                initial_context = {}
-
-            # If a keyword is specified, add it to the context being passed to the new flow
-            if switch_config.trigger_keyword_to_pass:
-                initial_context['simulated_trigger_keyword'] = switch_config.trigger_keyword_to_pass
-
-            # Resolve the target flow name as a template to allow for dynamic switching
-            resolved_target_flow_name = _resolve_value(switch_config.target_flow_name, current_step_context, contact)
-            if not resolved_target_flow_name:
-                logger.error(f"Contact {contact.id}: 'switch_flow' step '{step.name}' target_flow_name resolved to an empty value. Cannot switch. Template: '{switch_config.target_flow_name}'")
-                return actions_to_perform, current_step_context
-
-            actions_to_perform.append({
-                'type': '_internal_command_switch_flow',
-                'target_flow_name': resolved_target_flow_name,
-                'initial_context': initial_context
-            })
-            logger.info(f"Contact {contact.id}: Step '{step.name}' queued switch to flow '{resolved_target_flow_name}'.")
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'switch_flow' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
+        if parsed_config.error:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'switch_flow' step '{step.name}' (ID: {step.id}) failed: {parsed_config.error.errors()}", exc_info=False)
+            return actions_to_perform, current_step_context
+        switch_config = parsed_config.config
+        
+        # Start with the initial context from the config and resolve any templates in it
+        initial_context = _resolve_value(switch_config.initial_context_template or {}, current_step_context, contact)
+        if not isinstance(initial_context, dict):
+            initial_context = {}
+
+        # If a keyword is specified, add it to the context being passed to the new flow
+        if switch_config.trigger_keyword_to_pass:
+            initial_context['simulated_trigger_keyword'] = switch_config.trigger_keyword_to_pass
+
+        # Resolve the target flow name as a template to allow for dynamic switching
+        resolved_target_flow_name = _resolve_value(switch_config.target_flow_name, current_step_context, contact)
+        if not resolved_target_flow_name:
+            logger.error(f"Contact {contact.id}: 'switch_flow' step '{step.name}' target_flow_name resolved to an empty value. Cannot switch. Template: '{switch_config.target_flow_name}'")
+            return actions_to_perform, current_step_context
+
+        actions_to_perform.append({
+            'type': '_internal_command_switch_flow',
+            'target_flow_name': resolved_target_flow_name,
+            'initial_context': initial_context
+        })
+        logger.info(f"Contact {contact.id}: Step '{step.name}' queued switch to flow '{resolved_target_flow_name}'.")
 
     elif step.step_type == 'end_flow':
-        try:
-            end_flow_config = StepConfigEndFlow.model_validate(raw_step_config)
-            if end_flow_config.message_config:
-                try:
-                    final_msg_pydantic_config = StepConfigSendMessage.model_validate(end_flow_config.message_config)
-                    # The config for a send_message step is the message config itself (flat structure).
-                    dummy_config = final_msg_pydantic_config.model_dump(exclude_none=True, by_alias=True)
-                    dummy_end_msg_step = FlowStep(
-                        name=f"{step.name}_final_msg", step_type="send_message", config=dummy_config
-                    )
-                    send_actions, _ = _execute_step_actions(dummy_end_msg_step, contact, current_step_context)
-                    actions_to_perform.extend(send_actions)
-                except ValidationError as ve:
-                     logger.error(f"Contact {contact.id}: Pydantic validation for 'message_config' in 'end_flow' step '{step.name}' (ID: {step.id}): {ve.errors()}", exc_info=False)
-            logger.info(f"Contact {contact.id}: Executing 'end_flow' step '{step.name}' (ID: {step.id}).")
-            actions_to_perform.append({'type': '_internal_command_clear_flow_state'})
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'end_flow' step '{step.name}' (ID: {step.id}) config: {e.errors()}", exc_info=False)
+        if parsed_config.error:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'end_flow' step '{step.name}' (ID: {step.id}) config: {parsed_config.error.errors()}", exc_info=False)
+            return actions_to_perform, current_step_context
+        if parsed_config.message_error:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'message_config' in 'end_flow' step '{step.name}' (ID: {step.id}): {parsed_config.message_error.errors()}", exc_info=False)
+        elif parsed_config.message:
+            try:
+                actions_to_perform.extend(_build_send_message_actions(parsed_config.message, step, contact, current_step_context))
+            except Exception as e:
+                logger.error(f"Contact {contact.id}: Unexpected error sending final message of 'end_flow' step '{step.name}' (ID: {step.id}): {e}", exc_info=True)
+        logger.info(f"Contact {contact.id}: Executing 'end_flow' step '{step.name}' (ID: {step.id}).")
+        actions_to_perform.append({'type': '_internal_command_clear_flow_state'})
 
     elif step.step_type == 'human_handover':
-        try:
-            handover_config = StepConfigHumanHandover.model_validate(raw_step_config)
-            logger.info(f"Executing 'human_handover' step '{step.name}'.")
-            if handover_config.pre_handover_message_text and not suppress_prompt: # Avoid sending pre-handover message on re-execution/fallback
-                resolved_msg = _resolve_value(handover_config.pre_handover_message_text, current_step_context, contact)
-                actions_to_perform.append({'type': 'send_whatsapp_message', 'recipient_wa_id': contact.whatsapp_id, 'message_type': 'text', 'data': {'body': resolved_msg}})
-            
-            contact.needs_human_intervention = True
-            contact.intervention_requested_at = timezone.now()
-            contact.save(update_fields=['needs_human_intervention', 'intervention_requested_at'])
-            logger.info(f"Contact {contact.id} ({contact.whatsapp_id}) flagged for human intervention.")
-            notification_info = _resolve_value(handover_config.notification_details or f"Contact {contact.name or contact.whatsapp_id} requires help.", current_step_context, contact)
-            logger.info(f"HUMAN INTERVENTION NOTIFICATION: {notification_info}. Context: {current_step_context}")
-            actions_to_perform.append({'type': '_internal_command_clear_flow_state'})
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'human_handover' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
+        if parsed_config.error:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'human_handover' step '{step.name}' (ID: {step.id}) failed: {parsed_config.error.errors()}", exc_info=False)
+            return actions_to_perform, current_step_context
+        handover_config = parsed_config.config
+        logger.info(f"Executing 'human_handover' step '{step.name}'.")
+        if handover_config.pre_handover_message_text and not suppress_prompt: # Avoid sending pre-handover message on re-execution/fallback
+            resolved_msg = _resolve_value(handover_config.pre_handover_message_text, current_step_context, contact)
+            actions_to_perform.append({'type': 'send_whatsapp_message', 'recipient_wa_id': contact.whatsapp_id, 'message_type': 'text', 'data': {'body': resolved_msg}})
+        
+        contact.needs_human_intervention = True
+        contact.intervention_requested_at = timezone.now()
+        contact.save(update_fields=['needs_human_intervention', 'intervention_requested_at'])
+        logger.info(f"Contact {contact.id} ({contact.whatsapp_id}) flagged for human intervention.")
+        notification_info = _resolve_value(handover_config.notification_details or f"Contact {contact.name or contact.whatsapp_id} requires help.", current_step_context, contact)
+        logger.info(f"HUMAN INTERVENTION NOTIFICATION: {notification_info}. Context: {current_step_context}")
+        actions_to_perform.append({'type': '_internal_command_clear_flow_state'})
 
     elif step.step_type in ['condition', 'wait_for_reply', 'start_flow_node']: # 'wait_for_reply' is more a state than an executable step here
         logger.debug(f"'{step.step_type}' step '{step.name}' processed. No direct actions from this function, logic handled by transitions or flow control.")
@@ -628,18 +692,17 @@ def _create_human_handover_actions(contact: Contact, message_text: str) -> List[
     actions.append({'type': '_internal_command_clear_flow_state'})
     return actions
 
-def _handle_fallback(current_step: FlowStep, contact: Contact, flow_context: dict, contact_flow_state: ContactFlowState) -> List[Dict[str, Any]]:
+def _handle_fallback(current_step: FlowStep, contact: Contact, flow_context: dict, session: FlowStateSession) -> List[Dict[str, Any]]:
     """
     Handles the logic when no transition condition is met from a step.
     This can be due to an invalid user reply to a question, or a logical dead-end in the flow.
     """
     actions_to_perform = []
     updated_context = flow_context.copy()
-    try:
-        fallback_config = FallbackConfig.model_validate(current_step.config.get('fallback_config', {}) if isinstance(current_step.config, dict) else {})
-    except ValidationError as e:
-        logger.warning(f"Invalid fallback_config for step {current_step.id}. Using defaults. Errors: {e.errors()}")
-        fallback_config = FallbackConfig()
+    parsed_config = _get_step_config(current_step)
+    fallback_config = parsed_config.fallback or FallbackConfig()
+    if parsed_config.fallback_error:
+        logger.warning(f"Invalid fallback_config for step {current_step.id}. Using defaults. Errors: {parsed_config.fallback_error.errors()}")
 
     # Scenario 1: The step was a question, and the user's reply was invalid.
     if current_step.step_type == 'question':
@@ -664,9 +727,8 @@ def _handle_fallback(current_step: FlowStep, contact: Contact, flow_context: dic
             actions_to_perform.extend(step_actions)
             updated_context = re_executed_context
  
-            # Save the updated context (with incremented fallback_count) and keep the user in the step
-            contact_flow_state.flow_context_data = updated_context
-            contact_flow_state.save(update_fields=['flow_context_data', 'last_updated_at'])
+            # Keep the updated context (with incremented fallback_count) and keep the user in the step
+            session.set_context(updated_context)
             return actions_to_perform
         else: # Retries exhausted or action is not 're_prompt'
             action_after_retries = fallback_config.action_after_retries
@@ -678,7 +740,7 @@ def _handle_fallback(current_step: FlowStep, contact: Contact, flow_context: dic
                     step_type=action_after_retries,
                     config=fallback_config.config_after_retries or {}
                 )
-                return _execute_step_actions(dummy_fallback_step, contact, updated_context)[0]
+                return _execute_step_actions(dummy_fallback_step, contact, updated_context, parsed_config=parsed_config.after_retries)[0]
             else:
                 # ROBUSTNESS: Default behavior after retries is now human handover, not silent exit.
                 logger.warning(f"Fallback retries exhausted for step '{current_step.name}' and no 'action_after_retries' defined. Defaulting to human handover for contact {contact.id}.")
@@ -695,64 +757,34 @@ def _handle_fallback(current_step: FlowStep, contact: Contact, flow_context: dic
         handover_message = "Apologies, I've encountered a technical issue and can't continue. I'm alerting a team member to assist you."
         return _create_human_handover_actions(contact, handover_message)
 
-def _trigger_new_flow(contact: Contact, message_data: dict, incoming_message_obj: Message) -> bool:
+def _trigger_new_flow(contact: Contact, message_data: dict, incoming_message_obj: Message, session: FlowStateSession) -> bool:
     """
     Finds and sets up the initial state for a new flow based on a trigger keyword.
-    This function does NOT execute the first step; it only creates the state.
+    This function does NOT execute the first step; it only starts the flow in the session.
     The main processing loop is responsible for all step executions.
 
     Returns:
         True if a flow was triggered, False otherwise.
     """
     message_text_body = message_data.get('text', {}).get('body', '').strip() # Keep original case for extraction
-    message_text_lower = message_text_body.lower()
 
     triggered_flow = None
     initial_context = {} # To hold any data extracted from the trigger
-    
-    active_flows = Flow.objects.filter(is_active=True).order_by('name')
-
-    if message_text_body:  # Only attempt keyword trigger if there's text
-        for flow_candidate in active_flows:
-            if isinstance(flow_candidate.trigger_keywords, list):
-                for keyword in flow_candidate.trigger_keywords:
-                    if keyword.strip().lower() in message_text_lower and (not hasattr(contact, 'flow_state')):
-                        triggered_flow = flow_candidate
-                        
-                        # --- DYNAMIC DATA EXTRACTION FROM TRIGGER ---
-                        trigger_conf = triggered_flow.trigger_config or {}
-                        extraction_regex = trigger_conf.get("extraction_regex")
-                        context_var_name = trigger_conf.get("context_variable")
-
-                        if extraction_regex and context_var_name:
-                            try:
-                                match = re.search(extraction_regex, message_text_body)
-                                if match and match.groups():
-                                    extracted_data = match.group(1) # Use the first capturing group
-                                    initial_context[context_var_name] = extracted_data.strip()
-                                    logger.info(f"Extracted '{extracted_data.strip()}' into '{context_var_name}' from trigger for flow '{flow_candidate.name}'.")
-                            except re.error as e:
-                                logger.error(f"Invalid extraction_regex for flow '{flow_candidate.name}': {e}")
-
-                        logger.info(f"Keyword '{keyword}' triggered flow '{flow_candidate.name}' for contact {contact.whatsapp_id}.")
-                        break
-            if triggered_flow:
-                break
+
+    if message_text_body and not session.is_active:  # Only attempt keyword trigger if there's text
+        # A single pass over the text against every active flow's keywords; flows keep name-order priority.
+        trigger_match = get_trigger_index().match(message_text_body)
+        if trigger_match:
+            triggered_flow = trigger_match.flow
+            initial_context = trigger_match.initial_context
+            logger.info(f"Keyword '{trigger_match.keyword}' triggered flow '{triggered_flow.name}' for contact {contact.whatsapp_id}.")
 
     if triggered_flow:
-        entry_point_step = FlowStep.objects.filter(flow=triggered_flow, is_entry_point=True).first()
+        entry_point_step = get_compiled_flow(triggered_flow).entry_point
         if entry_point_step:
             logger.info(f"Setting up new flow '{triggered_flow.name}' for contact {contact.whatsapp_id} at entry step '{entry_point_step.name}'.")
 
-            _clear_contact_flow_state(contact)
-
-            ContactFlowState.objects.create(
-                contact=contact,
-                current_flow=triggered_flow,
-                current_step=entry_point_step,
-                flow_context_data=initial_context, # Pass the extracted context
-                started_at=timezone.now()
-            )
+            session.start(triggered_flow, entry_point_step, initial_context) # Pass the extracted context
             return True
         else:
             logger.error(f"Flow '{triggered_flow.name}' is active but has no entry point step defined.")
@@ -762,193 +794,36 @@ def _trigger_new_flow(contact: Contact, message_data: dict, incoming_message_obj
     return False
 
 
-def _evaluate_transition_condition(transition: FlowTransition, contact: Contact, message_data: dict, flow_context: dict, incoming_message_obj: Message) -> bool:
-    config = transition.condition_config
-    if not isinstance(config, dict):
-        logger.warning(f"Transition {transition.id} has invalid condition_config (not a dict): {config}")
-        return False
-    condition_type = config.get('type')
-    logger.debug(f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: Evaluating condition type '{condition_type}' for transition {transition.id}. Context: {flow_context}, Message Type: {message_data.get('type')}")
-
-    if not condition_type: return False # No condition type means no specific condition to evaluate beyond default
-    if condition_type == 'always_true': return True
-
-    user_text = ""
-    if message_data.get('type') == 'text' and isinstance(message_data.get('text'), dict):
-        user_text = message_data.get('text', {}).get('body', '').strip()
-
-    interactive_reply_id = None
-    nfm_response_data = None 
-    if message_data.get('type') == 'interactive' and isinstance(message_data.get('interactive'), dict):
-        interactive_payload = message_data.get('interactive', {})
-        interactive_type_from_payload = interactive_payload.get('type')
-        if interactive_type_from_payload == 'button_reply' and isinstance(interactive_payload.get('button_reply'), dict):
-            interactive_reply_id = interactive_payload.get('button_reply', {}).get('id')
-        elif interactive_type_from_payload == 'list_reply' and isinstance(interactive_payload.get('list_reply'), dict):
-            interactive_reply_id = interactive_payload.get('list_reply', {}).get('id')
-        elif interactive_type_from_payload == 'nfm_reply' and isinstance(interactive_payload.get('nfm_reply'), dict):
-            nfm_payload = interactive_payload.get('nfm_reply', {})
-            response_json_str = nfm_payload.get('response_json')
-            if response_json_str:
-                try:
-                    nfm_response_data = json.loads(response_json_str)
-                except json.JSONDecodeError:
-                    logger.warning(f"Could not parse nfm_reply response_json for transition {transition.id}")
-    
-    # --- Condition Implementations ---
-    value_for_condition = config.get('value') # Get expected value for comparison
-
-    if condition_type == 'user_reply_matches_keyword':
-        keyword = str(config.get('keyword', '')).strip()
-        if not keyword: return False # Cannot match empty keyword
-        case_sensitive = config.get('case_sensitive', False)
-        return (keyword == user_text) if case_sensitive else (keyword.lower() == user_text.lower())
-    
-    elif condition_type == 'user_reply_contains_keyword':
-        keyword = str(config.get('keyword', '')).strip()
-        if not keyword: return False
-        case_sensitive = config.get('case_sensitive', False)
-        return (keyword in user_text) if case_sensitive else (keyword.lower() in user_text.lower())
-    
-    elif condition_type == 'interactive_reply_id_equals':
-        return interactive_reply_id is not None and interactive_reply_id == str(value_for_condition)
-    
-    elif condition_type == 'message_type_is':
-        return message_data.get('type') == str(value_for_condition) # Compare with expected message_type
-    
-    elif condition_type == 'user_reply_matches_regex':
-        regex = config.get('regex')
-        if regex and user_text:
-            try: return bool(re.match(regex, user_text))
-            except re.error as e: logger.error(f"Invalid regex in transition {transition.id}: {regex}. Error: {e}"); return False
-        return False
-        
-    elif condition_type == 'variable_equals':
-        variable_name = config.get('variable_name')
-        if variable_name is None: return False
-        actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
-        # Compare as strings for simplicity and predictability in flow logic
-        result = str(actual_value) == str(value_for_condition)
-        logger.debug(
-            f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: "
-            f"Condition 'variable_equals' check for '{variable_name}'. "
-            f"Actual: '{actual_value}' (type: {type(actual_value).__name__}), "
-            f"Expected: '{value_for_condition}' (type: {type(value_for_condition).__name__}). "
-            f"Result (str comparison): {result}"
-        )
-        return result
-        
-    elif condition_type == 'variable_exists':
-        variable_name_template = config.get('variable_name')
-        if variable_name_template is None: return False
-        # Resolve the variable name itself as a template to handle dynamic paths like 'list.{{ index }}'
-        resolved_variable_path = _resolve_value(variable_name_template, flow_context, contact)
-        actual_value = _get_value_from_context_or_contact(resolved_variable_path, flow_context, contact)
-        result = actual_value is not None
-        logger.debug(
-            f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: "
-            f"Condition 'variable_exists' check for '{resolved_variable_path}'. "
-            f"Value: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}). Result: {result}"
-        )
-        return result
-        
-    elif condition_type == 'variable_contains':
-        variable_name = config.get('variable_name')
-        if variable_name is None: return False
-        actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
-        expected_item = value_for_condition # This is the 'value' field from config
-        result = False
-        if isinstance(actual_value, str) and isinstance(expected_item, str): result = expected_item in actual_value
-        elif isinstance(actual_value, list) and expected_item is not None: result = expected_item in actual_value
-        
-        logger.debug(
-            f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: "
-            f"Condition 'variable_contains' check for '{variable_name}'. "
-            f"Container: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}), "
-            f"Expected item: '{expected_item}'. Result: {result}"
-        )
-        return result
-
-    elif condition_type == 'nfm_response_field_equals' and nfm_response_data:
-        field_path = config.get('field_path')
-        if not field_path: return False
-        actual_val_from_nfm = nfm_response_data
-        for part in field_path.split('.'):
-            if isinstance(actual_val_from_nfm, dict): actual_val_from_nfm = actual_val_from_nfm.get(part)
-            else: actual_val_from_nfm = None; break
-        return actual_val_from_nfm == value_for_condition
-
-    elif condition_type == 'question_reply_is_valid':
-        # This condition is now implicitly handled by the logic within _handle_active_flow_step
-        # when it processes a reply for a question. If flow_context has the saved variable,
-        # it means the reply was valid according to the question's own reply_config.
-        # The transition would then typically check if that variable_exists or variable_equals.
-        # However, to directly use this condition type, we'd need to re-evaluate validity here.
-        # For now, assume a question step saves valid reply to context, then use 'variable_exists'
-        # or 'variable_equals' on the saved variable in the transition.
-        # If value_for_condition is True, check if the specific variable for the current question (if any) was set.
-        question_expectation = flow_context.get('_question_awaiting_reply_for')
-        if question_expectation and isinstance(question_expectation, dict):
-            var_name = question_expectation.get('variable_name')
-            # If value is True, we check if the variable was set (implying valid reply)
-            # If value is False, we check if the variable was *not* set (implying invalid reply)
-            is_var_set = var_name in flow_context
-            return is_var_set if value_for_condition is True else not is_var_set
-        return False # No question was being awaited or config mismatch
-
-    elif condition_type == 'user_requests_human':
-        human_request_keywords = config.get('keywords', ['help', 'support', 'agent', 'human', 'operator'])
-        if user_text and isinstance(human_request_keywords, list):
-            user_text_lower = user_text.lower()
-            for keyword in human_request_keywords:
-                if isinstance(keyword, str) and keyword.strip() and keyword.strip().lower() in user_text_lower:
-                    logger.info(f"User requested human agent with keyword: '{keyword}'")
-                    return True
-        return False
-
-    logger.warning(f"Unknown or unhandled condition type: '{condition_type}' for transition {transition.id} or condition logic not met.")
-    return False
+def _evaluate_transition_condition(transition: FlowTransition, contact: Contact, event: InboundEvent, flow_context: dict, compiled_flow=None) -> bool:
+    """
+    Evaluates a transition's condition against the normalised inbound event.
+    The predicate comes from the compiled flow graph; it is compiled on the spot only for transitions outside it.
+    """
+    predicate = compiled_flow.get_condition(transition.id) if compiled_flow is not None else None
+    if predicate is None:
+        predicate = compile_condition(transition)
+    logger.debug(f"Contact {contact.id}, Step {transition.current_step_id}: Evaluating condition for transition {transition.id}. Message Type: {event.type}")
+    return predicate(event, flow_context, contact)
 
 
-def _transition_to_step(contact_flow_state: ContactFlowState, next_step: FlowStep, current_flow_context: dict, contact: Contact, message_data: dict) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
-    logger.info(f"Transitioning contact {contact.whatsapp_id} from '{contact_flow_state.current_step.name}' to '{next_step.name}' in flow '{contact_flow_state.current_flow.name}'.")
+def _transition_to_step(session: FlowStateSession, next_step: FlowStep, current_flow_context: dict, contact: Contact, message_data: dict) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    current_step = session.current_step
+    logger.info(f"Transitioning contact {contact.whatsapp_id} from '{current_step.name}' to '{next_step.name}' in flow '{session.current_flow.name}'.")
     
     # Clear question-specific context from the *previous* step if it was a question
-    if contact_flow_state.current_step.step_type == 'question':
+    if current_step.step_type == 'question':
         current_flow_context.pop('_question_awaiting_reply_for', None)
         current_flow_context.pop('_fallback_count', None)
-        logger.debug(f"Cleared question expectation and fallback count from previous step '{contact_flow_state.current_step.name}'.")
+        logger.debug(f"Cleared question expectation and fallback count from previous step '{current_step.name}'.")
 
-    # --- FIX: Save the new step and the context from the previous step's answer ---
-    # This ensures the contact is officially at the new step before we execute its actions.
-    contact_flow_state.current_step = next_step
-    contact_flow_state.flow_context_data = current_flow_context
-    # Use transaction.atomic to ensure that the state update and subsequent actions
-    # are treated as a single unit of work where possible.
-    # The save() here commits the move to the new step.
-    contact_flow_state.save()
+    # Move to the new step before executing its actions. Nothing is written here;
+    # the session persists the final step and context once the whole message has been processed.
+    session.move_to(next_step)
 
     actions_from_new_step, context_after_new_step_execution = _execute_step_actions(
         next_step, contact, current_flow_context.copy() # Pass a copy to avoid modification by reference if new step also modifies
     )
-    
-    # Re-fetch state to see if it was cleared or changed by _execute_step_actions (e.g., by end_flow, human_handover, switch_flow)
-    # This is a critical check for robustness.
-    with transaction.atomic():
-        current_db_state = ContactFlowState.objects.select_for_update().filter(contact=contact).first()
-
-        if current_db_state and current_db_state.pk == contact_flow_state.pk:
-            # If the state still exists and belongs to this flow, then save the context
-            # that resulted from executing this 'next_step'.
-            if current_db_state.flow_context_data != context_after_new_step_execution:
-                current_db_state.flow_context_data = context_after_new_step_execution
-                current_db_state.save(update_fields=['flow_context_data', 'last_updated_at'])
-                logger.debug(f"Saved updated context for contact {contact.whatsapp_id} after executing step '{next_step.name}'.")
-        elif not current_db_state:
-            logger.info(f"ContactFlowState for contact {contact.whatsapp_id} was cleared during execution of step '{next_step.name}'. No final context to save.")
-        else: # State exists but is different (e.g., switched flow)
-            logger.info(f"ContactFlowState for contact {contact.whatsapp_id} changed during execution of step '{next_step.name}'. New state: {current_db_state}")
-        
+    session.set_context(context_after_new_step_execution)
     return actions_from_new_step, context_after_new_step_execution
 
 
@@ -1086,7 +961,13 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
     """
     Main entry point to process an incoming message for a contact against flows.
     Determines if the contact is in an active flow or if a new flow should be triggered.
+    Wall time, DB queries and loop iterations of each call are recorded by `metrics.MessageMetrics`.
     """
+    message_id = incoming_message_obj.id if incoming_message_obj else None
+    with metrics.MessageMetrics(contact_id=contact.id, message_id=message_id) as message_metrics:
+        return _run_flow_engine(contact, message_data, incoming_message_obj, message_metrics)
+
+def _run_flow_engine(contact: Contact, message_data: dict, incoming_message_obj: Message, message_metrics: metrics.MessageMetrics) -> List[Dict[str, Any]]:
     if contact.needs_human_intervention:
         logger.info(
             f"Flow processing is paused for contact {contact.id} ({contact.whatsapp_id}) "
@@ -1096,29 +977,27 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
         return []
 
     actions_to_perform = []
+    # The contact's flow state is read and locked once here, kept in memory through all
+    # fall-through steps, and written back once by session.commit() below.
+    session = FlowStateSession(contact)
     try:
-        contact_flow_state = ContactFlowState.objects.select_related('current_flow', 'current_step').filter(contact=contact).first()
+        session.load()
+        message_metrics.set_flow(session.current_flow)
 
         # If no active flow, try to trigger one. This is the only time a user message can start a flow.
-        if not contact_flow_state:
+        if not session.is_active:
             logger.info(f"No active flow state for contact {contact.whatsapp_id}. Attempting to trigger a new flow.")
-            flow_was_triggered = _trigger_new_flow(contact, message_data, incoming_message_obj)
+            flow_was_triggered = _trigger_new_flow(contact, message_data, incoming_message_obj, session)
             
             if flow_was_triggered:
+                message_metrics.set_flow(session.current_flow)
                 # A new flow was started. Execute its entry step's actions now.
-                contact_flow_state = ContactFlowState.objects.select_related('current_flow', 'current_step').filter(contact=contact).first()
-                if not contact_flow_state:
-                    logger.warning(f"Flow was triggered for contact {contact.id} but no state was found immediately after (likely ended on first step). Exiting.")
-                    return []
-
-                entry_step = contact_flow_state.current_step
-                initial_context = contact_flow_state.flow_context_data or {}
+                entry_step = session.current_step
+                initial_context = session.context or {}
                 
                 entry_actions, updated_context = _execute_step_actions(entry_step, contact, initial_context.copy())
                 actions_to_perform.extend(entry_actions)
-                
-                contact_flow_state.flow_context_data = updated_context
-                contact_flow_state.save(update_fields=['flow_context_data', 'last_updated_at'])
+                session.set_context(updated_context)
                 
                 # If the entry step was a question or ends the flow, we are done with this message.
                 if entry_step.step_type in ['question', 'end_flow', 'human_handover']:
@@ -1128,11 +1007,12 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                     final_actions_for_meta_view = []
                     for action in actions_to_perform:
                         if action.get('type') == '_internal_command_clear_flow_state':
-                            _clear_contact_flow_state(contact)
+                            session.clear()
                             logger.debug(f"Contact {contact.id}: Processed internal command to clear flow state from entry step.")
                         elif action.get('type') == 'send_whatsapp_message':
                             final_actions_for_meta_view.append(action)
                     
+                    session.commit()
                     return final_actions_for_meta_view
                 else:
                     # It's a fall-through step. We need to enter the main processing loop
@@ -1142,20 +1022,24 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                 # No flow triggered, nothing more to do.
                 return []
 
+        event = None
+
         # --- Start of Main Flow Processing Loop ---
         # This loop will continue as long as the contact is in an active flow state.
         # It allows for "fall-through" steps (like 'action' steps) to be processed immediately.
         while True:
-            # Re-fetch state in each loop iteration for robustness
-            is_internal_message = message_data.get('type', '').startswith('internal_')
-            contact_flow_state = ContactFlowState.objects.select_related('current_flow', 'current_step').filter(contact=contact).first()
+            if event is None or event.raw is not message_data:
+                event = InboundEvent(message_data) # Parsed once per message, shared by the question step and all transitions
+            is_internal_message = event.is_internal
 
-            if not contact_flow_state:
+            if not session.is_active:
                 logger.info(f"Flow state was cleared, exiting processing loop for contact {contact.id}.")
                 break # Flow was ended inside the loop.
-            
-            current_step = contact_flow_state.current_step
-            flow_context = contact_flow_state.flow_context_data if contact_flow_state.flow_context_data is not None else {}
+
+            message_metrics.iteration()
+            message_metrics.set_flow(session.current_flow) # A switch_flow step may have moved the contact to another flow
+            current_step = session.current_step
+            flow_context = session.context
 
             logger.debug(f"Handling active flow. Contact: {contact.whatsapp_id}, Current Step: '{current_step.name}' (Type: {current_step.step_type}). Context: {flow_context}")
 
@@ -1173,26 +1057,10 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                 expected_reply_type = question_expectation.get('expected_type')
                 validation_regex_ctx = question_expectation.get('validation_regex')
                 
-                user_text = message_data.get('text', {}).get('body', '').strip() if message_data.get('type') == 'text' else None
-                interactive_reply_id = None
-                if message_data.get('type') == 'interactive':
-                    interactive_payload = message_data.get('interactive', {})
-                    interactive_type = interactive_payload.get('type')
-                    if interactive_type == 'button_reply':
-                        interactive_reply_id = interactive_payload.get('button_reply', {}).get('id')
-                    elif interactive_type == 'list_reply':
-                        interactive_reply_id = interactive_payload.get('list_reply', {}).get('id')
-                    elif interactive_type == 'nfm_reply': # Handle Native Flow Message reply
-                        response_json_str = interactive_payload.get('nfm_reply', {}).get('response_json')
-                        if response_json_str:
-                            try: 
-                                nfm_response_data = json.loads(response_json_str)
-                            except json.JSONDecodeError: 
-                                logger.warning(f"Could not parse nfm_reply response_json for question step {current_step.name}")
-                
-                
-                
-                image_payload = message_data.get('image') if message_data.get('type') == 'image' else None
+                user_text = event.text if event.type == 'text' else None
+                interactive_reply_id = event.interactive_id
+                nfm_response_data = event.nfm_data
+                image_media_id = event.media_id if event.type == 'image' else None
 
                 reply_is_valid = False
                 value_to_save = None
@@ -1227,10 +1095,9 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                 elif expected_reply_type == 'interactive_id' and interactive_reply_id:
                     value_to_save = interactive_reply_id
                     reply_is_valid = True
-                elif expected_reply_type == 'image' and image_payload:
-                    value_to_save = image_payload.get('id') # Save the WhatsApp Media ID
-                    if value_to_save:
-                        reply_is_valid = True
+                elif expected_reply_type == 'image' and image_media_id:
+                    value_to_save = image_media_id # Save the WhatsApp Media ID
+                    reply_is_valid = True
                 elif expected_reply_type == 'nfm_reply' and nfm_response_data is not None:
                     value_to_save = nfm_response_data
                     reply_is_valid = True
@@ -1250,41 +1117,34 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                 just_triggered_flow = False # Unset flag if it was set
 
             # --- Step 2: Evaluate transitions from the current step ---
-            transitions = FlowTransition.objects.filter(current_step=current_step).select_related('next_step').order_by('priority')
+            compiled_flow = get_compiled_flow(session.current_flow)
             next_step_to_transition_to = None
-            for transition in transitions:
-                if _evaluate_transition_condition(transition, contact, message_data, flow_context, incoming_message_obj):
+            for transition in compiled_flow.transitions_from(current_step.id):
+                if _evaluate_transition_condition(transition, contact, event, flow_context, compiled_flow):
                     next_step_to_transition_to = transition.next_step
                     logger.info(f"Transition condition met: From '{current_step.name}' to '{next_step_to_transition_to.name}'.")
                     break
             
             if next_step_to_transition_to:
-                actions, flow_context = _transition_to_step(contact_flow_state, next_step_to_transition_to, flow_context, contact, message_data)
+                actions, flow_context = _transition_to_step(session, next_step_to_transition_to, flow_context, contact, message_data)
                 # Check for a switch_flow command specifically to handle it within the loop.
                 switch_action = next((a for a in actions if a.get('type') == '_internal_command_switch_flow'), None)
                 if switch_action:
                     logger.info(f"Contact {contact.id}: Processing internal command to switch flow within the main loop.")
                     try:
-                        _clear_contact_flow_state(contact) # Clear old state
-
                         new_flow_name = switch_action.get('target_flow_name')
                         initial_context_for_new_flow = switch_action.get('initial_context', {})
 
                         target_flow = Flow.objects.get(name=new_flow_name, is_active=True)
-                        entry_point_step = FlowStep.objects.filter(flow=target_flow, is_entry_point=True).first()
+                        entry_point_step = get_compiled_flow(target_flow).entry_point
 
                         if not entry_point_step:
                             raise ValueError(f"Flow '{new_flow_name}' is active but has no entry point step defined.")
                         
                         logger.info(f"Contact {contact.id}: Switching to flow '{target_flow.name}' at entry step '{entry_point_step.name}'.")
                         
-                        new_contact_flow_state = ContactFlowState.objects.create(
-                            contact=contact,
-                            current_flow=target_flow,
-                            current_step=entry_point_step,
-                            flow_context_data=initial_context_for_new_flow,
-                            started_at=timezone.now()
-                        )
+                        # Replaces the old flow's state; the row is updated in place on commit.
+                        session.start(target_flow, entry_point_step, initial_context_for_new_flow)
 
                         # Manually execute the actions for the new entry point step.
                         # This ensures that 'action' steps at the start of a flow are run immediately
@@ -1294,10 +1154,9 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                         )
                         actions_to_perform.extend(entry_actions)
                         
-                        # Save the context after this first execution
-                        new_contact_flow_state.flow_context_data = updated_context
-                        new_contact_flow_state.save(update_fields=['flow_context_data', 'last_updated_at'])
-                        logger.debug(f"Contact {contact.id}: Executed entry step '{entry_point_step.name}' and saved context.")
+                        # Keep the context after this first execution
+                        session.set_context(updated_context)
+                        logger.debug(f"Contact {contact.id}: Executed entry step '{entry_point_step.name}'.")
                         
                         # Check if the new entry point immediately ended the flow.
                         # If so, break the main loop to allow the clear_state command to be processed.
@@ -1313,7 +1172,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
 
                     except (Flow.DoesNotExist, ValueError) as e:
                         logger.error(f"Contact {contact.id}: Failed to switch flow to '{switch_action.get('target_flow_name')}'. Error: {e}", exc_info=True)
-                        _clear_contact_flow_state(contact, error=True) # Ensure state is cleared on failure
+                        session.clear(error=True) # Ensure state is cleared on failure
                         actions_to_perform.append({
                             'type': 'send_whatsapp_message', 'recipient_wa_id': contact.whatsapp_id, 'message_type': 'text',
                             'data': {'body': 'I seem to be having some technical difficulties. Please try again in a moment.'}
@@ -1327,14 +1186,13 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
 
             else:
                 logger.info(f"No transition met for step '{current_step.name}'. Engaging fallback logic for contact {contact.id}.")
-                fallback_actions = _handle_fallback(current_step, contact, flow_context, contact_flow_state)
+                fallback_actions = _handle_fallback(current_step, contact, flow_context, session)
                 actions_to_perform.extend(fallback_actions)
                 break # Fallback always breaks the loop
             
             # --- Step 3: Loop Control ---
             # If the new step is a question, or if the flow state was cleared (e.g., end_flow), break the loop.
-            new_state = ContactFlowState.objects.filter(contact=contact).first()
-            if not new_state or new_state.current_step.step_type in ['question', 'end_flow', 'human_handover']:
+            if not session.is_active or session.current_step.step_type in ['question', 'end_flow', 'human_handover']:
                 break
             
             # The message_data is "consumed" by the first step that uses it (the question step).
@@ -1345,7 +1203,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
     except Exception as e:
         logger.error(f"Critical error in process_message_for_flow for contact {contact.whatsapp_id}: {e}", exc_info=True)
         # Clear state on unhandled error to prevent loops and allow re-triggering or human intervention
-        _clear_contact_flow_state(contact, error=True)
+        session.clear(error=True)
         # Notify user of an issue
         actions_to_perform = [{ # Reset actions to only send an error message
             'type': 'send_whatsapp_message',
@@ -1359,11 +1217,13 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
     for action in actions_to_perform: # actions_to_perform could be modified by switch_flow
         if action.get('type') == '_internal_command_clear_flow_state':
             # Actually clear the state when the command is processed.
-            _clear_contact_flow_state(contact)
+            session.clear()
             logger.debug(f"Contact {contact.id}: Processed internal command to clear flow state.")
         elif action.get('type') == 'send_whatsapp_message': # Only pass valid message actions
             final_actions_for_meta_view.append(action)
         else:
             logger.warning(f"Unhandled action type in final processing: {action.get('type')}")
-            
+
+    # The single write of this message's flow state (INSERT, UPDATE or DELETE, or nothing if unchanged).
+    session.commit()
     return final_actions_for_meta_view
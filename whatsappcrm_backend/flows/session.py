@@ -0,0 +1,140 @@
+# whatsappcrm_backend/flows/session.py
+
+import copy
+import logging
+from typing import Optional
+
+from django.utils import timezone
+
+from conversations.models import Contact
+from .graph import get_compiled_flow, flow_graph_cache
+from .models import Flow, FlowStep, ContactFlowState
+
+logger = logging.getLogger(__name__)
+
+
+class FlowStateSession:
+    """
+    A contact's flow state for the duration of one incoming message.
+
+    The ContactFlowState row is read (and locked) once by `load()`. Steps, switches and context
+    changes are then applied in memory, and `commit()` writes the result back with a single
+    INSERT, UPDATE or DELETE — or nothing at all if the state didn't change.
+    Must be used inside a transaction so the row lock is held until the message is processed.
+    """
+    def __init__(self, contact: Contact):
+        self.contact = contact
+        self.state: Optional[ContactFlowState] = None
+        self._persisted: Optional[ContactFlowState] = None # The row as it exists in the database, if any
+        self._snapshot = None
+        self._cleared_with_error = False
+
+    # --- Reading ---
+
+    def load(self) -> Optional[ContactFlowState]:
+        """
+        Fetches and locks the contact's flow state, wiring its current_step to the instance
+        held by the compiled flow graph so graph walks don't hit the database.
+        """
+        state = (
+            ContactFlowState.objects.select_for_update(of=('self',))
+            .select_related('current_flow')
+            .filter(contact=self.contact)
+            .first()
+        )
+        self.state = self._persisted = state
+        if state is None:
+            return None
+
+        graph = get_compiled_flow(state.current_flow)
+        current_step = graph.get_step(state.current_step_id)
+        if current_step is None:
+            # The graph is older than the state row (e.g. a step was added in another process). Rebuild once.
+            flow_graph_cache.invalidate(state.current_flow_id)
+            current_step = get_compiled_flow(state.current_flow).get_step(state.current_step_id)
+        if current_step is not None:
+            state.current_step = current_step
+        if state.flow_context_data is None:
+            state.flow_context_data = {}
+        self._snapshot = self._take_snapshot(state)
+        return state
+
+    @property
+    def is_active(self) -> bool:
+        return self.state is not None
+
+    @property
+    def current_flow(self) -> Optional[Flow]:
+        return self.state.current_flow if self.state else None
+
+    @property
+    def current_step(self) -> Optional[FlowStep]:
+        return self.state.current_step if self.state else None
+
+    @property
+    def context(self) -> dict:
+        return self.state.flow_context_data if self.state else {}
+
+    # --- In-memory changes ---
+
+    def start(self, flow: Flow, entry_step: FlowStep, initial_context: Optional[dict] = None) -> ContactFlowState:
+        """Puts the contact at the entry step of a flow, replacing any current state."""
+        state = self._persisted or ContactFlowState(contact=self.contact)
+        state.current_flow = flow
+        state.current_step = entry_step
+        state.flow_context_data = initial_context or {}
+        state.started_at = timezone.now()
+        self.state = state
+        return state
+
+    def move_to(self, step: FlowStep) -> None:
+        self.state.current_step = step
+
+    def set_context(self, flow_context: dict) -> None:
+        self.state.flow_context_data = flow_context
+
+    def clear(self, error: bool = False) -> None:
+        if self.state is not None or self._persisted is not None:
+            self._cleared_with_error = self._cleared_with_error or error
+        self.state = None
+
+    # --- Writing ---
+
+    def commit(self) -> None:
+        """Writes the in-memory state back to the database with at most one statement."""
+        persisted, state = self._persisted, self.state
+
+        if state is None:
+            if persisted is not None and persisted.pk:
+                ContactFlowState.objects.filter(pk=persisted.pk).delete()
+                logger.info(f"Contact {self.contact.id}: Cleared flow state ({self.contact.whatsapp_id})." + (" Due to an error." if self._cleared_with_error else ""))
+            self._persisted = None
+        elif state.pk is None:
+            state.save(force_insert=True)
+            self._persisted = state
+        else:
+            changed_fields = self._changed_fields(state)
+            if changed_fields:
+                state.save(update_fields=changed_fields + ['last_updated_at'])
+                logger.debug(f"Contact {self.contact.id}: Saved flow state ({', '.join(changed_fields)}).")
+
+        self._snapshot = self._take_snapshot(self._persisted)
+        self._cleared_with_error = False
+
+    @staticmethod
+    def _take_snapshot(state: Optional[ContactFlowState]):
+        if state is None:
+            return None
+        return {
+            'current_flow_id': state.current_flow_id,
+            'current_step_id': state.current_step_id,
+            'flow_context_data': copy.deepcopy(state.flow_context_data),
+            'started_at': state.started_at,
+        }
+
+    def _changed_fields(self, state: ContactFlowState) -> list:
+        snapshot = self._snapshot or {}
+        return [
+            field_name for field_name in ('current_flow_id', 'current_step_id', 'flow_context_data', 'started_at')
+            if getattr(state, field_name) != snapshot.get(field_name)
+        ]
@@ -0,0 +1,63 @@
+# whatsappcrm_backend/flows/signals.py
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Flow, FlowStep, FlowTransition
+from .graph import flow_graph_cache
+from .triggers import invalidate_trigger_index
+from . import query_cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _touch_flow(flow_id):
+    """
+    Drops the local compiled graph and bumps Flow.updated_at so that every other process
+    sees a new graph version on its next lookup. `update()` does not fire Flow signals.
+    """
+    if not flow_id:
+        return
+    flow_graph_cache.invalidate(flow_id)
+    Flow.objects.filter(pk=flow_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Flow)
+@receiver(post_delete, sender=Flow)
+def on_flow_change_invalidate_graph(sender, instance, **kwargs):
+    flow_graph_cache.invalidate(instance.pk)
+    invalidate_trigger_index()
+    logger.debug(f"Flow {instance.pk} changed: invalidated compiled graph and trigger index.")
+
+
+@receiver(post_save, sender=FlowStep)
+@receiver(post_delete, sender=FlowStep)
+def on_flow_step_change_invalidate_graph(sender, instance, **kwargs):
+    _touch_flow(instance.flow_id)
+
+
+@receiver(post_save, sender=FlowTransition)
+@receiver(post_delete, sender=FlowTransition)
+def on_flow_transition_change_invalidate_graph(sender, instance, **kwargs):
+    try:
+        flow_id = FlowStep.objects.filter(pk=instance.current_step_id).values_list('flow_id', flat=True).first()
+    except Exception as e:
+        logger.warning(f"Could not resolve flow for transition {instance.pk}: {e}. Invalidating all compiled graphs.")
+        flow_graph_cache.invalidate()
+        return
+    if flow_id is None:
+        flow_graph_cache.invalidate()
+        return
+    _touch_flow(flow_id)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def on_cacheable_model_change_invalidate_query_cache(sender, **kwargs):
+    """
+    Invalidates cached `query_model` results when a row of a cacheable model changes.
+    Queryset.update()/bulk operations don't send signals; the entries' TTL bounds staleness there.
+    """
+    if sender._meta.label_lower in query_cache.cacheable_models():
+        query_cache.bump_generation(sender)
@@ -0,0 +1,120 @@
+# whatsappcrm_backend/flows/step_configs.py
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel, ValidationError
+
+from .schemas import (
+    StepConfigSendMessage,
+    StepConfigQuestion,
+    StepConfigAction,
+    StepConfigHumanHandover,
+    StepConfigEndFlow,
+    StepConfigSwitchFlow,
+    FallbackConfig,
+)
+
+logger = logging.getLogger(__name__)
+
+STEP_CONFIG_SCHEMAS = {
+    'send_message': StepConfigSendMessage,
+    'question': StepConfigQuestion,
+    'action': StepConfigAction,
+    'human_handover': StepConfigHumanHandover,
+    'end_flow': StepConfigEndFlow,
+    'switch_flow': StepConfigSwitchFlow,
+}
+
+# Message types whose payload is sent as a dumped dict (resolved through Jinja at runtime).
+_DUMPED_PAYLOAD_TYPES = ('interactive', 'template', 'contacts', 'location')
+
+
+@dataclass(frozen=True)
+class ParsedMessage:
+    """A validated send_message config plus its payload dumped once, ready for template resolution."""
+    config: StepConfigSendMessage
+    payload: Any = None
+
+
+@dataclass(frozen=True)
+class ParsedStepConfig:
+    """
+    The validated form of a FlowStep.config. Built once per compiled flow version so that executing
+    a step never re-runs pydantic validation. Validation errors are kept and reported at execution time,
+    exactly as they were when the config was validated on every run.
+    """
+    step_type: str
+    config: Optional[BaseModel] = None
+    error: Optional[ValidationError] = None
+    # The message sent by send_message steps, the prompt of question steps and the final message of end_flow steps.
+    message: Optional[ParsedMessage] = None
+    message_error: Optional[ValidationError] = None
+    fallback: Optional[FallbackConfig] = None
+    fallback_error: Optional[ValidationError] = None
+    after_retries: Optional['ParsedStepConfig'] = None
+
+    @property
+    def is_valid(self) -> bool:
+        return self.error is None and self.message_error is None
+
+
+def _dump_message_payload(message_config: StepConfigSendMessage) -> Any:
+    message_type = message_config.message_type
+    if message_type not in _DUMPED_PAYLOAD_TYPES:
+        return None
+    payload = getattr(message_config, message_type, None)
+    if not payload:
+        return None
+    if message_type == 'contacts':
+        return [c.model_dump(exclude_none=True, by_alias=True) for c in payload]
+    return payload.model_dump(exclude_none=True, by_alias=True)
+
+
+def parse_message_config(raw_message_config: Dict[str, Any]) -> ParsedMessage:
+    """Validates a send_message config. Raises pydantic.ValidationError if it is invalid."""
+    message_config = StepConfigSendMessage.model_validate(raw_message_config)
+    return ParsedMessage(config=message_config, payload=_dump_message_payload(message_config))
+
+
+def parse_step_config(step_type: str, raw_config: Any) -> ParsedStepConfig:
+    """Validates a step's config against the schema for its step_type. Never raises."""
+    raw_config = raw_config or {}
+    config = error = message = message_error = None
+
+    schema = STEP_CONFIG_SCHEMAS.get(step_type)
+    if schema is not None:
+        try:
+            config = schema.model_validate(raw_config)
+        except ValidationError as e:
+            error = e
+
+    if step_type == 'send_message' and config is not None:
+        message = ParsedMessage(config=config, payload=_dump_message_payload(config))
+    elif step_type in ('question', 'end_flow') and config is not None and config.message_config:
+        try:
+            message = parse_message_config(config.message_config)
+        except ValidationError as e:
+            message_error = e
+
+    fallback = fallback_error = after_retries = None
+    if step_type == 'question':
+        try:
+            fallback = FallbackConfig.model_validate(raw_config.get('fallback_config', {}) if isinstance(raw_config, dict) else {})
+        except ValidationError as e:
+            fallback_error = e
+            fallback = FallbackConfig()
+        if fallback.action_after_retries:
+            after_retries = parse_step_config(fallback.action_after_retries, fallback.config_after_retries or {})
+
+    return ParsedStepConfig(
+        step_type=step_type,
+        config=config,
+        error=error,
+        message=message,
+        message_error=message_error,
+        fallback=fallback,
+        fallback_error=fallback_error,
+        after_retries=after_retries,
+    )
@@ -2,18 +2,22 @@
 import logging
 from celery import shared_task
 from django.db import transaction
+from django.utils import timezone
 
 from conversations.models import Message, Contact
 from meta_integration.models import MetaAppConfig
-from meta_integration.tasks import send_whatsapp_message_task
+from conversations.last_seen import record_last_seen
+from meta_integration.payload_store import store_payloads
+from meta_integration.sequencer import dispatch_outgoing_messages
+from media_manager.link_cache import use_cached_media_id
 from .services import process_message_for_flow
+from .dispatch import ContactProcessingLock, ack_pending_message, has_pending_messages, peek_pending_message
 
 logger = logging.getLogger(__name__)
 
-@shared_task(queue='celery') # Use your main I/O queue
-def process_flow_for_message_task(message_id: int):
+def _process_flow_for_message(message_id: int):
     """
-    This task asynchronously runs the entire flow engine for an incoming message.
+    Runs the entire flow engine for an incoming message and dispatches the resulting messages.
     """
     try:
         # Use a transaction to ensure atomicity of reading state and taking action
@@ -31,26 +35,99 @@ def process_flow_for_message_task(message_id: int):
 
             active_config = MetaAppConfig.objects.get_active_config()
 
-            # Process the actions returned by the flow engine
-            dispatch_countdown = 0
+            # Build all outgoing messages for this engine run and insert them in one query.
+            # bulk_create() skips Message.save(), so text_content is populated explicitly and
+            # each recipient's last_seen is updated once below. The post_save broadcast to the
+            # conversation UI happens when the send task saves each message's status.
+            outgoing_messages = []
+            recipients = {contact.whatsapp_id: contact}
             for action in actions_to_perform:
                 if action.get('type') == 'send_whatsapp_message':
                     recipient_wa_id = action.get('recipient_wa_id', contact.whatsapp_id)
-                    
-                    if recipient_wa_id == contact.whatsapp_id:
-                        recipient_contact = contact
-                    else:
+                    recipient_contact = recipients.get(recipient_wa_id)
+                    if recipient_contact is None:
                         recipient_contact, _ = Contact.objects.get_or_create(whatsapp_id=recipient_wa_id)
+                        recipients[recipient_wa_id] = recipient_contact
 
-                    outgoing_msg = Message.objects.create(
+                    # Media sent by a fixed link goes out by its uploaded media ID once it has been cached.
+                    data = action.get('data')
+                    if action.get('cacheable_link'):
+                        data = use_cached_media_id(action.get('message_type'), data, active_config)
+                    outgoing_msg = Message(
                         contact=recipient_contact, app_config=active_config, direction='out',
-                        message_type=action.get('message_type'), content_payload=action.get('data'),
-                        status='pending_dispatch', related_incoming_message=incoming_message
+                        message_type=action.get('message_type'), content_payload=data,
+                        status='pending_dispatch', related_incoming_message=incoming_message,
+                        timestamp=timezone.now()
                     )
-                    send_whatsapp_message_task.apply_async(args=[outgoing_msg.id, active_config.id], countdown=dispatch_countdown)
-                    dispatch_countdown += 2 # Stagger subsequent messages by 2 seconds
+                    outgoing_msg.populate_text_content()
+                    outgoing_messages.append(outgoing_msg)
+
+            if not outgoing_messages:
+                return
+            store_payloads(outgoing_messages)
+            Message.objects.bulk_create(outgoing_messages)
+
+            # One ordered send sequence per recipient (usually just the contact, plus e.g. an admin notification).
+            sequences = {}
+            for outgoing_msg in outgoing_messages:
+                sequences.setdefault(outgoing_msg.contact_id, []).append(outgoing_msg.id)
+            record_last_seen({contact_id: outgoing_messages[-1].timestamp for contact_id in sequences})
+
+            for contact_id, message_ids in sequences.items():
+                dispatch_outgoing_messages(contact_id, message_ids, active_config.id)
 
     except Message.DoesNotExist:
         logger.error(f"process_flow_for_message_task: Message with ID {message_id} not found.")
     except Exception as e:
-        logger.error(f"Critical error in process_flow_for_message_task for message {message_id}: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"Critical error in process_flow_for_message_task for message {message_id}: {e}", exc_info=True)
+
+
+@shared_task(queue='celery') # Use your main I/O queue
+def process_flow_for_message_task(message_id: int):
+    """
+    This task asynchronously runs the entire flow engine for an incoming message.
+    """
+    _process_flow_for_message(message_id)
+
+
+@shared_task(queue='celery')
+def drain_contact_flow_queue_task(contact_id: int):
+    """
+    Processes a contact's pending incoming messages in arrival order (partitioned dispatch mode).
+    Only the worker holding the contact's lock drains the list; other drain tasks for the same
+    contact return immediately, since their message will be picked up by the lock holder. If the
+    holder dies, its lock expires and `sweep_flow_queues_task` (beat) restarts the drain.
+    """
+    lock = ContactProcessingLock(contact_id)
+    if not lock.acquire():
+        logger.debug(f"Contact {contact_id} is already being processed by another worker. Its pending messages will be drained there.")
+        return
+
+    processed = 0
+    try:
+        while True:
+            message_id = peek_pending_message(contact_id)
+            if message_id is None:
+                break
+            _process_flow_for_message(message_id)
+            # Removed only once processed: a worker dying mid-message leaves it for the next drain.
+            ack_pending_message(contact_id)
+            processed += 1
+            if not lock.refresh():
+                logger.warning(f"Lost the processing lock for contact {contact_id} after {processed} message(s). Stopping this drain.")
+                return
+    finally:
+        lock.release()
+
+    # A message may have been queued after our last pop but before the lock was released;
+    # its own drain task saw the lock held and returned, so pick it up here.
+    if has_pending_messages(contact_id):
+        drain_contact_flow_queue_task.delay(contact_id)
+    logger.debug(f"Drained {processed} pending message(s) for contact {contact_id}.")
+
+
+@shared_task(queue='celery')
+def sweep_flow_queues_task():
+    """Restarts contact flow queues whose drain died with its worker. Scheduled every minute (CELERY_BEAT_SCHEDULE)."""
+    from .dispatch import sweep_flow_queues
+    return sweep_flow_queues()
@@ -1,3 +1,382 @@
-from django.test import TestCase
+import json
+import random
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from conversations.models import Contact
+from . import query_cache
+from .conditions import InboundEvent, compile_condition
+from .metrics import MessageMetrics, measure_step
+from .graph import compile_flow, get_compiled_flow
+from .models import ContactFlowState, Flow, FlowStep, FlowTransition
+from .services import _resolve_value, get_compiled_template, jinja_env
+from .session import FlowStateSession
+from .step_configs import parse_step_config
+from .triggers import KeywordAutomaton, TriggerIndex
+
+
+def _text(body):
+    return {'type': 'text', 'text': {'body': body}}
+
+
+def _button(reply_id):
+    return {'type': 'interactive', 'interactive': {'type': 'button_reply', 'button_reply': {'id': reply_id, 'title': 'x'}}}
+
+
+def _nfm(data):
+    return {'type': 'interactive', 'interactive': {'type': 'nfm_reply', 'nfm_reply': {'response_json': json.dumps(data)}}}
+
+
+class CompiledConditionTests(SimpleTestCase):
+    """
+    Each case is (condition_config, message_data, flow_context, expected), where `expected` is what the
+    per-message `_evaluate_transition_condition` the compiled predicates replaced returned for it.
+    """
+    contact = SimpleNamespace(id=1, name='Rudo', whatsapp_id='263770000001')
+
+    CASES = [
+        ({'type': 'always_true'}, _text('anything'), {}, True),
+        ({}, _text('anything'), {}, False),
+        ({'type': 'no_such_condition'}, _text('anything'), {}, False),
+        ({'type': 'user_reply_matches_keyword', 'keyword': ' Yes '}, _text('  yes '), {}, True),
+        ({'type': 'user_reply_matches_keyword', 'keyword': 'Yes', 'case_sensitive': True}, _text('yes'), {}, False),
+        ({'type': 'user_reply_matches_keyword', 'keyword': ''}, _text(''), {}, False),
+        ({'type': 'user_reply_contains_keyword', 'keyword': 'price'}, _text('What is the PRICE?'), {}, True),
+        ({'type': 'user_reply_contains_keyword', 'keyword': 'price'}, _button('price'), {}, False),
+        ({'type': 'interactive_reply_id_equals', 'value': 'buy'}, _button('buy'), {}, True),
+        ({'type': 'interactive_reply_id_equals', 'value': 'buy'}, _text('buy'), {}, False),
+        ({'type': 'message_type_is', 'value': 'image'}, {'type': 'image', 'image': {'id': 'm1'}}, {}, True),
+        ({'type': 'message_type_is', 'value': 'image'}, _text('hi'), {}, False),
+        ({'type': 'user_reply_matches_regex', 'regex': r'^\d{4}$'}, _text('2024'), {}, True),
+        ({'type': 'user_reply_matches_regex', 'regex': r'^\d{4}$'}, _text('abc'), {}, False),
+        ({'type': 'user_reply_matches_regex', 'regex': '('}, _text('('), {}, False),
+        ({'type': 'variable_equals', 'variable_name': 'qty', 'value': '2'}, _text(''), {'qty': 2}, True),
+        ({'type': 'variable_equals', 'variable_name': 'flow_context.order.qty', 'value': 3}, _text(''), {'order': {'qty': 2}}, False),
+        ({'type': 'variable_equals', 'variable_name': 'contact.name', 'value': 'Rudo'}, _text(''), {}, True),
+        ({'type': 'variable_exists', 'variable_name': 'email'}, _text(''), {'email': 'a@b.c'}, True),
+        ({'type': 'variable_exists', 'variable_name': 'email'}, _text(''), {}, False),
+        ({'type': 'variable_exists', 'variable_name': 'items.{{ index }}'}, _text(''), {'items': ['a', 'b'], 'index': 1}, True),
+        ({'type': 'variable_exists', 'variable_name': 'items.{{ index }}'}, _text(''), {'items': ['a'], 'index': 3}, False),
+        ({'type': 'variable_contains', 'variable_name': 'tags', 'value': 'vip'}, _text(''), {'tags': ['new', 'vip']}, True),
+        ({'type': 'variable_contains', 'variable_name': 'note', 'value': 'urgent'}, _text(''), {'note': 'not urgent'}, True),
+        ({'type': 'variable_contains', 'variable_name': 'count', 'value': '1'}, _text(''), {'count': 10}, False),
+        ({'type': 'nfm_response_field_equals', 'field_path': 'form.size', 'value': 'L'}, _nfm({'form': {'size': 'L'}}), {}, True),
+        ({'type': 'nfm_response_field_equals', 'field_path': 'form.size', 'value': 'L'}, _text('L'), {}, False),
+        ({'type': 'question_reply_is_valid', 'value': True}, _text(''), {'_question_awaiting_reply_for': {'variable_name': 'age'}, 'age': 30}, True),
+        ({'type': 'question_reply_is_valid', 'value': False}, _text(''), {'_question_awaiting_reply_for': {'variable_name': 'age'}, 'age': 30}, False),
+        ({'type': 'question_reply_is_valid', 'value': True}, _text(''), {}, False),
+        ({'type': 'user_requests_human'}, _text('I need an AGENT please'), {}, True),
+        ({'type': 'user_requests_human', 'keywords': ['manager']}, _text('I need an agent'), {}, False),
+        ({'type': 'user_requests_human', 'keywords': 'agent'}, _text('agent'), {}, False),
+    ]
+
+    def test_compiled_conditions_match_the_per_message_evaluation(self):
+        for transition_id, (config, message_data, flow_context, expected) in enumerate(self.CASES, start=1):
+            with self.subTest(config=config, message=message_data):
+                predicate = compile_condition(SimpleNamespace(id=transition_id, condition_config=config))
+                self.assertIs(predicate(InboundEvent(message_data), flow_context, self.contact), expected)
+
+    def test_invalid_config_never_matches(self):
+        predicate = compile_condition(SimpleNamespace(id=1, condition_config=['always_true']))
+        self.assertFalse(predicate(InboundEvent(_text('hi')), {}, self.contact))
+
+
+class FlowStateSessionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.contact = Contact.objects.create(whatsapp_id='263770000002', name='Tafadzwa')
+        cls.flow = Flow.objects.create(name='session_test_flow', is_active=True)
+        cls.first_step = FlowStep.objects.create(flow=cls.flow, name='first', step_type='human_handover', is_entry_point=True)
+        cls.second_step = FlowStep.objects.create(flow=cls.flow, name='second', step_type='end_flow')
+
+    def _create_state(self, context=None):
+        return ContactFlowState.objects.create(
+            contact=self.contact, current_flow=self.flow, current_step=self.first_step, flow_context_data=context or {}
+        )
+
+    def _commit(self, session):
+        """Commits the session and returns the write statements it ran against the flow state table."""
+        with CaptureQueriesContext(connection) as queries:
+            session.commit()
+        table = ContactFlowState._meta.db_table
+        return [
+            query['sql'] for query in queries.captured_queries
+            if table in query['sql'] and query['sql'].lstrip().split(' ', 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE')
+        ]
+
+    def test_unchanged_state_is_not_written(self):
+        self._create_state({'answer': 'yes'})
+        session = FlowStateSession(self.contact)
+        session.load()
+        session.set_context(dict(session.context)) # Equal content, new object
+        self.assertEqual(self._commit(session), [])
+
+    def test_changes_are_written_with_one_update(self):
+        self._create_state()
+        session = FlowStateSession(self.contact)
+        session.load()
+        session.move_to(self.second_step)
+        session.set_context({'answer': 'no'})
+        writes = self._commit(session)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].lstrip().upper().startswith('UPDATE'))
+        state = ContactFlowState.objects.get(contact=self.contact)
+        self.assertEqual(state.current_step_id, self.second_step.pk)
+        self.assertEqual(state.flow_context_data, {'answer': 'no'})
+
+    def test_context_mutated_in_place_is_written(self):
+        self._create_state({'items': []})
+        session = FlowStateSession(self.contact)
+        session.load()
+        session.context['items'].append('x')
+        self.assertEqual(len(self._commit(session)), 1)
+        self.assertEqual(ContactFlowState.objects.get(contact=self.contact).flow_context_data, {'items': ['x']})
+
+    def test_new_state_is_written_with_one_insert(self):
+        session = FlowStateSession(self.contact)
+        self.assertIsNone(session.load())
+        session.start(self.flow, self.first_step, {'source': 'test'})
+        writes = self._commit(session)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].lstrip().upper().startswith('INSERT'))
+        # A second commit without changes writes nothing.
+        self.assertEqual(self._commit(session), [])
+
+    def test_cleared_state_is_written_with_one_delete(self):
+        self._create_state()
+        session = FlowStateSession(self.contact)
+        session.load()
+        session.clear()
+        writes = self._commit(session)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].lstrip().upper().startswith('DELETE'))
+        self.assertFalse(ContactFlowState.objects.filter(contact=self.contact).exists())
+
+    def test_state_started_and_cleared_in_one_message_is_not_written(self):
+        session = FlowStateSession(self.contact)
+        session.load()
+        session.start(self.flow, self.first_step)
+        session.clear()
+        self.assertEqual(self._commit(session), [])
+
+
+class TriggerIndexTests(SimpleTestCase):
+    def _flow(self, name, keywords, trigger_config=None):
+        return SimpleNamespace(name=name, trigger_keywords=keywords, trigger_config=trigger_config or {})
+
+    @staticmethod
+    def _scan(flows, text):
+        """The per-message scan the index replaced: flows in name order, keywords in list order."""
+        for flow in flows:
+            for keyword in flow.trigger_keywords:
+                if isinstance(keyword, str) and keyword.strip().lower() in text.lower():
+                    return flow, keyword
+        return None
+
+    def test_automaton_finds_overlapping_patterns(self):
+        automaton = KeywordAutomaton([('he', 1), ('she', 2), ('his', 3), ('hers', 4)])
+        self.assertEqual(sorted(automaton.iter_matches('ushers')), [1, 2, 4])
+
+    def test_first_flow_and_keyword_win(self):
+        flows = [self._flow('a_orders', ['track order', 'order']), self._flow('b_sales', ['buy', 'order now'])]
+        index = TriggerIndex(flows)
+        match = index.match('I want to ORDER NOW please')
+        self.assertIs(match.flow, flows[0])
+        self.assertEqual(match.keyword, 'order')
+        self.assertEqual(index.match('can I buy?').keyword, 'buy')
+        self.assertIsNone(index.match('hello'))
+
+    def test_matches_the_per_message_scan(self):
+        rng = random.Random(7)
+        vocabulary = ['hi', 'hello', 'price', 'pr', 'ice', 'menu', 'help', 'el', 'order', ' Order ', 'HI there']
+        for _ in range(200):
+            flows = [self._flow(f"flow_{i}", rng.sample(vocabulary, rng.randint(1, 3))) for i in range(rng.randint(1, 4))]
+            text = ' '.join(rng.choice(vocabulary + ['xyz', 'thanks']) for _ in range(rng.randint(1, 4)))
+            expected = self._scan(flows, text)
+            match = TriggerIndex(flows).match(text)
+            with self.subTest(flows=[flow.trigger_keywords for flow in flows], text=text):
+                if expected is None:
+                    self.assertIsNone(match)
+                else:
+                    self.assertEqual((match.flow, match.keyword), expected)
+
+    def test_extraction_regex_fills_the_initial_context(self):
+        flow = self._flow('quote', ['quote'], {'extraction_regex': r'quote for (\w+)', 'context_variable': 'product'})
+        self.assertEqual(TriggerIndex([flow]).match('Quote for Solar please').initial_context, {})
+        self.assertEqual(TriggerIndex([flow]).match('quote for solar').initial_context, {'product': 'solar'})
+
+
+class TemplateRenderingTests(SimpleTestCase):
+    contact = SimpleNamespace(id=1, name='Rudo', whatsapp_id='263770000001')
+
+    def test_plain_strings_render_like_jinja(self):
+        for value in ['Hello', '', 'Line one\nLine two\n', 'ends with two newlines\n\n', 'price: $5 {not jinja}', 'Windows\r\n', 'Mhoro ✓']:
+            with self.subTest(value=value):
+                self.assertEqual(_resolve_value(value, {}, self.contact), jinja_env.from_string(value).render())
+
+    def test_templates_are_rendered_with_context_and_contact(self):
+        value = {'body': 'Hi {{ contact.name }}, your order {{ order_id }}', 'rows': ['{{ order_id }}', 3]}
+        self.assertEqual(
+            _resolve_value(value, {'order_id': 'A1'}, self.contact),
+            {'body': 'Hi Rudo, your order A1', 'rows': ['A1', 3]},
+        )
+
+    def test_compiled_templates_are_reused(self):
+        source = 'Cached {{ value }} template'
+        template = get_compiled_template(source)
+        self.assertIs(get_compiled_template(source), template)
+        self.assertEqual(template.render(value=1), 'Cached 1 template')
+
+
+class StepConfigParsingTests(SimpleTestCase):
+    text_message = {'message_type': 'text', 'text': {'body': 'Hi'}}
+    reply_config = {'save_to_variable': 'answer'}
+
+    def test_valid_send_message(self):
+        parsed = parse_step_config('send_message', self.text_message)
+        self.assertTrue(parsed.is_valid)
+        self.assertEqual(parsed.message.config.text.body, 'Hi')
+
+    def test_invalid_config_is_kept_rather_than_raised(self):
+        parsed = parse_step_config('send_message', {'message_type': 'fax'})
+        self.assertFalse(parsed.is_valid)
+        self.assertIsNotNone(parsed.error)
+        self.assertIsNone(parsed.message)
+
+    def test_question_prompt_is_validated_as_a_message(self):
+        parsed = parse_step_config('question', {'message_config': {'message_type': 'fax'}, 'reply_config': self.reply_config})
+        self.assertIsNone(parsed.error)
+        self.assertIsNotNone(parsed.message_error)
+        self.assertFalse(parsed.is_valid)
+
+    def test_invalid_fallback_falls_back_to_the_defaults(self):
+        parsed = parse_step_config('question', {
+            'message_config': self.text_message, 'reply_config': self.reply_config, 'fallback_config': {'max_retries': -1},
+        })
+        self.assertTrue(parsed.is_valid)
+        self.assertIsNotNone(parsed.fallback_error)
+        self.assertEqual(parsed.fallback.max_retries, 2)
+
+    def test_action_after_retries_is_parsed_up_front(self):
+        parsed = parse_step_config('question', {
+            'message_config': self.text_message, 'reply_config': self.reply_config,
+            'fallback_config': {'action_after_retries': 'end_flow', 'config_after_retries': {'message_config': self.text_message}},
+        })
+        self.assertEqual(parsed.after_retries.step_type, 'end_flow')
+        self.assertTrue(parsed.after_retries.is_valid)
+        self.assertEqual(parsed.after_retries.message.config.text.body, 'Hi')
+
+
+class CompiledFlowTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.flow = Flow.objects.create(name='graph_test_flow', is_active=True)
+        message = {'message_type': 'text', 'text': {'body': 'Hi'}}
+        cls.start = FlowStep.objects.create(flow=cls.flow, name='start', step_type='send_message', config=message, is_entry_point=True)
+        cls.yes = FlowStep.objects.create(flow=cls.flow, name='yes', step_type='end_flow')
+        cls.other = FlowStep.objects.create(flow=cls.flow, name='other', step_type='end_flow')
+        cls.fallback_transition = FlowTransition.objects.create(
+            current_step=cls.start, next_step=cls.other, condition_config={'type': 'always_true'}, priority=2
+        )
+        cls.yes_transition = FlowTransition.objects.create(
+            current_step=cls.start, next_step=cls.yes, condition_config={'type': 'user_reply_matches_keyword', 'keyword': 'yes'}, priority=1
+        )
+
+    def test_graph_is_walked_without_queries(self):
+        with self.assertNumQueries(2):
+            graph = compile_flow(self.flow)
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.entry_point.pk, self.start.pk)
+            transitions = graph.transitions_from(self.start.pk)
+            self.assertEqual([t.pk for t in transitions], [self.yes_transition.pk, self.fallback_transition.pk])
+            self.assertEqual([t.next_step.flow.name for t in transitions], ['graph_test_flow'] * 2)
+            self.assertTrue(graph.get_step_config(self.start.pk).is_valid)
+            self.assertTrue(graph.get_condition(self.yes_transition.pk)(InboundEvent(_text('Yes')), {}, None))
+            self.assertEqual(graph.transitions_from(self.yes.pk), ())
+
+    def test_cached_graph_is_reused_until_the_flow_changes(self):
+        flow = Flow.objects.get(pk=self.flow.pk)
+        graph = get_compiled_flow(flow)
+        with self.assertNumQueries(0):
+            self.assertIs(get_compiled_flow(flow), graph)
+        # An edit made by another process only shows up as a newer updated_at on the row.
+        Flow.objects.filter(pk=flow.pk).update(updated_at=flow.updated_at + timedelta(seconds=1))
+        self.assertIsNot(get_compiled_flow(Flow.objects.get(pk=flow.pk)), graph)
+
+
+@override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'flows-tests-default'},
+        'flow-query-tests': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'flows-tests-query'},
+    },
+    FLOW_QUERY_CACHE_ALIAS='flow-query-tests',
+)
+class QueryModelCacheTests(SimpleTestCase):
+    model = SimpleNamespace(_meta=SimpleNamespace(label_lower='products_and_services.device'))
+
+    def setUp(self):
+        query_cache._cache().clear()
+
+    def _query(self, key_parts, result=('row',)):
+        run_query = mock.Mock(return_value=list(result))
+        return query_cache.get_or_query(self.model, 60, key_parts, run_query), run_query
+
+    def test_results_are_cached_per_query(self):
+        first, run_query = self._query({'filters': {'is_active': True}, 'limit': 5})
+        run_query.assert_called_once()
+        second, run_query = self._query({'limit': 5, 'filters': {'is_active': True}})
+        run_query.assert_not_called()
+        self.assertEqual(second, first)
+        _, run_query = self._query({'filters': {'is_active': False}, 'limit': 5})
+        run_query.assert_called_once()
+
+    def test_model_change_invalidates_its_results(self):
+        self._query({'limit': 5})
+        query_cache.bump_generation(self.model)
+        result, run_query = self._query({'limit': 5}, result=('fresh',))
+        run_query.assert_called_once()
+        self.assertEqual(result, ['fresh'])
+
+    def test_cache_errors_fall_back_to_the_query(self):
+        with mock.patch.object(query_cache, '_cache', side_effect=ConnectionError('down')):
+            result, run_query = self._query({'limit': 5})
+        run_query.assert_called_once()
+        self.assertEqual(result, ['row'])
+
+    def test_only_configured_models_are_cacheable(self):
+        self.assertTrue(query_cache.is_cacheable(self.model))
+        self.assertFalse(query_cache.is_cacheable(SimpleNamespace(_meta=SimpleNamespace(label_lower='conversations.contact'))))
+
+
+class FlowQueryBudgetTests(TestCase):
+    def _run(self, queries):
+        with MessageMetrics(contact_id=1, message_id=2) as metrics:
+            metrics.set_flow(SimpleNamespace(name='budget_flow'))
+            metrics.iteration()
+            with measure_step('action') as step_queries:
+                for _ in range(queries):
+                    Flow.objects.count()
+        return metrics, step_queries
+
+    @override_settings(FLOW_QUERY_BUDGET=2)
+    def test_queries_are_counted_per_message_and_step(self):
+        metrics, step_queries = self._run(2)
+        self.assertEqual(metrics.queries.count, 2)
+        self.assertEqual(step_queries.count, 2)
+        self.assertEqual(metrics.iterations, 1)
+
+    @override_settings(FLOW_QUERY_BUDGET=2)
+    def test_exceeding_the_budget_is_logged(self):
+        with self.assertLogs('flows.metrics', level='WARNING') as logs:
+            self._run(3)
+        self.assertIn("'budget_flow': 3 queries (budget 2)", logs.output[0])
+
+    @override_settings(FLOW_QUERY_BUDGET=2)
+    def test_staying_within_the_budget_is_not_logged(self):
+        with self.assertNoLogs('flows.metrics', level='WARNING'):
+            self._run(2)
@@ -0,0 +1,165 @@
+# whatsappcrm_backend/flows/triggers.py
+
+import logging
+import re
+import threading
+from collections import deque
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from django.db.models import Count, Max
+
+from .models import Flow
+
+logger = logging.getLogger(__name__)
+
+
+class KeywordAutomaton:
+    """
+    A minimal Aho-Corasick automaton. Finds every occurrence of every pattern in a single pass
+    over the text, so matching cost doesn't grow with the number of flows and keywords.
+    """
+    def __init__(self, patterns: List[Tuple[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Any]] = [[]]
+
+        for pattern, payload in patterns:
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = next_state
+            self._out[state].append(payload)
+
+        # Breadth-first pass to compute failure links and merge outputs of suffix states.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def iter_matches(self, text: str) -> Iterator[Any]:
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                yield from out[state]
+
+
+class TriggerMatch(NamedTuple):
+    flow: Flow
+    keyword: str
+    initial_context: Dict[str, Any]
+
+
+class TriggerIndex:
+    """
+    All active flows' trigger keywords compiled into one automaton.
+    Priority follows the original scan: flows in name order, then keywords in list order.
+    """
+    def __init__(self, flows: List[Flow], version: Tuple[Any, Any] = None):
+        self.version = version
+        self._flows = flows
+        self._extractors: Dict[int, Tuple[Optional[re.Pattern], Optional[str], Optional[str]]] = {}
+        self._always_matching: List[Tuple[int, int, str]] = []
+        patterns = []
+
+        for flow_rank, flow in enumerate(flows):
+            if not isinstance(flow.trigger_keywords, list):
+                continue
+            for keyword_rank, keyword in enumerate(flow.trigger_keywords):
+                if not isinstance(keyword, str):
+                    logger.warning(f"Ignoring non-string trigger keyword {keyword!r} on flow '{flow.name}'.")
+                    continue
+                normalized = keyword.strip().lower()
+                if normalized:
+                    patterns.append((normalized, (flow_rank, keyword_rank, keyword)))
+                else:
+                    # An empty keyword is contained in every message, as with the original `in` check.
+                    self._always_matching.append((flow_rank, keyword_rank, keyword))
+
+            trigger_conf = flow.trigger_config or {}
+            extraction_regex = trigger_conf.get("extraction_regex")
+            context_var_name = trigger_conf.get("context_variable")
+            if extraction_regex and context_var_name:
+                try:
+                    self._extractors[flow_rank] = (re.compile(extraction_regex), context_var_name, None)
+                except re.error as e:
+                    self._extractors[flow_rank] = (None, context_var_name, str(e))
+
+        self._automaton = KeywordAutomaton(patterns)
+
+    def match(self, message_text_body: str) -> Optional[TriggerMatch]:
+        message_text_lower = message_text_body.lower()
+        best = min(self._always_matching, default=None)
+        for candidate in self._automaton.iter_matches(message_text_lower):
+            if best is None or candidate < best:
+                best = candidate
+        if best is None:
+            return None
+
+        flow_rank, _, keyword = best
+        flow = self._flows[flow_rank]
+        return TriggerMatch(flow=flow, keyword=keyword, initial_context=self._extract(flow_rank, flow, message_text_body))
+
+    def _extract(self, flow_rank: int, flow: Flow, message_text_body: str) -> Dict[str, Any]:
+        initial_context = {}
+        extractor = self._extractors.get(flow_rank)
+        if not extractor:
+            return initial_context
+        pattern, context_var_name, error = extractor
+        if error:
+            logger.error(f"Invalid extraction_regex for flow '{flow.name}': {error}")
+            return initial_context
+        match = pattern.search(message_text_body)
+        if match and match.groups():
+            extracted_data = match.group(1) # Use the first capturing group
+            if extracted_data is not None:
+                initial_context[context_var_name] = extracted_data.strip()
+                logger.info(f"Extracted '{extracted_data.strip()}' into '{context_var_name}' from trigger for flow '{flow.name}'.")
+        return initial_context
+
+
+_trigger_index: Optional[TriggerIndex] = None
+_trigger_index_lock = threading.Lock()
+
+
+def _current_flows_version() -> Tuple[Any, Any]:
+    # One cheap aggregate instead of loading every flow; changes whenever a flow is saved, created or deleted.
+    aggregate = Flow.objects.aggregate(latest=Max('updated_at'), total=Count('id'))
+    return aggregate['latest'], aggregate['total']
+
+
+def get_trigger_index() -> TriggerIndex:
+    """Returns the per-process trigger index, rebuilding it if any Flow changed since it was built."""
+    global _trigger_index
+    version = _current_flows_version()
+    index = _trigger_index
+    if index is not None and index.version == version:
+        return index
+
+    flows = list(Flow.objects.filter(is_active=True).order_by('name'))
+    index = TriggerIndex(flows, version=version)
+    with _trigger_index_lock:
+        _trigger_index = index
+    logger.debug(f"Rebuilt trigger keyword index over {len(flows)} active flows.")
+    return index
+
+
+def invalidate_trigger_index() -> None:
+    global _trigger_index
+    with _trigger_index_lock:
+        _trigger_index = None
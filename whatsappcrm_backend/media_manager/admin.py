@@ -1,7 +1,7 @@
 # media_manager/admin.py
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import MediaAsset
+from .models import MediaAsset, LinkedMediaCache
 
 @admin.action(description='Sync selected assets with WhatsApp')
 def sync_assets_with_whatsapp(modeladmin, request, queryset):
@@ -74,4 +74,17 @@ class MediaAssetAdmin(admin.ModelAdmin):
     status_display.short_description = "Current Status"
 
 
-admin.site.register(MediaAsset, MediaAssetAdmin)
\ No newline at end of file
+admin.site.register(MediaAsset, MediaAssetAdmin)
+
+
+class LinkedMediaCacheAdmin(admin.ModelAdmin):
+    list_display = ('url', 'media_type', 'phone_number_id', 'whatsapp_media_id', 'uploaded_to_whatsapp_at', 'validated_at')
+    list_filter = ('media_type', 'phone_number_id')
+    search_fields = ('url', 'whatsapp_media_id', 'content_hash')
+    readonly_fields = (
+        'url_hash', 'content_hash', 'mime_type', 'file_size', 'uploaded_to_whatsapp_at',
+        'etag', 'last_modified', 'validated_at', 'created_at', 'updated_at'
+    )
+
+
+admin.site.register(LinkedMediaCache, LinkedMediaCacheAdmin)
@@ -0,0 +1,212 @@
+# media_manager/link_cache.py
+"""
+Uploads files that flow steps send by `link` to WhatsApp once, and rewrites later sends of the
+same link to use the returned media ID. Meta then stops downloading the URL again for every
+recipient, which saves origin bandwidth and Meta's fetch time on large sends.
+
+A send whose link isn't cached yet (or whose media ID is expiring) still goes out by link, and
+schedules one background upload. Uploads are keyed by URL and phone number; files with the same
+content share a single media ID. Links to our own media files are read from storage, not over HTTP.
+
+The file behind a URL can change, so an entry is only used for MEDIA_LINK_CACHE_REVALIDATE_SECONDS
+after it was last validated. After that sends go out by link again until the background task has
+checked the URL: a conditional request (ETag / Last-Modified) or an unchanged content hash keeps the
+media ID, new content is uploaded. Only fixed links are cached (flows pass `cacheable_link`); a link
+built from a template can point at a different file for each contact.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+from datetime import timedelta
+from typing import NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from whatsappcrm_backend.redis_client import get_redis_client
+from .models import LinkedMediaCache
+from .utils import actual_upload_to_whatsapp_api
+
+logger = logging.getLogger(__name__)
+
+MEDIA_MESSAGE_TYPES = ('image', 'video', 'audio', 'document', 'sticker')
+UPLOAD_SCHEDULED_KEY = "media:link_upload:{phone_number_id}:{url_hash}"
+MAX_FILE_SIZE_BYTES = 100 * 1024 * 1024 # Same limit as MediaAsset.clean()
+
+
+def is_enabled() -> bool:
+    return getattr(settings, 'MEDIA_LINK_CACHE_ENABLED', False)
+
+
+def _revalidate_after() -> timedelta:
+    return timedelta(seconds=getattr(settings, 'MEDIA_LINK_CACHE_REVALIDATE_SECONDS', 3600))
+
+
+def _is_usable(entry: LinkedMediaCache) -> bool:
+    """True if the entry's media ID is not expiring and the link was checked recently enough."""
+    return (
+        not entry.is_whatsapp_id_potentially_expired()
+        and entry.validated_at is not None and entry.validated_at > timezone.now() - _revalidate_after()
+    )
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def use_cached_media_id(message_type: str, data: dict, config) -> dict:
+    """
+    Returns the media message `data` with its `link` replaced by the cached media ID when one is
+    available, not expiring and recently validated; otherwise returns `data` unchanged and schedules
+    the upload (or revalidation). Only for fixed links, see the module docstring.
+    """
+    if not is_enabled() or message_type not in MEDIA_MESSAGE_TYPES or not isinstance(data, dict):
+        return data
+    link = data.get('link')
+    if not link or data.get('id') or config is None:
+        return data
+
+    link_hash = url_hash(link)
+    entry = LinkedMediaCache.objects.filter(url_hash=link_hash, phone_number_id=config.phone_number_id).only(
+        'whatsapp_media_id', 'uploaded_to_whatsapp_at', 'validated_at'
+    ).first()
+    if entry is not None and _is_usable(entry):
+        rewritten = {key: value for key, value in data.items() if key != 'link'}
+        rewritten['id'] = entry.whatsapp_media_id
+        return rewritten
+
+    _schedule_upload(link, link_hash, message_type, config)
+    return data
+
+
+def _schedule_upload(link: str, link_hash: str, message_type: str, config) -> None:
+    from .tasks import cache_linked_media_task
+
+    try:
+        # One upload per link at a time, however many sends are waiting for it.
+        if not get_redis_client().set(
+            UPLOAD_SCHEDULED_KEY.format(phone_number_id=config.phone_number_id, url_hash=link_hash), 1, nx=True, ex=300
+        ):
+            return
+    except Exception as e:
+        logger.warning(f"Could not schedule upload of linked media {link}: {e}")
+        return
+    cache_linked_media_task.delay(link, message_type, config.id)
+
+
+def _local_media_path(url: str) -> Optional[str]:
+    """The storage name of a link to one of our own media files (BACKEND_DOMAIN_FOR_CSP + MEDIA_URL), else None."""
+    parsed = urlparse(url)
+    domain = getattr(settings, 'BACKEND_DOMAIN_FOR_CSP', None)
+    if not domain or parsed.netloc != domain or not parsed.path.startswith(settings.MEDIA_URL):
+        return None
+    return parsed.path[len(settings.MEDIA_URL):]
+
+
+def _copy(chunks, target) -> Tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+        if size > MAX_FILE_SIZE_BYTES:
+            raise ValueError(f"Linked media exceeds {MAX_FILE_SIZE_BYTES // (1024 * 1024)}MB.")
+        target.write(chunk)
+    return digest.hexdigest(), size
+
+
+class _Fetched(NamedTuple):
+    content_hash: str
+    mime_type: str
+    size: int
+    etag: str = ''
+    last_modified: str = ''
+
+
+def _fetch(url: str, target, cached: Optional[LinkedMediaCache] = None) -> Optional[_Fetched]:
+    """
+    Copies the file behind `url` into `target`. With a `cached` entry the request is conditional,
+    and None is returned if the server says the file hasn't changed since.
+    """
+    storage_name = _local_media_path(url)
+    etag, last_modified = '', ''
+    if storage_name and default_storage.exists(storage_name):
+        mime_type = mimetypes.guess_type(storage_name)[0]
+        with default_storage.open(storage_name, 'rb') as source:
+            content_hash, size = _copy(iter(lambda: source.read(1024 * 1024), b''), target)
+    else:
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        with requests.get(url, headers=headers, stream=True, timeout=(5, 60)) as response:
+            if headers and response.status_code == 304:
+                return None
+            response.raise_for_status()
+            mime_type = (response.headers.get('Content-Type') or '').split(';')[0].strip()
+            etag, last_modified = response.headers.get('ETag', ''), response.headers.get('Last-Modified', '')
+            content_hash, size = _copy(response.iter_content(chunk_size=1024 * 1024), target)
+    mime_type = mime_type or mimetypes.guess_type(urlparse(url).path)[0] or 'application/octet-stream'
+    return _Fetched(content_hash, mime_type, size, etag[:255], last_modified[:64])
+
+
+def cache_linked_media(url: str, media_type: str, config) -> Optional[str]:
+    """
+    Uploads the file behind `url` for the config's phone number, unless a fresh upload of the same
+    content exists, and records the media ID for the link. Returns the media ID, or None on failure.
+    Also revalidates an existing entry: if the file hasn't changed, its media ID is kept.
+    """
+    link_hash = url_hash(url)
+    cached = LinkedMediaCache.objects.filter(url_hash=link_hash, phone_number_id=config.phone_number_id).first()
+    if cached is not None and cached.is_whatsapp_id_potentially_expired():
+        cached = None # Needs a new upload either way; fetch unconditionally.
+    suffix = os.path.splitext(urlparse(url).path)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as target:
+        try:
+            fetched = _fetch(url, target, cached)
+            target.flush()
+        except Exception as e:
+            logger.error(f"Could not fetch linked media {url} for upload: {e}", exc_info=True)
+            return None
+        if fetched is None:
+            cached.validated_at = timezone.now()
+            cached.save(update_fields=['validated_at', 'updated_at'])
+            logger.info(f"Linked media {url} is unchanged; keeping media ID {cached.whatsapp_media_id}.")
+            return cached.whatsapp_media_id
+        content_hash, mime_type, size = fetched.content_hash, fetched.mime_type, fetched.size
+
+        media_id, uploaded_at = None, None
+        same_content = LinkedMediaCache.objects.filter(
+            content_hash=content_hash, phone_number_id=config.phone_number_id, whatsapp_media_id__isnull=False
+        ).order_by('-uploaded_to_whatsapp_at').first()
+        if same_content is not None and not same_content.is_whatsapp_id_potentially_expired():
+            media_id, uploaded_at = same_content.whatsapp_media_id, same_content.uploaded_to_whatsapp_at
+            logger.info(f"Linked media {url} has the same content as {same_content.url}; reusing media ID {media_id}.")
+        else:
+            media_id = actual_upload_to_whatsapp_api(
+                file_path=target.name,
+                mime_type=mime_type,
+                phone_number_id=config.phone_number_id,
+                access_token=config.access_token,
+                api_version=config.api_version
+            )
+            uploaded_at = timezone.now()
+        if not media_id:
+            return None
+
+    LinkedMediaCache.objects.update_or_create(
+        url_hash=link_hash, phone_number_id=config.phone_number_id,
+        defaults={
+            'url': url, 'content_hash': content_hash, 'media_type': media_type, 'mime_type': mime_type,
+            'file_size': size, 'whatsapp_media_id': media_id, 'uploaded_to_whatsapp_at': uploaded_at,
+            'etag': fetched.etag, 'last_modified': fetched.last_modified, 'validated_at': timezone.now(),
+        }
+    )
+    logger.info(f"Cached linked media {url} as WhatsApp media ID {media_id} for phone number {config.phone_number_id}.")
+    return media_id
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_manager', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkedMediaCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.TextField(help_text='The link as sent in the message payload.')),
+                ('url_hash', models.CharField(editable=False, help_text='SHA-256 of the URL, for lookups.', max_length=64)),
+                ('phone_number_id', models.CharField(help_text='Phone number the media ID was uploaded for.', max_length=50)),
+                ('content_hash', models.CharField(blank=True, db_index=True, help_text='SHA-256 of the file. Links to identical files share one upload.', max_length=64)),
+                ('media_type', models.CharField(choices=[('image', 'Image'), ('video', 'Video'), ('audio', 'Audio'), ('document', 'Document'), ('sticker', 'Sticker')], max_length=20)),
+                ('mime_type', models.CharField(blank=True, max_length=100)),
+                ('file_size', models.PositiveIntegerField(blank=True, help_text='File size in bytes.', null=True)),
+                ('whatsapp_media_id', models.CharField(blank=True, help_text='WhatsApp Media ID of the upload.', max_length=255, null=True)),
+                ('uploaded_to_whatsapp_at', models.DateTimeField(blank=True, help_text='When the media ID was obtained.', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Linked Media Cache Entry',
+                'verbose_name_plural': 'Linked Media Cache',
+                'ordering': ['-updated_at'],
+                'constraints': [models.UniqueConstraint(fields=('url_hash', 'phone_number_id'), name='unique_linked_media_per_phone_number')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_manager', '0002_linkedmediacache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='linkedmediacache',
+            name='etag',
+            field=models.CharField(blank=True, help_text='ETag of the file when last fetched, for conditional requests.', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='linkedmediacache',
+            name='last_modified',
+            field=models.CharField(blank=True, help_text='Last-Modified of the file when last fetched.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='linkedmediacache',
+            name='validated_at',
+            field=models.DateTimeField(blank=True, help_text='When the link was last checked to still serve the uploaded file. Older than MEDIA_LINK_CACHE_REVALIDATE_SECONDS means check again.', null=True),
+        ),
+    ]
@@ -13,7 +13,18 @@ from .utils import actual_upload_to_whatsapp_api
 
 logger = logging.getLogger(__name__)
 
-class MediaAsset(models.Model):
+class WhatsAppMediaExpiryMixin:
+    """
+    Expiry check for models holding an uploaded WhatsApp media ID in `whatsapp_media_id` and
+    `uploaded_to_whatsapp_at`. Meta keeps uploaded media for 30 days.
+    """
+    def is_whatsapp_id_potentially_expired(self, days_valid=29):
+        if not self.uploaded_to_whatsapp_at or not self.whatsapp_media_id:
+            return True # No ID or never uploaded means it needs syncing
+        return self.uploaded_to_whatsapp_at < (timezone.now() - timezone.timedelta(days=days_valid))
+
+
+class MediaAsset(WhatsAppMediaExpiryMixin, models.Model):
     STATUS_CHOICES = [
         ('local', 'Local Only - Pending Upload'),
         ('uploading', 'Uploading to WhatsApp...'),
@@ -101,11 +112,6 @@ class MediaAsset(models.Model):
                 self.mime_type = mimetypes.guess_type(self.file.name)[0] or 'application/octet-stream'
         super().save(*args, **kwargs)
 
-    def is_whatsapp_id_potentially_expired(self, days_valid=29):
-        if not self.uploaded_to_whatsapp_at or not self.whatsapp_media_id:
-            return True # No ID or never uploaded means it needs syncing
-        return self.uploaded_to_whatsapp_at < (timezone.now() - timezone.timedelta(days=days_valid))
-
     def sync_with_whatsapp(self, force_reupload=False, config: MetaAppConfig = None):
         logger.info(f"Initiating sync_with_whatsapp for MediaAsset {self.pk} ('{self.name}'). Force reupload: {force_reupload}")
 
@@ -172,4 +178,42 @@ class MediaAsset(models.Model):
     class Meta:
         ordering = ['-created_at']
         verbose_name = "Media Asset"
-        verbose_name_plural = "Media Assets"
\ No newline at end of file
+        verbose_name_plural = "Media Assets"
+
+
+class LinkedMediaCache(WhatsAppMediaExpiryMixin, models.Model):
+    """
+    A file sent by link from a flow step, uploaded to WhatsApp once so later sends can use its media ID
+    instead of Meta fetching the URL again for every recipient. See media_manager.link_cache.
+    """
+    url = models.TextField(help_text="The link as sent in the message payload.")
+    url_hash = models.CharField(max_length=64, editable=False, help_text="SHA-256 of the URL, for lookups.")
+    phone_number_id = models.CharField(max_length=50, help_text="Phone number the media ID was uploaded for.")
+    content_hash = models.CharField(
+        max_length=64, blank=True, db_index=True,
+        help_text="SHA-256 of the file. Links to identical files share one upload."
+    )
+    media_type = models.CharField(max_length=20, choices=MediaAsset.MEDIA_TYPE_CHOICES)
+    mime_type = models.CharField(max_length=100, blank=True)
+    file_size = models.PositiveIntegerField(null=True, blank=True, help_text="File size in bytes.")
+    whatsapp_media_id = models.CharField(max_length=255, blank=True, null=True, help_text="WhatsApp Media ID of the upload.")
+    uploaded_to_whatsapp_at = models.DateTimeField(null=True, blank=True, help_text="When the media ID was obtained.")
+    etag = models.CharField(max_length=255, blank=True, help_text="ETag of the file when last fetched, for conditional requests.")
+    last_modified = models.CharField(max_length=64, blank=True, help_text="Last-Modified of the file when last fetched.")
+    validated_at = models.DateTimeField(
+        null=True, blank=True,
+        help_text="When the link was last checked to still serve the uploaded file. Older than MEDIA_LINK_CACHE_REVALIDATE_SECONDS means check again."
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.url} ({self.whatsapp_media_id or 'not uploaded'})"
+
+    class Meta:
+        ordering = ['-updated_at']
+        verbose_name = "Linked Media Cache Entry"
+        verbose_name_plural = "Linked Media Cache"
+        constraints = [
+            models.UniqueConstraint(fields=['url_hash', 'phone_number_id'], name='unique_linked_media_per_phone_number'),
+        ]
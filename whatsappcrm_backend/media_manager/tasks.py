@@ -42,6 +42,22 @@ def trigger_media_asset_sync_task(asset_pk: int, force_reupload: bool = False):
             logger.error(f"Could not update asset status for pk={asset_pk} after task failure: {update_e}")
         return f"Error syncing MediaAsset {asset_pk}: {e}"
 
+@shared_task(name="media_manager.tasks.cache_linked_media_task")
+def cache_linked_media_task(url: str, media_type: str, config_id: int):
+    """
+    Uploads a file sent by link to WhatsApp so later sends of the link use its media ID.
+    Scheduled by link_cache.use_cached_media_id the first time a link is sent, when its ID expires,
+    or when the link is due for revalidation.
+    """
+    from meta_integration.models import MetaAppConfig
+    from .link_cache import cache_linked_media
+
+    config = MetaAppConfig.objects.filter(pk=config_id).first()
+    if config is None:
+        logger.error(f"[Celery Task] MetaAppConfig {config_id} not found. Cannot cache linked media {url}.")
+        return None
+    return cache_linked_media(url, media_type, config)
+
 @shared_task(name="media_manager.tasks.check_and_resync_whatsapp_media")
 def check_and_resync_whatsapp_media():
     """
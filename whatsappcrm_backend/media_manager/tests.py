@@ -1,3 +1,89 @@
-from django.test import TestCase
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import link_cache
+from .models import LinkedMediaCache
+
+URL = 'https://cdn.example.com/brochure.pdf'
+
+
+@override_settings(MEDIA_LINK_CACHE_ENABLED=True, MEDIA_LINK_CACHE_REVALIDATE_SECONDS=3600)
+class LinkedMediaCacheTests(TestCase):
+    def setUp(self):
+        self.config = SimpleNamespace(id=1, phone_number_id='111', access_token='token', api_version='v19.0')
+
+    def _entry(self, url=URL, media_id='media-1', uploaded_ago=timedelta(days=1), validated_ago=timedelta(minutes=5), content_hash='abc'):
+        now = timezone.now()
+        return LinkedMediaCache.objects.create(
+            url=url, url_hash=link_cache.url_hash(url), phone_number_id='111', content_hash=content_hash,
+            media_type='document', whatsapp_media_id=media_id, uploaded_to_whatsapp_at=now - uploaded_ago,
+            validated_at=now - validated_ago,
+        )
+
+    def _use(self, data=None):
+        with mock.patch.object(link_cache, '_schedule_upload') as schedule_upload:
+            result = link_cache.use_cached_media_id('document', data or {'link': URL, 'filename': 'brochure.pdf'}, self.config)
+        return result, schedule_upload
+
+    def test_fresh_entry_replaces_link_with_media_id(self):
+        self._entry()
+        result, schedule_upload = self._use()
+        self.assertEqual(result, {'id': 'media-1', 'filename': 'brochure.pdf'})
+        schedule_upload.assert_not_called()
+
+    def test_uncached_link_is_sent_by_link_and_scheduled(self):
+        data = {'link': URL}
+        result, schedule_upload = self._use(data)
+        self.assertIs(result, data)
+        schedule_upload.assert_called_once_with(URL, link_cache.url_hash(URL), 'document', self.config)
+
+    def test_entry_due_for_revalidation_is_not_used(self):
+        self._entry(validated_ago=timedelta(hours=2))
+        result, schedule_upload = self._use()
+        self.assertEqual(result['link'], URL)
+        schedule_upload.assert_called_once()
+
+    def test_expiring_media_id_is_not_used(self):
+        self._entry(uploaded_ago=timedelta(days=29, hours=1))
+        result, schedule_upload = self._use()
+        self.assertEqual(result['link'], URL)
+        schedule_upload.assert_called_once()
+
+    @override_settings(MEDIA_LINK_CACHE_ENABLED=False)
+    def test_disabled_cache_leaves_payload_alone(self):
+        self._entry()
+        result, schedule_upload = self._use()
+        self.assertEqual(result['link'], URL)
+        schedule_upload.assert_not_called()
+
+    def test_unchanged_file_keeps_media_id(self):
+        entry = self._entry(validated_ago=timedelta(hours=2))
+        with mock.patch.object(link_cache, '_fetch', return_value=None), \
+                mock.patch.object(link_cache, 'actual_upload_to_whatsapp_api') as upload:
+            self.assertEqual(link_cache.cache_linked_media(URL, 'document', self.config), 'media-1')
+        upload.assert_not_called()
+        entry.refresh_from_db()
+        self.assertGreater(entry.validated_at, timezone.now() - timedelta(minutes=1))
+
+    def test_same_content_reuses_media_id(self):
+        self._entry(url='https://cdn.example.com/copy.pdf', media_id='media-2', content_hash='same')
+        fetched = link_cache._Fetched('same', 'application/pdf', 1024)
+        with mock.patch.object(link_cache, '_fetch', return_value=fetched), \
+                mock.patch.object(link_cache, 'actual_upload_to_whatsapp_api') as upload:
+            self.assertEqual(link_cache.cache_linked_media(URL, 'document', self.config), 'media-2')
+        upload.assert_not_called()
+        self.assertEqual(LinkedMediaCache.objects.get(url_hash=link_cache.url_hash(URL)).whatsapp_media_id, 'media-2')
+
+    def test_changed_content_is_uploaded(self):
+        self._entry(validated_ago=timedelta(hours=2))
+        fetched = link_cache._Fetched('new', 'application/pdf', 2048, etag='"v2"')
+        with mock.patch.object(link_cache, '_fetch', return_value=fetched), \
+                mock.patch.object(link_cache, 'actual_upload_to_whatsapp_api', return_value='media-3') as upload:
+            self.assertEqual(link_cache.cache_linked_media(URL, 'document', self.config), 'media-3')
+        upload.assert_called_once()
+        entry = LinkedMediaCache.objects.get(url_hash=link_cache.url_hash(URL))
+        self.assertEqual((entry.whatsapp_media_id, entry.content_hash, entry.etag), ('media-3', 'new', '"v2"'))
@@ -2,6 +2,7 @@
 import requests
 import logging
 import os # For os.path.basename
+from meta_integration.graph_client import get_graph_client, graph_api_base_url
 
 logger = logging.getLogger(__name__)
 
@@ -20,7 +21,7 @@ def actual_upload_to_whatsapp_api(
         logger.error(f"[WhatsApp API Upload] File not found at path: {file_path}")
         return None
 
-    url = f"https://graph.facebook.com/{api_version}/{phone_number_id}/media"
+    url = f"{graph_api_base_url()}/{api_version}/{phone_number_id}/media"
     headers = {
         "Authorization": f"Bearer {access_token}",
     }
@@ -38,7 +39,7 @@ def actual_upload_to_whatsapp_api(
                 f"[WhatsApp API Upload] Attempting to upload {file_path} (type: {mime_type}) "
                 f"to WhatsApp for Phone ID {phone_number_id} using API {api_version}."
             )
-            response = requests.post(url, headers=headers, files=files_payload, timeout=60) # 60-second timeout
+            response = get_graph_client().post(url, 'media_upload', headers=headers, files=files_payload, timeout=60) # 60-second read timeout
 
         response.raise_for_status()  # Raises an HTTPError for bad responses (4XX or 5XX)
         
@@ -1,6 +1,10 @@
 # whatsappcrm_backend/meta_integration/admin.py
 
-from django.contrib import admin
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.utils import timezone
 from .models import MetaAppConfig, WebhookEventLog
 
 @admin.register(MetaAppConfig)
@@ -32,10 +36,11 @@ class MetaAppConfigAdmin(admin.ModelAdmin):
 class WebhookEventLogAdmin(admin.ModelAdmin):
     list_display = ('id', 'event_type', 'event_identifier', 'message_link', 'app_config_name', 'received_at', 'processing_status')
     list_filter = ('event_type', 'processing_status', 'received_at', 'app_config', 'waba_id_received', 'phone_number_id_received')
-    search_fields = ('event_identifier', 'payload', 'processing_notes', 'waba_id_received', 'phone_number_id_received', 'message__wamid', 'message__contact__name')
+    search_fields = ('event_identifier', 'processing_notes', 'waba_id_received', 'phone_number_id_received', 'message__wamid', 'message__contact__name')
     readonly_fields = ('app_config', 'message', 'payload_object_type', 'payload', 'received_at', 'processed_at')
     date_hierarchy = 'received_at'
     list_per_page = 25
+    actions = ['replay_events']
 
     fieldsets = (
         (None, {'fields': ('event_type', 'event_identifier', 'app_config', 'message')}),
@@ -57,6 +62,39 @@ class WebhookEventLogAdmin(admin.ModelAdmin):
         return "N/A"
     message_link.short_description = "Message"
 
+    @admin.action(description="Replay selected events through the webhook processor")
+    def replay_events(self, request, queryset):
+        from .tasks import replay_webhook_events_task
+        log_ids = list(queryset.values_list('id', flat=True))
+        queryset.update(processing_status='pending_reprocessing', processed_at=None)
+        replay_webhook_events_task.delay(log_ids)
+        self.message_user(request, f"{len(log_ids)} event(s) queued for replay. Use the replay_webhook_events command for larger ranges.")
+
+    def _default_window_days(self, request):
+        """
+        Days the changelist is limited to, or None. It only looks at recent partitions unless a
+        received_at filter/date drill-down is chosen; change views still see every row.
+        """
+        is_changelist = request.resolver_match and request.resolver_match.url_name == 'meta_integration_webhookeventlog_changelist'
+        if is_changelist and not any(param.startswith('received_at') for param in request.GET):
+            return getattr(settings, 'WEBHOOK_LOG_DEFAULT_WINDOW_DAYS', 7)
+        return None
+
     def get_queryset(self, request):
         # Optimize query by prefetching related MetaAppConfig
-        return super().get_queryset(request).select_related('app_config', 'message')
+        queryset = super().get_queryset(request).select_related('app_config', 'message')
+        window_days = self._default_window_days(request)
+        if window_days:
+            queryset = queryset.filter(received_at__gte=timezone.now() - timedelta(days=window_days))
+        return queryset
+
+    def changelist_view(self, request, extra_context=None):
+        window_days = self._default_window_days(request)
+        if window_days and request.method == 'GET':
+            self.message_user(
+                request,
+                f"Showing events received in the last {window_days} days only. "
+                f"Pick a 'Received at' filter or a date above to see older events.",
+                messages.INFO,
+            )
+        return super().changelist_view(request, extra_context)
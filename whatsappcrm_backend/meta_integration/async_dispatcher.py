@@ -0,0 +1,246 @@
+# whatsappcrm_backend/meta_integration/async_dispatcher.py
+"""
+Asyncio outbound dispatcher, run by `python manage.py run_send_dispatcher` when
+META_SEND_ASYNC_DISPATCHER is enabled.
+
+It drains the send sequencer's per-contact queues (see sequencer.py) as coroutines on one event
+loop, with hundreds of Graph API calls in flight over a pooled httpx client, instead of one blocked
+Celery worker slot per send. Ordering, leases, rate limits and delivery waits are the sequencer's,
+so the rules are the same as for `drain_contact_send_queue_task`. Send results are written with
+one bulk_update per batch; a contact's queue only moves past a message once its result (wamid,
+status) is committed, and each written message sends post_save like the Celery path's save().
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from conversations.models import Message
+from . import sequencer
+from .graph_client import graph_pool_size, record_request
+from .models import MetaAppConfig
+from .rate_limiter import MetaRateLimitError, acquire_send_token
+from .tasks import _apply_send_response
+from .utils import build_message_request
+
+logger = logging.getLogger('meta_integration')
+
+RESULT_FIELDS = ['wamid', 'status', 'error_details', 'status_timestamp']
+# Transport errors are retried like drain_contact_send_queue_task does (max_retries=10, default_retry_delay=3).
+MAX_SEND_RETRIES = 10
+SEND_RETRY_DELAY_SECONDS = 3
+
+
+class AsyncSendDispatcher:
+    def __init__(self, concurrency: int = 200, flush_interval: float = 0.25, flush_batch_size: int = 500):
+        self.concurrency = concurrency
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.stats = {'sent': 0, 'failed': 0, 'rate_limited': 0, 'retried': 0}
+        self._drains = set()
+        self._pending_results: List[Tuple[Message, asyncio.Future]] = []
+        self._configs: Dict[int, Optional[MetaAppConfig]] = {}
+        self._stopping = asyncio.Event()
+        self._client = None
+
+    def stop(self) -> None:
+        """Stops taking new drains; drains in progress hand their queue back and pending results are written."""
+        self._stopping.set()
+
+    async def run(self) -> None:
+        # Like GraphAPIClient's pool: up to META_GRAPH_API_POOL_SIZE connections are kept alive, and busier
+        # moments open short-lived extra ones rather than making drains wait for a pooled connection.
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max(self.concurrency, graph_pool_size()), max_keepalive_connections=graph_pool_size()
+            ),
+            timeout=httpx.Timeout(
+                getattr(settings, 'META_GRAPH_API_READ_TIMEOUT', 20),
+                connect=getattr(settings, 'META_GRAPH_API_CONNECT_TIMEOUT', 5),
+            ),
+        )
+        flusher = asyncio.create_task(self._flush_periodically())
+        try:
+            while not self._stopping.is_set():
+                free_slots = self.concurrency - len(self._drains)
+                if free_slots <= 0:
+                    await asyncio.wait(self._drains, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                try:
+                    drains = await asyncio.to_thread(sequencer.take_ready_drains, free_slots, 0.5)
+                except Exception as e:
+                    logger.error(f"Send dispatcher could not read scheduled drains: {e}", exc_info=True)
+                    await asyncio.sleep(1)
+                    continue
+                for contact_id, token, awaited_wamid in drains:
+                    drain = asyncio.create_task(self._drain(contact_id, token, awaited_wamid))
+                    self._drains.add(drain)
+                    drain.add_done_callback(self._drains.discard)
+        finally:
+            if self._drains:
+                await asyncio.wait(self._drains)
+            flusher.cancel()
+            await self._flush()
+            await self._client.aclose()
+
+    async def _drain(self, contact_id: int, token: str, awaited_wamid: Optional[str]) -> None:
+        try:
+            await self._drain_queue(contact_id, token, awaited_wamid)
+        except Exception as e:
+            # The lease expires and sweep_send_queues restarts the queue.
+            logger.error(f"Send dispatcher failed draining the queue of contact {contact_id}: {e}", exc_info=True)
+
+    async def _drain_queue(self, contact_id: int, token: str, awaited_wamid: Optional[str]) -> None:
+        if awaited_wamid and await asyncio.to_thread(sequencer.stop_awaiting, awaited_wamid) is None:
+            return # The status webhook already resumed the queue.
+
+        retries = 0
+        while True:
+            if self._stopping.is_set():
+                await asyncio.to_thread(sequencer.defer, contact_id, token, 0.001) # Picked up by the next dispatcher
+                return
+            if not await asyncio.to_thread(sequencer.renew_lease, contact_id, token):
+                logger.warning(f"Send dispatcher lost the send lease for contact {contact_id}. Another drain has taken over.")
+                return
+            head = await asyncio.to_thread(sequencer.peek, contact_id)
+            if head is None:
+                if await asyncio.to_thread(sequencer.release_if_idle, contact_id, token) == 0:
+                    continue # Messages were queued while releasing.
+                return
+            message_id, config_id, lane = head
+
+            outgoing_msg, active_config = await sync_to_async(self._load)(message_id, config_id)
+            if outgoing_msg is None:
+                await asyncio.to_thread(sequencer.pop, contact_id)
+                continue
+
+            wait = await asyncio.to_thread(acquire_send_token, active_config.phone_number_id, lane)
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+
+            try:
+                api_response = await self._post(outgoing_msg, active_config)
+                # In a thread: a rate-limit rejection is recorded in Redis.
+                accepted = await asyncio.to_thread(_apply_send_response, outgoing_msg, api_response, active_config)
+            except MetaRateLimitError as e:
+                self.stats['rate_limited'] += 1
+                await asyncio.sleep(e.retry_after)
+                continue
+            except httpx.HTTPError as e:
+                retries += 1
+                if retries <= MAX_SEND_RETRIES:
+                    self.stats['retried'] += 1
+                    logger.warning(f"Transport error sending Message ID {message_id}: {e}. Retry {retries}/{MAX_SEND_RETRIES}.")
+                    await asyncio.sleep(SEND_RETRY_DELAY_SECONDS)
+                    continue
+                logger.error(f"Max retries exceeded for sending Message ID {message_id}. Continuing with the contact's queue.")
+                outgoing_msg.status = 'failed'
+                outgoing_msg.error_details = {'error': str(e), 'type': type(e).__name__}
+                accepted = False
+
+            retries = 0
+            outgoing_msg.status_timestamp = timezone.now()
+            self.stats['sent' if accepted else 'failed'] += 1
+            written = asyncio.get_running_loop().create_future()
+            self._pending_results.append((outgoing_msg, written))
+            if len(self._pending_results) >= self.flush_batch_size:
+                await self._flush()
+            # The entry stays at the head of the queue until the wamid is in the database, so status
+            # webhooks can always find the message. If this process dies first the message is sent
+            # again once the lease expires, as with a Celery worker dying between send and save.
+            while not written.done():
+                await asyncio.wait({written}, timeout=sequencer.LEASE_SECONDS / 3)
+                if not written.done():
+                    await asyncio.to_thread(sequencer.renew_lease, contact_id, token)
+            await asyncio.to_thread(sequencer.pop, contact_id)
+            if accepted and sequencer.wait_for_delivery():
+                await asyncio.to_thread(sequencer.await_delivery, contact_id, token, outgoing_msg.wamid)
+                return
+
+    def _load(self, message_id: int, config_id: int):
+        """The message to send and its config, or (None, None) if the queue entry is to be skipped."""
+        outgoing_msg = Message.objects.select_related('contact', 'payload_blob').filter(pk=message_id).first()
+        if outgoing_msg is None:
+            logger.error(f"Send dispatcher: Message with ID {message_id} not found. Skipping.")
+            return None, None
+        if outgoing_msg.direction != 'out':
+            logger.warning(f"Send dispatcher: Message ID {message_id} is not an outgoing message. Skipping.")
+            return None, None
+        if outgoing_msg.wamid and outgoing_msg.status == 'sent':
+            logger.info(f"Send dispatcher: Message ID {message_id} (WAMID: {outgoing_msg.wamid}) already marked as sent. Skipping.")
+            return None, None
+        if config_id not in self._configs:
+            self._configs[config_id] = MetaAppConfig.objects.filter(pk=config_id).first()
+        active_config = self._configs[config_id]
+        if active_config is None:
+            logger.error(f"Send dispatcher: MetaAppConfig with ID {config_id} not found for Message ID {message_id}.")
+            outgoing_msg.status = 'failed'
+            outgoing_msg.error_details = {'error': f'MetaAppConfig ID {config_id} not found for sending.'}
+            outgoing_msg.status_timestamp = timezone.now()
+            outgoing_msg.save(update_fields=['status', 'error_details', 'status_timestamp'])
+            return None, None
+        if not isinstance(outgoing_msg.content_payload, dict):
+            logger.error(f"Send dispatcher: Message ID {message_id} content_payload is not a valid dictionary for sending.")
+            outgoing_msg.status = 'failed'
+            outgoing_msg.error_details = {'error': 'Message content_payload is not a valid dictionary for sending.'}
+            outgoing_msg.status_timestamp = timezone.now()
+            outgoing_msg.save(update_fields=['status', 'error_details', 'status_timestamp'])
+            return None, None
+        return outgoing_msg, active_config
+
+    async def _post(self, outgoing_msg: Message, active_config: MetaAppConfig):
+        """Sends the message. Returns Meta's response or error body like send_whatsapp_message; raises httpx.HTTPError on transport errors."""
+        url, headers, payload = build_message_request(
+            outgoing_msg.contact.whatsapp_id, outgoing_msg.message_type, outgoing_msg.content_payload, active_config
+        )
+        started = time.monotonic()
+        try:
+            response = await self._client.post(url, headers=headers, json=payload)
+        except httpx.HTTPError:
+            record_request('messages', 'POST', started, None)
+            raise
+        record_request('messages', 'POST', started, response.status_code)
+        if response.status_code >= 400:
+            logger.error(f"HTTP error sending Message ID {outgoing_msg.id}: {response.status_code} - {response.text}")
+            try:
+                return response.json()
+            except ValueError:
+                return None
+        return response.json()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if not self._pending_results:
+            return
+        batch, self._pending_results = self._pending_results, []
+        try:
+            await sync_to_async(self._write_results)([message for message, _ in batch])
+        except Exception as e:
+            # Kept (ahead of newer results) and retried on the next flush; the waiting drains hold their queues meanwhile.
+            logger.error(f"Send dispatcher could not write the results of {len(batch)} message(s): {e}. Retrying.", exc_info=True)
+            self._pending_results = batch + self._pending_results
+            return
+        for _, written in batch:
+            if not written.done():
+                written.set_result(True)
+
+    def _write_results(self, results: List[Message]) -> None:
+        close_old_connections() # Long-running process; drop connections the database has closed
+        with transaction.atomic():
+            Message.objects.bulk_update(results, RESULT_FIELDS)
+        # bulk_update() sends no signals: announce each message like its save() would (live conversation view, stats).
+        update_fields = frozenset(RESULT_FIELDS)
+        for message in results:
+            post_save.send(sender=Message, instance=message, created=False, update_fields=update_fields, raw=False, using=message._state.db)
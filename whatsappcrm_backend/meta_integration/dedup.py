@@ -0,0 +1,89 @@
+# whatsappcrm_backend/meta_integration/dedup.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+from django.conf import settings
+
+from whatsappcrm_backend.redis_client import get_redis_client
+
+logger = logging.getLogger('meta_integration')
+
+SEEN_KEY = "meta:seen:{event_key}"
+
+# Keys seen recently by this process, so most redeliveries are dropped without a Redis round trip.
+_LOCAL_MAX_ENTRIES = 50000
+_LOCAL_TTL_SECONDS = 120
+
+
+class _RecentKeys:
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False
+            return True
+
+    def add(self, key) -> None:
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl_seconds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_recent_keys = _RecentKeys(_LOCAL_MAX_ENTRIES, _LOCAL_TTL_SECONDS)
+
+
+def _ttl() -> int:
+    return getattr(settings, 'META_WEBHOOK_DEDUP_TTL_SECONDS', 24 * 60 * 60)
+
+
+def is_seen(event_key: str) -> bool:
+    """
+    True if a webhook event (a wamid, or '<wamid>_<status>' for statuses) was already committed,
+    i.e. this delivery is a retry that can be dropped before any database work.
+    Fails open: if Redis is unavailable the event is processed and WebhookEventKey dedupes it.
+    """
+    if not event_key or not _ttl():
+        return False
+    if event_key in _recent_keys:
+        return True
+    try:
+        seen = bool(get_redis_client().exists(SEEN_KEY.format(event_key=event_key)))
+    except Exception as e:
+        logger.warning(f"Webhook dedupe check unavailable for '{event_key}': {e}. Processing it.")
+        return False
+    if seen:
+        _recent_keys.add(event_key)
+    return seen
+
+
+def mark_seen(event_keys: List[str]) -> None:
+    """
+    Records events as seen. Call only once they are committed (transaction.on_commit): an event
+    marked and then lost with its transaction would have every redelivery dropped.
+    """
+    if not event_keys or not _ttl():
+        return
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        for event_key in event_keys:
+            pipe.set(SEEN_KEY.format(event_key=event_key), 1, ex=_ttl())
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not record {len(event_keys)} webhook dedupe keys: {e}")
+        return
+    for event_key in event_keys:
+        _recent_keys.add(event_key)
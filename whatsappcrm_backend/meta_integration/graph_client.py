@@ -0,0 +1,119 @@
+# whatsappcrm_backend/meta_integration/graph_client.py
+"""
+One Graph API client per worker process, shared by every outbound Meta call (messages, read
+receipts, media upload/download). It keeps a pooled keep-alive session so calls reuse TLS
+connections instead of a handshake each, and records per-endpoint latency and error metrics.
+The metrics live in the calling process: Celery workers serve them on CELERY_METRICS_PORT, and
+run_send_dispatcher / run_webhook_ingestion on their --metrics-port.
+
+Pool size and timeouts come from META_GRAPH_API_POOL_SIZE, META_GRAPH_API_CONNECT_TIMEOUT and
+META_GRAPH_API_READ_TIMEOUT; call sites pass their own read timeout where they need a longer one.
+The asyncio send dispatcher uses httpx instead, with the same settings and `record_request()` metrics.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import requests
+from django.conf import settings
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger('meta_integration')
+
+REQUEST_SECONDS = Histogram(
+    'graph_api_request_seconds', 'Wall time of one Graph API request, including reading the response.', ['endpoint', 'method'],
+)
+REQUEST_ERRORS = Counter(
+    'graph_api_request_errors_total', 'Graph API requests that failed, by kind (http_4xx, http_5xx, transport).', ['endpoint', 'kind'],
+)
+
+
+def request_error_kind(status_code: Optional[int]) -> Optional[str]:
+    """The REQUEST_ERRORS kind of a response status, 'transport' for no response at all, None for success."""
+    if status_code is None:
+        return 'transport'
+    if status_code >= 500:
+        return 'http_5xx'
+    if status_code >= 400:
+        return 'http_4xx'
+    return None
+
+
+def record_request(endpoint: str, method: str, started: float, status_code: Optional[int]) -> None:
+    """
+    Records one Graph API request started at `started` (time.monotonic()). `status_code` is None when
+    the request failed without a response. Shared by GraphAPIClient and the async send dispatcher.
+    """
+    REQUEST_SECONDS.labels(endpoint, method).observe(time.monotonic() - started)
+    kind = request_error_kind(status_code)
+    if kind:
+        REQUEST_ERRORS.labels(endpoint, kind).inc()
+
+
+def graph_pool_size() -> int:
+    return getattr(settings, 'META_GRAPH_API_POOL_SIZE', 10)
+
+
+def graph_api_base_url() -> str:
+    """Base URL of the Graph API. Point META_GRAPH_API_BASE_URL at a stand-in for replays and load tests."""
+    return getattr(settings, 'META_GRAPH_API_BASE_URL', 'https://graph.facebook.com').rstrip('/')
+
+
+class GraphAPIClient:
+    """
+    Thin wrapper around a pooled requests.Session. Responses are returned as-is (callers keep their
+    own raise_for_status()/error handling); `endpoint` is a short label such as 'messages' used for metrics.
+    """
+
+    def __init__(self, pool_size: int, connect_timeout: float, read_timeout: float):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        # Connections to graph.facebook.com and to the media CDN each get their own pool.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter) # Local stand-in APIs
+
+    def request(self, method: str, url: str, endpoint: str, access_token: Optional[str] = None,
+                timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        headers = kwargs.pop('headers', None) or {}
+        if access_token:
+            headers.setdefault('Authorization', f"Bearer {access_token}")
+        started = time.monotonic()
+        try:
+            response = self.session.request(
+                method, url, headers=headers, timeout=(self.connect_timeout, timeout or self.read_timeout), **kwargs
+            )
+        except requests.exceptions.RequestException:
+            record_request(endpoint, method, started, None)
+            raise
+        record_request(endpoint, method, started, response.status_code)
+        return response
+
+    def get(self, url: str, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, endpoint, **kwargs)
+
+    def post(self, url: str, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, endpoint, **kwargs)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_graph_client() -> GraphAPIClient:
+    """Returns this process's client. A forked worker (Celery prefork) gets its own, never the parent's sockets."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = GraphAPIClient(
+                    pool_size=graph_pool_size(),
+                    connect_timeout=getattr(settings, 'META_GRAPH_API_CONNECT_TIMEOUT', 5),
+                    read_timeout=getattr(settings, 'META_GRAPH_API_READ_TIMEOUT', 20),
+                )
+                _client_pid = os.getpid()
+    return _client
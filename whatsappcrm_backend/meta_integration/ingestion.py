@@ -0,0 +1,83 @@
+# whatsappcrm_backend/meta_integration/ingestion.py
+import logging
+from typing import List, Tuple
+
+from django.conf import settings
+
+from whatsappcrm_backend.redis_client import get_redis_client
+
+logger = logging.getLogger('meta_integration')
+
+STREAM_KEY = "meta:webhooks:inbound"
+DEAD_LETTER_STREAM_KEY = "meta:webhooks:dead"
+CONSUMER_GROUP = "webhook-ingestion"
+
+# An entry as returned by XREADGROUP/XAUTOCLAIM: (entry_id, {'config_id': ..., 'body': ...})
+StreamEntry = Tuple[str, dict]
+
+
+def is_buffered_ingestion_enabled() -> bool:
+    return getattr(settings, 'META_WEBHOOK_INGESTION_MODE', 'sync') == 'buffered'
+
+
+def enqueue_webhook(config_id: int, raw_body: str) -> bool:
+    """
+    Appends a verified webhook body to the inbound stream. Returns False if Redis is unavailable,
+    in which case the caller should process the webhook synchronously instead of dropping it.
+    """
+    try:
+        get_redis_client().xadd(
+            STREAM_KEY, {'config_id': config_id, 'body': raw_body},
+            maxlen=getattr(settings, 'META_WEBHOOK_STREAM_MAXLEN', 100000), approximate=True,
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Could not buffer webhook in Redis stream '{STREAM_KEY}': {e}. Falling back to synchronous processing.", exc_info=True)
+        return False
+
+
+def ensure_consumer_group() -> None:
+    try:
+        get_redis_client().xgroup_create(STREAM_KEY, CONSUMER_GROUP, id='0', mkstream=True)
+    except Exception as e:
+        if 'BUSYGROUP' not in str(e): # The group already exists
+            raise
+
+
+def read_batch(consumer: str, count: int, block_ms: int) -> List[StreamEntry]:
+    """Reads up to `count` new entries for this consumer, blocking up to `block_ms` if there are none."""
+    response = get_redis_client().xreadgroup(CONSUMER_GROUP, consumer, {STREAM_KEY: '>'}, count=count, block=block_ms)
+    if not response:
+        return []
+    return [(entry_id, fields) for entry_id, fields in response[0][1] if fields is not None]
+
+
+def claim_stale(consumer: str, min_idle_ms: int, count: int) -> List[StreamEntry]:
+    """Takes over entries delivered to a consumer that died (or stalled) before acknowledging them."""
+    response = get_redis_client().xautoclaim(STREAM_KEY, CONSUMER_GROUP, consumer, min_idle_time=min_idle_ms, start_id='0-0', count=count)
+    # redis-py returns [next_start_id, entries] (plus deleted ids on Redis 7+)
+    return [(entry_id, fields) for entry_id, fields in response[1] if fields is not None]
+
+
+def delivery_count(entry_id: str) -> int:
+    pending = get_redis_client().xpending_range(STREAM_KEY, CONSUMER_GROUP, min=entry_id, max=entry_id, count=1)
+    return pending[0]['times_delivered'] if pending else 0
+
+
+def acknowledge(entry_ids: List[str]) -> None:
+    if entry_ids:
+        client = get_redis_client()
+        pipe = client.pipeline()
+        pipe.xack(STREAM_KEY, CONSUMER_GROUP, *entry_ids)
+        pipe.xdel(STREAM_KEY, *entry_ids)
+        pipe.execute()
+
+
+def dead_letter(entry_id: str, fields: dict, reason: str) -> None:
+    """Moves an entry that keeps failing out of the way so it doesn't block the group forever."""
+    client = get_redis_client()
+    pipe = client.pipeline()
+    pipe.xadd(DEAD_LETTER_STREAM_KEY, {**fields, 'original_id': entry_id, 'reason': reason[:500]}, maxlen=10000, approximate=True)
+    pipe.xack(STREAM_KEY, CONSUMER_GROUP, entry_id)
+    pipe.xdel(STREAM_KEY, entry_id)
+    pipe.execute()
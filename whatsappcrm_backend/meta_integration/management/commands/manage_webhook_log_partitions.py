@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from meta_integration import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates upcoming WebhookEventLog partitions and detaches/drops the ones older than '
+        'WEBHOOK_LOG_RETENTION_DAYS. Also run daily by the maintain_webhook_log_partitions_task beat task.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=None, help='Intervals to pre-create past now (default: WEBHOOK_LOG_PARTITIONS_AHEAD).')
+        parser.add_argument('--retention-days', type=int, default=None, help='Drop partitions older than this (default: WEBHOOK_LOG_RETENTION_DAYS).')
+        parser.add_argument('--detach-only', action='store_true', help='Detach expired partitions but keep them as standalone tables.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be done.')
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            self.stdout.write(self.style.WARNING(f"{partitions.PARENT_TABLE} is not partitioned (requires PostgreSQL and migration 0003). Nothing to do."))
+            return
+
+        dry_run = options['dry_run']
+        created = partitions.ensure_partitions(ahead=options['ahead'], dry_run=dry_run)
+        removed = partitions.drop_expired_partitions(
+            retention_days=options['retention_days'], detach_only=options['detach_only'] or None, dry_run=dry_run
+        )
+
+        for partition in partitions.list_partitions():
+            lower = partition.lower.isoformat() if partition.lower else 'MINVALUE'
+            upper = partition.upper.isoformat() if partition.upper else 'MAXVALUE'
+            self.stdout.write(f"  {partition.name}: [{lower}, {upper})")
+
+        prefix = "[DRY RUN] " if dry_run else ""
+        self.stdout.write(self.style.SUCCESS(f"{prefix}Created {len(created)} partition(s), removed {len(removed)} expired partition(s)."))
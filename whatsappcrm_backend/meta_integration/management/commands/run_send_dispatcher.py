@@ -0,0 +1,37 @@
+import asyncio
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from meta_integration.async_dispatcher import AsyncSendDispatcher
+from whatsappcrm_backend.metrics_server import start_metrics_server
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends queued outgoing WhatsApp messages from an asyncio event loop (META_SEND_ASYNC_DISPATCHER=True), '
+        'with many Graph API calls in flight at once. Several instances can run side by side.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=200, help='Maximum contact queues drained concurrently.')
+        parser.add_argument('--flush-interval', type=float, default=0.25, help='Seconds between batched writes of send results.')
+        parser.add_argument('--metrics-port', type=int, default=0, help='Serve Prometheus metrics (Graph API latency/errors) on this port; 0 disables.')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'META_SEND_ASYNC_DISPATCHER', False):
+            self.stderr.write(self.style.WARNING(
+                "META_SEND_ASYNC_DISPATCHER is disabled: sends are drained by Celery and this dispatcher will stay idle."
+            ))
+        start_metrics_server(options['metrics_port'])
+        dispatcher = AsyncSendDispatcher(concurrency=options['concurrency'], flush_interval=options['flush_interval'])
+        self.stdout.write(self.style.SUCCESS(f"Send dispatcher started with concurrency {options['concurrency']}."))
+        asyncio.run(self._run(dispatcher))
+        self.stdout.write(self.style.SUCCESS(f"Send dispatcher stopped. {dispatcher.stats}"))
+
+    async def _run(self, dispatcher: AsyncSendDispatcher):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, dispatcher.stop)
+        await dispatcher.run()
@@ -0,0 +1,79 @@
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from meta_integration import ingestion
+from meta_integration.models import MetaAppConfig
+from meta_integration.services import WebhookProcessor
+from whatsappcrm_backend.metrics_server import start_metrics_server
+
+
+class Command(BaseCommand):
+    help = (
+        'Drains webhooks buffered by MetaWebhookAPIView (META_WEBHOOK_INGESTION_MODE=buffered) and processes them. '
+        'Run several instances for a pool of workers; each needs a distinct --consumer name (the default is unique per process).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', default=f"{socket.gethostname()}-{os.getpid()}", help='Consumer name within the ingestion group.')
+        parser.add_argument('--batch-size', type=int, default=50, help='Maximum entries read per batch.')
+        parser.add_argument('--block-ms', type=int, default=5000, help='How long to wait for new entries before checking for stale ones.')
+        parser.add_argument('--claim-idle-ms', type=int, default=60000, help='Entries unacknowledged for this long are taken over from dead consumers.')
+        parser.add_argument('--max-deliveries', type=int, default=5, help='Entries delivered this many times are moved to the dead-letter stream.')
+        parser.add_argument('--metrics-port', type=int, default=0, help='Serve Prometheus metrics (Graph API latency/errors) on this port; 0 disables.')
+
+    def handle(self, *args, **options):
+        consumer = options['consumer']
+        start_metrics_server(options['metrics_port'])
+        ingestion.ensure_consumer_group()
+        self.stdout.write(self.style.SUCCESS(f"Webhook ingestion worker '{consumer}' started on stream '{ingestion.STREAM_KEY}'."))
+
+        self._configs = {}
+        try:
+            while True:
+                entries = ingestion.claim_stale(consumer, options['claim_idle_ms'], options['batch_size'])
+                reclaimed = bool(entries)
+                if not entries:
+                    entries = ingestion.read_batch(consumer, options['batch_size'], options['block_ms'])
+                if not entries:
+                    continue
+
+                close_old_connections() # This is a long-running process; drop connections the database has closed
+                self._process_batch(entries, reclaimed, options['max_deliveries'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS(f"Webhook ingestion worker '{consumer}' stopped."))
+
+    def _process_batch(self, entries, reclaimed: bool, max_deliveries: int):
+        started_at = time.monotonic()
+        processed_ids = []
+        for entry_id, fields in entries:
+            if reclaimed and ingestion.delivery_count(entry_id) > max_deliveries:
+                ingestion.dead_letter(entry_id, fields, f"Exceeded {max_deliveries} deliveries")
+                self.stderr.write(self.style.ERROR(f"Moved webhook entry {entry_id} to '{ingestion.DEAD_LETTER_STREAM_KEY}' after {max_deliveries} failed deliveries."))
+                continue
+
+            try:
+                self._process_entry(fields)
+            except Exception as e:
+                # Left unacknowledged: it will be reclaimed and retried once it has been idle long enough.
+                self.stderr.write(self.style.ERROR(f"Failed to process webhook entry {entry_id}: {e}"))
+                continue
+            processed_ids.append(entry_id)
+
+        ingestion.acknowledge(processed_ids)
+        self.stdout.write(f"Processed {len(processed_ids)}/{len(entries)} webhook entries in {(time.monotonic() - started_at) * 1000:.1f}ms.")
+
+    def _process_entry(self, fields: dict):
+        config_id = int(fields['config_id'])
+        active_config = self._configs.get(config_id)
+        if active_config is None:
+            active_config = self._configs[config_id] = MetaAppConfig.objects.get(pk=config_id)
+
+        processor = WebhookProcessor(active_config)
+        payload = processor.parse_body(fields.get('body', ''))
+        # process() logs and swallows its errors; raise so the entry stays pending and is retried or dead-lettered.
+        if payload is not None and not processor.process(payload):
+            raise RuntimeError("WebhookProcessor.process() failed; see the webhook event log.")
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.7 on 2026-10-17 09:12
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_event_logs(apps, schema_editor):
+    """Keeps only the newest log row per (app_config, event_identifier) so the unique constraint can be added."""
+    WebhookEventLog = apps.get_model('meta_integration', 'WebhookEventLog')
+    duplicates = (
+        WebhookEventLog.objects
+        .filter(app_config__isnull=False, event_identifier__isnull=False)
+        .values('app_config_id', 'event_identifier')
+        .annotate(keep_id=Max('id'), row_count=Count('id'))
+        .filter(row_count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        WebhookEventLog.objects.filter(
+            app_config_id=duplicate['app_config_id'], event_identifier=duplicate['event_identifier']
+        ).exclude(id=duplicate['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta_integration', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhookeventlog',
+            name='event_identifier',
+            field=models.CharField(blank=True, db_index=True, help_text='Identifier of the event (e.g., wamid for messages), unique per app configuration.', max_length=255, null=True),
+        ),
+        migrations.RunPython(remove_duplicate_event_logs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='webhookeventlog',
+            constraint=models.UniqueConstraint(fields=('app_config', 'event_identifier'), name='unique_webhook_event_per_config'),
+        ),
+    ]
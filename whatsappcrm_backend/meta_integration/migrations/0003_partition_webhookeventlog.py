@@ -0,0 +1,163 @@
+# Generated by Django 5.1.7 on 2026-10-17 11:40
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import migrations, transaction
+
+# Turns meta_integration_webhookeventlog into a table partitioned by RANGE (received_at).
+# The existing table is not copied: it is attached as the first partition, covering everything
+# up to the cutover (the end of the next UTC day), and is dropped by retention like any other partition.
+# The primary key becomes (id, received_at), as PostgreSQL requires the partition key in it;
+# ids still come from a single identity sequence, so Django keeps treating `id` as the pk.
+#
+# ATTACH PARTITION would scan the whole table under an exclusive lock to check the bound. A CHECK
+# constraint matching the bound is added NOT VALID and validated first, in their own transactions:
+# validation only takes a SHARE UPDATE EXCLUSIVE lock, so webhooks keep being logged meanwhile, and
+# ATTACH then skips the scan. The cutover is a day ahead so rows written meanwhile satisfy the check.
+#
+# Rows outside every range partition (e.g. if maintenance stops running) go to a DEFAULT partition
+# rather than failing the insert; partitions.ensure_partitions moves them out when it creates their partition.
+LEGACY_BOUND_CHECK = 'meta_integration_webhookeventlog_legacy_bound'
+
+ADD_BOUND_CHECK_SQL = f"""
+ALTER TABLE meta_integration_webhookeventlog
+    ADD CONSTRAINT {LEGACY_BOUND_CHECK} CHECK (received_at IS NOT NULL AND received_at < '__CUTOVER__') NOT VALID
+"""
+VALIDATE_BOUND_CHECK_SQL = f"ALTER TABLE meta_integration_webhookeventlog VALIDATE CONSTRAINT {LEGACY_BOUND_CHECK}"
+
+PARTITION_SQL = r"""
+DO $$
+DECLARE
+    next_id bigint;
+    cutover timestamptz := '__CUTOVER__';
+    r record;
+BEGIN
+    SELECT COALESCE(MAX(id), 0) + 1 INTO next_id FROM meta_integration_webhookeventlog;
+
+    ALTER TABLE meta_integration_webhookeventlog RENAME TO meta_integration_webhookeventlog_legacy;
+    ALTER TABLE meta_integration_webhookeventlog_legacy
+        RENAME CONSTRAINT meta_integration_webhookeventlog_pkey TO meta_integration_webhookeventlog_legacy_pkey;
+    ALTER TABLE meta_integration_webhookeventlog_legacy ALTER COLUMN id DROP IDENTITY IF EXISTS;
+    ALTER TABLE meta_integration_webhookeventlog_legacy ALTER COLUMN id DROP DEFAULT;
+
+    CREATE TABLE meta_integration_webhookeventlog (LIKE meta_integration_webhookeventlog_legacy INCLUDING DEFAULTS)
+        PARTITION BY RANGE (received_at);
+    EXECUTE format('ALTER TABLE meta_integration_webhookeventlog ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (START WITH %s)', next_id);
+    ALTER TABLE meta_integration_webhookeventlog
+        ADD CONSTRAINT meta_integration_webhookeventlog_pkey PRIMARY KEY (id, received_at);
+
+    -- Secondary indexes move to the parent under their original names (they apply to every partition).
+    FOR r IN
+        SELECT idx.relname AS name, pg_get_indexdef(i.indexrelid) AS def
+        FROM pg_index i JOIN pg_class idx ON idx.oid = i.indexrelid
+        WHERE i.indrelid = 'meta_integration_webhookeventlog_legacy'::regclass
+          AND NOT i.indisprimary AND NOT i.indisunique
+    LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', r.name, left(r.name, 56) || '_legacy');
+        EXECUTE regexp_replace(r.def, ' ON \S+ USING ', ' ON meta_integration_webhookeventlog USING ');
+    END LOOP;
+
+    FOR r IN
+        SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+        WHERE conrelid = 'meta_integration_webhookeventlog_legacy'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE meta_integration_webhookeventlog ADD CONSTRAINT %I %s', r.conname, r.def);
+    END LOOP;
+
+    EXECUTE format(
+        'ALTER TABLE meta_integration_webhookeventlog ATTACH PARTITION meta_integration_webhookeventlog_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        cutover
+    );
+    ALTER TABLE meta_integration_webhookeventlog_legacy DROP CONSTRAINT meta_integration_webhookeventlog_legacy_bound;
+    CREATE TABLE meta_integration_webhookeventlog_default PARTITION OF meta_integration_webhookeventlog DEFAULT;
+END $$;
+"""
+
+# Reverse: copies every partition back into a plain table with the original primary key, indexes and
+# foreign keys. Duplicate event keys (possible once 0005's key table is gone) are removed first so
+# 0002's unique constraint can be restored.
+UNPARTITION_SQL = r"""
+DO $$
+DECLARE
+    next_id bigint;
+    r record;
+BEGIN
+    SELECT COALESCE(MAX(id), 0) + 1 INTO next_id FROM meta_integration_webhookeventlog;
+
+    ALTER TABLE meta_integration_webhookeventlog RENAME TO meta_integration_webhookeventlog_partitioned;
+    ALTER TABLE meta_integration_webhookeventlog_partitioned
+        RENAME CONSTRAINT meta_integration_webhookeventlog_pkey TO meta_integration_webhookeventlog_partitioned_pkey;
+
+    CREATE TABLE meta_integration_webhookeventlog (LIKE meta_integration_webhookeventlog_partitioned INCLUDING DEFAULTS);
+    ALTER TABLE meta_integration_webhookeventlog ALTER COLUMN id DROP IDENTITY IF EXISTS;
+    INSERT INTO meta_integration_webhookeventlog SELECT * FROM meta_integration_webhookeventlog_partitioned;
+    EXECUTE format('ALTER TABLE meta_integration_webhookeventlog ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (START WITH %s)', next_id);
+    ALTER TABLE meta_integration_webhookeventlog ADD CONSTRAINT meta_integration_webhookeventlog_pkey PRIMARY KEY (id);
+
+    DELETE FROM meta_integration_webhookeventlog log USING meta_integration_webhookeventlog newer
+    WHERE log.app_config_id = newer.app_config_id AND log.event_identifier = newer.event_identifier AND log.id < newer.id;
+
+    FOR r IN
+        SELECT idx.relname AS name, pg_get_indexdef(i.indexrelid) AS def
+        FROM pg_index i JOIN pg_class idx ON idx.oid = i.indexrelid
+        WHERE i.indrelid = 'meta_integration_webhookeventlog_partitioned'::regclass
+          AND NOT i.indisprimary AND NOT i.indisunique
+    LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', r.name, left(r.name, 51) || '_partitioned');
+        EXECUTE regexp_replace(regexp_replace(r.def, ' ON ONLY ', ' ON '), ' ON \S+ USING ', ' ON meta_integration_webhookeventlog USING ');
+    END LOOP;
+
+    FOR r IN
+        SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+        WHERE conrelid = 'meta_integration_webhookeventlog_partitioned'::regclass AND contype = 'f' AND conparentid = 0
+    LOOP
+        EXECUTE format('ALTER TABLE meta_integration_webhookeventlog_partitioned DROP CONSTRAINT %I', r.conname);
+        EXECUTE format('ALTER TABLE meta_integration_webhookeventlog ADD CONSTRAINT %I %s', r.conname, r.def);
+    END LOOP;
+
+    DROP TABLE meta_integration_webhookeventlog_partitioned;
+END $$;
+"""
+
+
+def partition_webhook_event_log(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return # Partitioning is PostgreSQL-only; other databases keep the plain table.
+    cutover = (datetime.now(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=2)).isoformat()
+
+    # Non-atomic migration: the check is added and validated in their own transactions, before the swap.
+    with transaction.atomic():
+        schema_editor.execute(ADD_BOUND_CHECK_SQL.replace('__CUTOVER__', cutover), params=None)
+    with transaction.atomic():
+        schema_editor.execute(VALIDATE_BOUND_CHECK_SQL, params=None)
+
+    from meta_integration.partitions import ensure_partitions
+    with transaction.atomic():
+        schema_editor.execute(PARTITION_SQL.replace('__CUTOVER__', cutover), params=None)
+        ensure_partitions()
+
+
+def unpartition_webhook_event_log(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with transaction.atomic():
+        schema_editor.execute(UNPARTITION_SQL, params=None)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('meta_integration', '0002_webhookeventlog_unique_event_per_config'),
+    ]
+
+    operations = [
+        # A unique constraint on a partitioned table must include the partition key, which would make it useless
+        # for deduplication. The key is enforced by the unpartitioned WebhookEventKey table instead (0005).
+        migrations.RemoveConstraint(
+            model_name='webhookeventlog',
+            name='unique_webhook_event_per_config',
+        ),
+        migrations.RunPython(partition_webhook_event_log, unpartition_webhook_event_log),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-17 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta_integration', '0003_partition_webhookeventlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayloadBlob',
+            fields=[
+                ('digest', models.CharField(help_text='SHA-256 of the canonical JSON.', max_length=64, primary_key=True, serialize=False)),
+                ('codec', models.CharField(default='zlib', max_length=10)),
+                ('data', models.BinaryField(help_text='Compressed canonical JSON.')),
+                ('size', models.PositiveIntegerField(help_text='Uncompressed size in bytes.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Payload Blob',
+                'verbose_name_plural': 'Payload Blobs',
+            },
+        ),
+        migrations.AddField(
+            model_name='webhookeventlog',
+            name='payload_blob',
+            field=models.ForeignKey(blank=True, help_text='Compressed JSON payload received from Meta.', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='meta_integration.payloadblob'),
+        ),
+    ]
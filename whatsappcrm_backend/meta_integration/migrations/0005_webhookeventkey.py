@@ -0,0 +1,49 @@
+# Generated by Django 5.1.7 on 2026-10-18 10:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_event_keys(apps, schema_editor):
+    """Creates the key of every logged event, dated by its earliest log row."""
+    WebhookEventLog = apps.get_model('meta_integration', 'WebhookEventLog')
+    WebhookEventKey = apps.get_model('meta_integration', 'WebhookEventKey')
+    first_seen = (
+        WebhookEventLog.objects
+        .filter(app_config__isnull=False, event_identifier__isnull=False)
+        .values('app_config_id', 'event_identifier')
+        .annotate(received_at=models.Min('received_at'))
+        .order_by()
+    )
+    batch = []
+    for row in first_seen.iterator():
+        batch.append(WebhookEventKey(**row))
+        if len(batch) >= 5000:
+            WebhookEventKey.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    WebhookEventKey.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta_integration', '0004_payloadblob_webhookeventlog_payload_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEventKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_identifier', models.CharField(max_length=255)),
+                ('received_at', models.DateTimeField(db_index=True, help_text="When the event was first logged (lower bound of the log row's received_at).")),
+                ('app_config', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='meta_integration.metaappconfig')),
+            ],
+            options={
+                'verbose_name': 'Webhook Event Key',
+                'verbose_name_plural': 'Webhook Event Keys',
+                'constraints': [models.UniqueConstraint(fields=('app_config', 'event_identifier'), name='unique_webhook_event_key_per_config')],
+            },
+        ),
+        migrations.RunPython(backfill_event_keys, migrations.RunPython.noop),
+    ]
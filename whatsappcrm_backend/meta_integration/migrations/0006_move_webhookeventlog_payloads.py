@@ -0,0 +1,89 @@
+# Generated by Django 5.1.7 on 2026-10-18 11:40
+
+import hashlib
+import json
+import zlib
+
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 1000
+
+
+# Frozen copy of the payload_store encoding as of this migration; later changes there must not alter it.
+def encode(payload):
+    raw = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest(), 'zlib', zlib.compress(raw, 6), len(raw)
+
+
+def decode(codec, data):
+    if codec != 'zlib':
+        raise ValueError(f"Unknown payload codec '{codec}'.")
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+def move_payloads(apps, schema_editor):
+    """Copies each log row's JSON payload into the blob store. Every batch commits on its own."""
+    PayloadBlob = apps.get_model('meta_integration', 'PayloadBlob')
+    WebhookEventLog = apps.get_model('meta_integration', 'WebhookEventLog')
+    using = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        batch = list(
+            WebhookEventLog.objects.using(using)
+            .filter(pk__gt=last_pk, payload_blob__isnull=True, payload__isnull=False)
+            .order_by('pk').only('pk', 'payload')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        blobs = {}
+        for log in batch:
+            digest, codec, data, size = encode(log.payload)
+            blobs.setdefault(digest, PayloadBlob(digest=digest, codec=codec, data=data, size=size))
+            log.payload_blob_id = digest
+        with transaction.atomic(using=using):
+            PayloadBlob.objects.using(using).bulk_create(blobs.values(), ignore_conflicts=True)
+            WebhookEventLog.objects.using(using).bulk_update(batch, ['payload_blob'])
+        last_pk = batch[-1].pk
+
+
+def restore_payloads(apps, schema_editor):
+    """Writes each log row's blob back into its JSON column. Rows without a blob get an empty object."""
+    PayloadBlob = apps.get_model('meta_integration', 'PayloadBlob')
+    WebhookEventLog = apps.get_model('meta_integration', 'WebhookEventLog')
+    using = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        batch = list(
+            WebhookEventLog.objects.using(using)
+            .filter(pk__gt=last_pk, payload__isnull=True)
+            .order_by('pk').only('pk', 'payload_blob')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        digests = {log.payload_blob_id for log in batch if log.payload_blob_id}
+        blobs = PayloadBlob.objects.using(using).in_bulk(digests)
+        for log in batch:
+            blob = blobs.get(log.payload_blob_id)
+            log.payload = decode(blob.codec, blob.data) if blob is not None else {}
+        with transaction.atomic(using=using):
+            WebhookEventLog.objects.using(using).bulk_update(batch, ['payload'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+    # Each batch commits separately, so a large table is neither locked nor rewritten in one transaction.
+    atomic = False
+
+    dependencies = [
+        ('meta_integration', '0005_webhookeventkey'),
+    ]
+
+    operations = [
+        # Nullable while both representations exist; the reverse restores NOT NULL once the JSON is back.
+        migrations.AlterField(
+            model_name='webhookeventlog',
+            name='payload',
+            field=models.JSONField(help_text='Full JSON payload received from Meta.', null=True),
+        ),
+        migrations.RunPython(move_payloads, restore_payloads),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-18 11:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta_integration', '0006_move_webhookeventlog_payloads'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='webhookeventlog',
+            name='payload',
+        ),
+    ]
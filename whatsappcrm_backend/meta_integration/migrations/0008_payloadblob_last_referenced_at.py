@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 12:15
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meta_integration', '0007_remove_webhookeventlog_payload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payloadblob',
+            name='last_referenced_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='Last time a row was pointed at this blob; orphans are pruned by it (see prune_orphaned_blobs).'),
+        ),
+    ]
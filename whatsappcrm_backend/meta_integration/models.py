@@ -2,9 +2,12 @@
 
 from django.db import models
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 # from conversations.models import Message # This is removed to prevent circular import
 import logging
 
+from .payload_store import PayloadProperty, PayloadStoreMixin, decode_payload
+
 logger = logging.getLogger(__name__)
 
 class MetaAppConfigManager(models.Manager):
@@ -82,7 +85,33 @@ class MetaAppConfig(models.Model):
         ordering = ['-is_active', 'name']
 
 
-class WebhookEventLog(models.Model):
+class PayloadBlob(models.Model):
+    """
+    A raw JSON payload stored once, compressed, keyed by the SHA-256 of its canonical serialization.
+    Referenced by WebhookEventLog.payload_blob and Message.payload_blob; see meta_integration.payload_store.
+    """
+    digest = models.CharField(max_length=64, primary_key=True, help_text="SHA-256 of the canonical JSON.")
+    codec = models.CharField(max_length=10, default='zlib')
+    data = models.BinaryField(help_text="Compressed canonical JSON.")
+    size = models.PositiveIntegerField(help_text="Uncompressed size in bytes.")
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_referenced_at = models.DateTimeField(
+        default=timezone.now, db_index=True,
+        help_text="Last time a row was pointed at this blob; orphans are pruned by it (see prune_orphaned_blobs)."
+    )
+
+    def load(self):
+        return decode_payload(self.codec, self.data)
+
+    def __str__(self):
+        return f"Payload {self.digest[:12]} ({self.size} bytes)"
+
+    class Meta:
+        verbose_name = "Payload Blob"
+        verbose_name_plural = "Payload Blobs"
+
+
+class WebhookEventLog(PayloadStoreMixin, models.Model):
     """
     Stores all incoming webhook events from Meta for auditing and reprocessing if needed.
     """
@@ -99,13 +128,12 @@ class WebhookEventLog(models.Model):
         ('unknown', 'Unknown Event Type'),
     ]
 
-    # --- THIS IS THE CORRECTED FIELD ---
-    # NOTE: unique=True was removed. It prevents logging multiple status updates
-    # for the same message (e.g., 'sent', 'delivered', 'read'), which all share
-    # the same WAMID. A management command `cleanup_logs` exists to handle duplicates.
+    # NOTE: Status events use '<wamid>_<status>' so that 'sent', 'delivered' and 'read' for the same
+    # message get separate rows. Identifiers are unique per app_config, but this can't be a database
+    # constraint on the partitioned table; WebhookEventKey holds the constraint instead.
     event_identifier = models.CharField(
         max_length=255, db_index=True, blank=True, null=True,
-        help_text="A non-unique identifier for the event (e.g., wamid for messages)."
+        help_text="Identifier of the event (e.g., wamid for messages), unique per app configuration."
     )
 
     app_config = models.ForeignKey(
@@ -132,7 +160,13 @@ class WebhookEventLog(models.Model):
         help_text="Categorized type of the webhook event."
     )
     payload_object_type = models.CharField(max_length=100, blank=True, null=True, help_text="The 'object' type from the webhook payload (e.g., 'whatsapp_business_account').")
-    payload = models.JSONField(help_text="Full JSON payload received from Meta.")
+    # DO_NOTHING: blobs are shared between rows and removed by payload_store.prune_orphaned_blobs(),
+    # which relies on the database constraint rather than Django's collector.
+    payload_blob = models.ForeignKey(
+        PayloadBlob, on_delete=models.DO_NOTHING, null=True, blank=True, related_name='+',
+        help_text="Compressed JSON payload received from Meta."
+    )
+    payload = PayloadProperty('payload_blob', doc="Full JSON payload received from Meta.")
     received_at = models.DateTimeField(auto_now_add=True, db_index=True)
     processed_at = models.DateTimeField(null=True, blank=True, help_text="Timestamp when the event was processed by a handler.")
     processing_status = models.CharField(
@@ -147,6 +181,9 @@ class WebhookEventLog(models.Model):
         return f"{self.get_event_type_display()} ({self.event_identifier or 'N/A'}) at {self.received_at.strftime('%Y-%m-%d %H:%M:%S')}"
 
     class Meta:
+        # On PostgreSQL the table is partitioned by RANGE (received_at) (migration 0003); partitions are
+        # created and expired by meta_integration.partitions. Filter on received_at where possible so
+        # queries only touch the relevant partitions.
         verbose_name = "Webhook Event Log"
         verbose_name_plural = "Webhook Event Logs"
         ordering = ['-received_at']
@@ -154,3 +191,25 @@ class WebhookEventLog(models.Model):
             models.Index(fields=['event_type', 'received_at']),
             models.Index(fields=['processing_status', 'event_type']),
         ]
+
+
+class WebhookEventKey(models.Model):
+    """
+    The unique (app_config, event_identifier) key of each WebhookEventLog row. The log table is
+    partitioned by received_at and can't enforce it, so WebhookProcessor inserts the key first
+    (INSERT ... ON CONFLICT DO NOTHING): concurrent deliveries of the same event can then create
+    only one log row. Expired with the log partitions.
+    """
+    app_config = models.ForeignKey(MetaAppConfig, on_delete=models.CASCADE, related_name='+')
+    event_identifier = models.CharField(max_length=255)
+    received_at = models.DateTimeField(db_index=True, help_text="When the event was first logged (lower bound of the log row's received_at).")
+
+    def __str__(self):
+        return f"{self.event_identifier} ({self.app_config_id})"
+
+    class Meta:
+        verbose_name = "Webhook Event Key"
+        verbose_name_plural = "Webhook Event Keys"
+        constraints = [
+            models.UniqueConstraint(fields=['app_config', 'event_identifier'], name='unique_webhook_event_key_per_config'),
+        ]
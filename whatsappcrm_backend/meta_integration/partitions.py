@@ -0,0 +1,194 @@
+# whatsappcrm_backend/meta_integration/partitions.py
+"""
+Maintenance of the time-partitioned WebhookEventLog table (PostgreSQL declarative partitioning
+by RANGE (received_at), set up by migration 0003).
+
+Partitions are contiguous: each new one starts where the newest existing one ends. Expired
+partitions are detached and dropped whole, which is O(1) compared with deleting rows.
+
+Rows outside every range (if maintenance fell behind) land in the DEFAULT partition. They are moved
+into their range partition when it is created, and deleted from it once past retention.
+"""
+import logging
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger('meta_integration')
+
+PARENT_TABLE = 'meta_integration_webhookeventlog'
+DEFAULT_PARTITION = f'{PARENT_TABLE}_default'
+INTERVALS = {'day': timedelta(days=1), 'week': timedelta(weeks=1)}
+
+_BOUND_RE = re.compile(r"FOR VALUES FROM \((?P<lower>[^)]*)\) TO \((?P<upper>[^)]*)\)")
+
+
+class Partition(NamedTuple):
+    name: str
+    lower: Optional[datetime] # None for MINVALUE
+    upper: Optional[datetime] # None for MAXVALUE
+
+
+def _interval() -> timedelta:
+    return INTERVALS[getattr(settings, 'WEBHOOK_LOG_PARTITION_INTERVAL', 'week')]
+
+
+def _parse_bound(value: str) -> Optional[datetime]:
+    value = value.strip().strip("'")
+    if value.upper() in ('MINVALUE', 'MAXVALUE'):
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=dt_timezone.utc)
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [PARENT_TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions() -> List[Partition]:
+    """Returns the partitions of the table, oldest first."""
+    # Bounds are rendered in the session time zone, which Django sets to UTC (USE_TZ = True).
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = to_regclass(%s)
+            """,
+            [PARENT_TABLE]
+        )
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        if bound == 'DEFAULT':
+            continue
+        match = _BOUND_RE.search(bound or '')
+        if not match:
+            logger.warning(f"Skipping partition {name} with unexpected bound: {bound}")
+            continue
+        partitions.append(Partition(name, _parse_bound(match.group('lower')), _parse_bound(match.group('upper'))))
+    return sorted(partitions, key=lambda p: p.lower or datetime.min.replace(tzinfo=dt_timezone.utc))
+
+
+@transaction.atomic
+def ensure_partitions(ahead: Optional[int] = None, dry_run: bool = False) -> List[str]:
+    """
+    Creates partitions until the table covers `ahead` intervals (WEBHOOK_LOG_PARTITIONS_AHEAD) past now.
+    Returns the names of the partitions created.
+    """
+    if ahead is None:
+        ahead = getattr(settings, 'WEBHOOK_LOG_PARTITIONS_AHEAD', 4)
+    interval = _interval()
+    now = datetime.now(dt_timezone.utc)
+    covered_until = now + interval * ahead
+
+    partitions = list_partitions()
+    bounded = [p.upper for p in partitions if p.upper is not None]
+    if not bounded:
+        # No partitions yet: start at the beginning of the current UTC day.
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start = max(bounded)
+
+    created = []
+    while start < covered_until:
+        end = start + interval
+        name = f"{PARENT_TABLE}_p{start:%Y%m%d}"
+        if not dry_run:
+            _create_partition(name, start, end)
+        logger.info(f"{'Would create' if dry_run else 'Created'} WebhookEventLog partition {name} [{start.isoformat()}, {end.isoformat()}).")
+        created.append(name)
+        start = end
+    return created
+
+
+def _default_partition_exists(cursor) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [DEFAULT_PARTITION])
+    return cursor.fetchone()[0]
+
+
+def _create_partition(name: str, start: datetime, end: datetime) -> None:
+    """
+    Creates the partition for [start, end). PostgreSQL refuses this while the DEFAULT partition holds
+    rows of the range, so those are taken out first and inserted again through the parent.
+    """
+    with connection.cursor() as cursor:
+        moved = 0
+        if _default_partition_exists(cursor):
+            cursor.execute(
+                f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE received_at >= %s AND received_at < %s)', [start, end]
+            )
+            if cursor.fetchone()[0]:
+                cursor.execute(f'CREATE TEMPORARY TABLE webhookeventlog_moved (LIKE "{PARENT_TABLE}") ON COMMIT DROP')
+                cursor.execute(
+                    f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE received_at >= %s AND received_at < %s RETURNING *) '
+                    f'INSERT INTO webhookeventlog_moved SELECT * FROM moved',
+                    [start, end]
+                )
+                moved = cursor.rowcount
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{PARENT_TABLE}" FOR VALUES FROM (%s) TO (%s)', [start, end]
+        )
+        if moved:
+            cursor.execute(f'INSERT INTO "{PARENT_TABLE}" SELECT * FROM webhookeventlog_moved')
+            cursor.execute('DROP TABLE webhookeventlog_moved')
+            logger.warning(f"Moved {moved} WebhookEventLog rows from the default partition into {name}.")
+
+
+def drop_expired_partitions(retention_days: Optional[int] = None, detach_only: Optional[bool] = None, dry_run: bool = False) -> List[str]:
+    """
+    Detaches, and unless `detach_only` drops, every partition whose rows are all older than the retention
+    period (WEBHOOK_LOG_RETENTION_DAYS). Returns the names of the partitions removed.
+    """
+    if retention_days is None:
+        retention_days = getattr(settings, 'WEBHOOK_LOG_RETENTION_DAYS', 90)
+    if detach_only is None:
+        detach_only = getattr(settings, 'WEBHOOK_LOG_DETACH_ONLY', False)
+    cutoff = datetime.now(dt_timezone.utc) - timedelta(days=retention_days)
+
+    removed = []
+    for partition in list_partitions():
+        if partition.upper is None or partition.upper > cutoff:
+            continue
+        if not dry_run:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{partition.name}"')
+                if not detach_only:
+                    cursor.execute(f'DROP TABLE "{partition.name}"')
+        verb = ('Would detach' if detach_only else 'Would drop') if dry_run else ('Detached' if detach_only else 'Dropped')
+        logger.info(f"{verb} expired WebhookEventLog partition {partition.name} (ends {partition.upper.isoformat()}).")
+        removed.append(partition.name)
+        removed_until = partition.upper
+
+    if not dry_run:
+        with transaction.atomic(), connection.cursor() as cursor:
+            if _default_partition_exists(cursor):
+                cursor.execute(f'DELETE FROM "{DEFAULT_PARTITION}" WHERE received_at < %s', [cutoff])
+                if cursor.rowcount:
+                    logger.warning(f"Deleted {cursor.rowcount} expired WebhookEventLog rows from the default partition.")
+
+    if removed and not dry_run:
+        # Keys of events whose log rows are gone; a redelivery of one is logged as a new event.
+        from .models import WebhookEventKey
+        deleted, _ = WebhookEventKey.objects.filter(received_at__lt=removed_until).delete()
+        logger.info(f"Deleted {deleted} webhook event keys older than {removed_until.isoformat()}.")
+    return removed
+
+
+def maintain_partitions(dry_run: bool = False) -> dict:
+    """Creates upcoming partitions and removes expired ones. Does nothing if the table isn't partitioned."""
+    if not is_partitioned():
+        logger.warning(f"{PARENT_TABLE} is not partitioned (requires PostgreSQL and migration 0003). Skipping partition maintenance.")
+        return {'created': [], 'removed': []}
+    return {'created': ensure_partitions(dry_run=dry_run), 'removed': drop_expired_partitions(dry_run=dry_run)}
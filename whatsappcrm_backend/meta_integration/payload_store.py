@@ -0,0 +1,183 @@
+# whatsappcrm_backend/meta_integration/payload_store.py
+"""
+Compressed, content-addressed storage for raw JSON payloads (webhook events, message bodies).
+
+A payload is serialized canonically, keyed by the SHA-256 of that serialization and stored once,
+zlib-compressed, as a PayloadBlob row. Models keep a foreign key to the blob and expose the old
+attribute name (e.g. `Message.content_payload`) through a `PayloadProperty`, which decompresses
+lazily on first access and accepts plain dicts on assignment or as a constructor kwarg.
+Columns that are filtered on (message type, wamid, text_content, ...) stay real columns.
+
+Payloads assigned to an instance are written by `PayloadStoreMixin.save()`. Code that bypasses
+save() (bulk_create/bulk_update) must call `store_payloads()` on the instances first.
+"""
+import hashlib
+import json
+import logging
+import zlib
+from datetime import timedelta
+from typing import Iterable, NamedTuple, Optional, Set
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.utils import timezone
+
+logger = logging.getLogger('meta_integration')
+
+CODEC_ZLIB = 'zlib'
+_COMPRESSION_LEVEL = 6
+
+
+class EncodedPayload(NamedTuple):
+    digest: str
+    codec: str
+    data: bytes
+    size: int
+
+
+def _serialize(payload) -> bytes:
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, cls=DjangoJSONEncoder).encode('utf-8')
+
+
+def payload_digest(payload) -> str:
+    return hashlib.sha256(_serialize(payload)).hexdigest()
+
+
+def encode_payload(payload) -> EncodedPayload:
+    raw = _serialize(payload)
+    return EncodedPayload(hashlib.sha256(raw).hexdigest(), CODEC_ZLIB, zlib.compress(raw, _COMPRESSION_LEVEL), len(raw))
+
+
+def decode_payload(codec: str, data) -> object:
+    if codec != CODEC_ZLIB:
+        raise ValueError(f"Unknown payload codec '{codec}'.")
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+_UNSAVED = object() # Marks a cached payload that was assigned rather than loaded from a blob
+
+
+class PayloadProperty(property):
+    """
+    Exposes the payload referenced by the `blob_field` foreign key as a plain Python value.
+    Subclasses `property` so Django accepts it as a model constructor kwarg and DRF serializes it.
+    """
+
+    def __init__(self, blob_field: str, doc: Optional[str] = None):
+        self.blob_field = blob_field
+        self.cache_attr = f'_{blob_field}_payload'
+        super().__init__(self._get, self._set, doc=doc)
+
+    def _get(self, instance):
+        cached = instance.__dict__.get(self.cache_attr)
+        blob_id = getattr(instance, f'{self.blob_field}_id')
+        # Cache is keyed by the blob it came from, so refresh_from_db() or a new blob reference reloads it.
+        if cached is not None and (cached[0] is _UNSAVED or cached[0] == blob_id):
+            return cached[1]
+        blob = getattr(instance, self.blob_field) if blob_id else None
+        value = blob.load() if blob is not None else None
+        instance.__dict__[self.cache_attr] = (blob_id, value)
+        return value
+
+    def _set(self, instance, value):
+        instance.__dict__[self.cache_attr] = (_UNSAVED, value)
+
+
+def _payload_properties(model) -> list:
+    properties = model.__dict__.get('_payload_properties_cache')
+    if properties is None:
+        properties = []
+        for klass in model.__mro__:
+            properties.extend(attr for attr in vars(klass).values() if isinstance(attr, PayloadProperty))
+        model._payload_properties_cache = properties
+    return properties
+
+
+def store_payloads(instances: Iterable) -> Set[str]:
+    """
+    Writes every payload assigned to (or read and possibly mutated on) `instances` to the blob store with
+    a single INSERT ... ON CONFLICT DO UPDATE, and points each instance's foreign key at its blob.
+    The update bumps `last_referenced_at` of blobs that already exist, and its row lock holds off a
+    concurrent prune until this transaction ends. Returns the names of the foreign key fields that changed.
+    """
+    from .models import PayloadBlob
+
+    now = timezone.now()
+    blobs = {}
+    changed_fields = set()
+    for instance in instances:
+        for prop in _payload_properties(type(instance)):
+            cached = instance.__dict__.get(prop.cache_attr)
+            if cached is None:
+                continue # Never touched: the stored reference is current.
+            blob_id_attr = f'{prop.blob_field}_id'
+            value = cached[1]
+            if value is None:
+                if getattr(instance, blob_id_attr) is not None:
+                    setattr(instance, blob_id_attr, None)
+                    changed_fields.add(prop.blob_field)
+                continue
+            digest = payload_digest(value)
+            if digest != getattr(instance, blob_id_attr):
+                if digest not in blobs:
+                    encoded = encode_payload(value)
+                    blobs[digest] = PayloadBlob(
+                        digest=digest, codec=encoded.codec, data=encoded.data, size=encoded.size, last_referenced_at=now
+                    )
+                setattr(instance, blob_id_attr, digest)
+                changed_fields.add(prop.blob_field)
+            instance.__dict__[prop.cache_attr] = (digest, value)
+
+    if blobs:
+        PayloadBlob.objects.bulk_create(
+            blobs.values(), update_conflicts=True, unique_fields=['digest'], update_fields=['last_referenced_at']
+        )
+    return changed_fields
+
+
+class PayloadStoreMixin:
+    """Model mixin that writes pending PayloadProperty values to the blob store on save()."""
+
+    def save(self, *args, **kwargs):
+        changed_fields = store_payloads([self])
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and changed_fields:
+            kwargs['update_fields'] = {*update_fields, *changed_fields}
+        super().save(*args, **kwargs)
+
+
+def prune_orphaned_blobs(min_age_hours: int = 24, dry_run: bool = False) -> int:
+    """
+    Deletes blobs no longer referenced by any model, e.g. after WebhookEventLog partitions expire or
+    old messages are deleted. Only blobs not referenced for `min_age_hours` are candidates.
+    Returns the number of blobs deleted (or that would be).
+
+    The age and reference checks are part of the DELETE itself, so they are re-evaluated on each row it
+    locks: a blob that `store_payloads` is re-using (and has bumped) in a transaction still in flight is
+    waited for and then skipped, and one deleted first is simply inserted again by the writer.
+    """
+    from conversations.models import Message
+    from .models import PayloadBlob, WebhookEventLog
+
+    cutoff = timezone.now() - timedelta(hours=min_age_hours)
+    if dry_run:
+        from django.db.models import Exists, OuterRef
+        return PayloadBlob.objects.filter(last_referenced_at__lt=cutoff).exclude(
+            Exists(Message.objects.filter(payload_blob=OuterRef('pk')))
+        ).exclude(
+            Exists(WebhookEventLog.objects.filter(payload_blob=OuterRef('pk')))
+        ).count()
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            DELETE FROM {PayloadBlob._meta.db_table} AS blob
+            WHERE blob.last_referenced_at < %s
+              AND NOT EXISTS (SELECT 1 FROM {Message._meta.db_table} WHERE payload_blob_id = blob.digest)
+              AND NOT EXISTS (SELECT 1 FROM {WebhookEventLog._meta.db_table} WHERE payload_blob_id = blob.digest)
+            """,
+            [cutoff],
+        )
+        deleted = cursor.rowcount
+    logger.info(f"Pruned {deleted} orphaned payload blobs.")
+    return deleted
@@ -0,0 +1,168 @@
+# whatsappcrm_backend/meta_integration/rate_limiter.py
+"""
+Cluster-wide send rate limiter for the Cloud API, one budget per phone_number_id shared by all workers.
+
+Every send takes a token from the phone number's bucket (META_SEND_RATE_LIMIT_PER_SECOND, bursting to
+META_SEND_RATE_LIMIT_BURST). Broadcast sends must also take one from the broadcast bucket
+(META_SEND_BROADCAST_RATE_LIMIT_PER_SECOND), so a broadcast can never use the share left for
+conversations.
+
+Both rates are scaled by an adaptive factor: a throughput error from Meta (130429 etc.) halves it
+and pauses the number for META_SEND_RATE_LIMIT_COOLDOWN_SECONDS, and it recovers linearly by
+META_SEND_RATE_LIMIT_RECOVERY_PER_SECOND. Sends run near the real limit of the tier without
+repeatedly running into it. If Redis is unavailable the limiter lets sends through.
+"""
+import logging
+from typing import Optional
+
+from django.conf import settings
+
+from whatsappcrm_backend.redis_client import get_redis_client
+
+logger = logging.getLogger('meta_integration')
+
+LANE_CONVERSATIONAL = 'conversational'
+LANE_BROADCAST = 'broadcast'
+
+BUCKET_KEY = "meta:ratelimit:{phone_number_id}:{bucket}"
+FACTOR_KEY = "meta:ratelimit:{phone_number_id}:factor"
+COOLDOWN_KEY = "meta:ratelimit:{phone_number_id}:cooldown"
+
+# Meta error codes meaning the phone number / account / app is sending too fast.
+THROUGHPUT_ERROR_CODES = {4, 80007, 130429, 131048}
+# Too many messages to the same user: only that contact has to slow down.
+PAIR_RATE_LIMIT_ERROR_CODE = 131056
+
+# Current adaptive factor, recovered linearly since its last change. Shared by both scripts.
+_FACTOR_LUA = """
+local now_t = redis.call('time')
+local now = tonumber(now_t[1]) + tonumber(now_t[2]) / 1000000
+local factor_state = redis.call('hmget', KEYS[1], 'value', 'ts')
+local factor = 1
+if factor_state[1] then
+    factor = math.min(1, tonumber(factor_state[1]) + (now - tonumber(factor_state[2])) * tonumber(ARGV[1]))
+end
+"""
+# KEYS: factor, cooldown, bucket... ARGV: recovery per second, then (rate, burst) per bucket.
+# Takes one token from every bucket, or none. Returns 0, or the milliseconds to wait before trying again.
+_ACQUIRE_SCRIPT = _FACTOR_LUA + """
+local wait = 0
+local cooldown = redis.call('pttl', KEYS[2])
+if cooldown > 0 then
+    wait = cooldown / 1000
+end
+local levels = {}
+for i = 3, #KEYS do
+    local rate = tonumber(ARGV[(i - 2) * 2]) * factor
+    local burst = tonumber(ARGV[(i - 2) * 2 + 1])
+    local state = redis.call('hmget', KEYS[i], 'tokens', 'ts')
+    local tokens = burst
+    if state[1] then
+        tokens = math.min(burst, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate)
+    end
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+local taken = 0
+if wait == 0 then
+    taken = 1
+end
+for i = 3, #KEYS do
+    redis.call('hset', KEYS[i], 'tokens', tostring(levels[i] - taken), 'ts', tostring(now))
+    redis.call('expire', KEYS[i], 60)
+end
+return math.ceil(wait * 1000)
+"""
+# KEYS: factor, cooldown. ARGV: recovery per second, min factor, cooldown ms.
+# Throttles arriving while the number is already cooling down come from sends that were in flight
+# before the first one, so they don't cut the rate again.
+_THROTTLED_SCRIPT = _FACTOR_LUA + """
+if redis.call('exists', KEYS[2]) == 1 then
+    return tostring(factor)
+end
+factor = math.max(tonumber(ARGV[2]), factor / 2)
+redis.call('hset', KEYS[1], 'value', tostring(factor), 'ts', tostring(now))
+redis.call('expire', KEYS[1], 3600)
+redis.call('set', KEYS[2], 1, 'px', ARGV[3])
+return tostring(factor)
+"""
+
+
+class MetaRateLimitError(Exception):
+    """Meta rejected a send because of a rate limit; the message was not sent and can be retried after `retry_after` seconds."""
+
+    def __init__(self, code: int, retry_after: float):
+        super().__init__(f"Meta rate limit error {code}")
+        self.code = code
+        self.retry_after = retry_after
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def _cooldown_seconds() -> float:
+    return _setting('META_SEND_RATE_LIMIT_COOLDOWN_SECONDS', 1)
+
+
+def acquire_send_token(phone_number_id: str, lane: str = LANE_CONVERSATIONAL) -> float:
+    """
+    Takes a send token for the phone number. Returns 0 if the message may be sent now, otherwise
+    the seconds to wait before asking again (nothing is taken in that case).
+    """
+    rate = _setting('META_SEND_RATE_LIMIT_PER_SECOND', 80)
+    if not rate or not phone_number_id:
+        return 0
+    keys = [
+        FACTOR_KEY.format(phone_number_id=phone_number_id),
+        COOLDOWN_KEY.format(phone_number_id=phone_number_id),
+        BUCKET_KEY.format(phone_number_id=phone_number_id, bucket='all'),
+    ]
+    args = [_setting('META_SEND_RATE_LIMIT_RECOVERY_PER_SECOND', 0.05), rate, _setting('META_SEND_RATE_LIMIT_BURST', rate)]
+    broadcast_rate = _setting('META_SEND_BROADCAST_RATE_LIMIT_PER_SECOND', 60)
+    if lane == LANE_BROADCAST and broadcast_rate:
+        keys.append(BUCKET_KEY.format(phone_number_id=phone_number_id, bucket=LANE_BROADCAST))
+        args.extend([broadcast_rate, min(broadcast_rate, args[2])])
+    try:
+        wait_ms = get_redis_client().eval(_ACQUIRE_SCRIPT, len(keys), *keys, *args)
+    except Exception as e:
+        logger.warning(f"Send rate limiter unavailable for phone number {phone_number_id}: {e}. Sending without it.")
+        return 0
+    return wait_ms / 1000
+
+
+def record_rate_limited(phone_number_id: str) -> None:
+    """Halves the phone number's send rate (down to META_SEND_RATE_LIMIT_MIN_FACTOR) and pauses its sends briefly."""
+    try:
+        factor = get_redis_client().eval(
+            _THROTTLED_SCRIPT, 2,
+            FACTOR_KEY.format(phone_number_id=phone_number_id), COOLDOWN_KEY.format(phone_number_id=phone_number_id),
+            _setting('META_SEND_RATE_LIMIT_RECOVERY_PER_SECOND', 0.05), _setting('META_SEND_RATE_LIMIT_MIN_FACTOR', 0.1),
+            int(_cooldown_seconds() * 1000),
+        )
+        logger.warning(f"Meta throttled phone number {phone_number_id}; send rate now at {float(factor):.0%} of the configured limit.")
+    except Exception as e:
+        logger.warning(f"Could not record throttling of phone number {phone_number_id}: {e}")
+
+
+def rate_limit_error_code(api_response) -> Optional[int]:
+    """The Meta error code of a send response if it is a rate-limit error, else None."""
+    if not isinstance(api_response, dict) or not isinstance(api_response.get('error'), dict):
+        return None
+    code = api_response['error'].get('code')
+    if code in THROUGHPUT_ERROR_CODES or code == PAIR_RATE_LIMIT_ERROR_CODE:
+        return code
+    return None
+
+
+def handle_rate_limit_response(api_response, phone_number_id: str) -> None:
+    """Raises MetaRateLimitError for a rate-limit error response, slowing the phone number down for throughput errors."""
+    code = rate_limit_error_code(api_response)
+    if code is None:
+        return
+    if code == PAIR_RATE_LIMIT_ERROR_CODE:
+        raise MetaRateLimitError(code, _setting('META_SEND_PAIR_RATE_LIMIT_BACKOFF_SECONDS', 10))
+    record_rate_limited(phone_number_id)
+    raise MetaRateLimitError(code, _cooldown_seconds())
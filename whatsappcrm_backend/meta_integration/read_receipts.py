@@ -0,0 +1,120 @@
+# whatsappcrm_backend/meta_integration/read_receipts.py
+"""
+Coalesces read receipts per contact. Marking a message as read also marks every earlier message
+in the chat as read, so when a contact sends several messages in a row only the newest wamid
+needs a receipt. The first message of a burst schedules one send after
+META_READ_RECEIPT_COALESCE_SECONDS; messages arriving until then only replace the pending wamid.
+"""
+import logging
+import time
+
+from django.conf import settings
+
+from whatsappcrm_backend.redis_client import get_redis_client
+
+logger = logging.getLogger('meta_integration')
+
+PENDING_RECEIPTS_KEY = "meta:read_receipts:pending"
+SCHEDULED_KEY = "meta:read_receipts:scheduled:{member}"
+RATE_KEY = "meta:read_receipts:rate:{second}"
+
+# Stores '<timestamp>|<wamid>' for the contact unless a newer message is already pending.
+# Ties go to the later arrival, as Meta's timestamps only have second resolution.
+_RECORD_RECEIPT_SCRIPT = """
+local current = redis.call('hget', KEYS[1], ARGV[1])
+if current then
+    local current_ts = tonumber(string.match(current, '^(%d+)|'))
+    if current_ts > tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2] .. '|' .. ARGV[3])
+return 1
+"""
+# Takes the pending wamid and clears the contact's schedule flag in one step, so messages
+# received after this point schedule a new receipt.
+_DRAIN_RECEIPT_SCRIPT = """
+local pending = redis.call('hget', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('del', KEYS[2])
+return pending
+"""
+
+
+def _coalesce_seconds() -> int:
+    return getattr(settings, 'META_READ_RECEIPT_COALESCE_SECONDS', 3)
+
+
+def _member(config_id: int, contact_wa_id: str) -> str:
+    return f"{config_id}:{contact_wa_id}"
+
+
+def _timestamp_value(message_timestamp) -> int:
+    return int(message_timestamp) if str(message_timestamp or '').isdigit() else int(time.time())
+
+
+def _store(client, member: str, message_timestamp: int, wamid: str) -> None:
+    client.eval(_RECORD_RECEIPT_SCRIPT, 1, PENDING_RECEIPTS_KEY, member, message_timestamp, wamid)
+
+
+def queue_read_receipt(wamid: str, config_id: int, contact_wa_id: str, message_timestamp=None) -> bool:
+    """
+    Makes `wamid` the contact's pending read receipt (unless a newer one is pending) and makes sure
+    a send is scheduled. Returns False if coalescing is disabled or Redis is unavailable, in which
+    case the caller should send the receipt directly.
+    """
+    from .tasks import send_coalesced_read_receipt_task
+
+    window = _coalesce_seconds()
+    if not window or not contact_wa_id:
+        return False
+    member = _member(config_id, contact_wa_id)
+    try:
+        client = get_redis_client()
+        _store(client, member, _timestamp_value(message_timestamp), wamid)
+        # The flag expires on its own in case the task is lost, so a receipt can't be stranded for long.
+        if client.set(SCHEDULED_KEY.format(member=member), 1, nx=True, ex=window + 60):
+            send_coalesced_read_receipt_task.apply_async(args=[config_id, contact_wa_id], countdown=window)
+        return True
+    except Exception as e:
+        logger.error(f"Could not coalesce read receipt for WAMID {wamid} in Redis: {e}. Sending it directly.", exc_info=True)
+        return False
+
+
+def take_pending_receipt(config_id: int, contact_wa_id: str):
+    """Removes and returns the contact's pending receipt as (message_timestamp, wamid), or None."""
+    member = _member(config_id, contact_wa_id)
+    pending = get_redis_client().eval(
+        _DRAIN_RECEIPT_SCRIPT, 2, PENDING_RECEIPTS_KEY, SCHEDULED_KEY.format(member=member), member
+    )
+    if not pending:
+        return None
+    message_timestamp, wamid = pending.split('|', 1)
+    return int(message_timestamp), wamid
+
+
+def requeue_receipt(config_id: int, contact_wa_id: str, message_timestamp: int, wamid: str) -> None:
+    """Puts back a receipt whose send failed, unless a newer message of the contact is already pending."""
+    _store(get_redis_client(), _member(config_id, contact_wa_id), message_timestamp, wamid)
+
+
+def acquire_send_slot() -> bool:
+    """
+    Fixed one-second window limit (META_READ_RECEIPT_RATE_LIMIT_PER_SECOND) shared by all workers,
+    so receipt bursts don't eat into the Graph API rate limit used by outgoing messages.
+    Fails open if Redis is unavailable.
+    """
+    limit = getattr(settings, 'META_READ_RECEIPT_RATE_LIMIT_PER_SECOND', 20)
+    if not limit:
+        return True
+    key = RATE_KEY.format(second=int(time.time()))
+    try:
+        client = get_redis_client()
+        pipe = client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, 2)
+        count, _ = pipe.execute()
+    except Exception as e:
+        logger.warning(f"Read receipt rate limiter unavailable: {e}. Sending without it.")
+        return True
+    return count <= limit
@@ -0,0 +1,185 @@
+# whatsappcrm_backend/meta_integration/replay.py
+"""
+Replays WebhookEventLog rows through the webhook ingestion path, e.g. to recover the events of an
+outage or to generate realistic load from production traffic.
+
+Rows are streamed in received_at order with a server-side cursor and handed to a pool of worker
+threads. Every row is routed by its contact (the sender of a message, the recipient of a status),
+so events of one contact are replayed strictly in order while different contacts run in parallel.
+
+Each row is rebuilt into a single-event Meta payload. By default it is processed in-process by
+WebhookProcessor in replay mode (no seen-set, already handled rows are processed again), keeping
+the row's event_identifier so the replay updates that row rather than logging a new event. With
+`target_url` it is instead POSTed, signed, to a webhook endpoint such as a local or staging stack,
+which assigns identifiers as for a live delivery.
+Point that stack's META_GRAPH_API_BASE_URL at a stand-in Graph API so replies never reach real users.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from typing import Iterable, Optional
+
+import requests
+from django.db import connections
+
+logger = logging.getLogger('meta_integration')
+
+# Rows in these states have not been (successfully) handled and are replayed by default.
+DEFAULT_REPLAY_STATUSES = ('pending', 'pending_reprocessing', 'error', 'failed')
+
+_PROGRESS_EVERY = 1000
+
+
+def build_payload(log_entry) -> Optional[dict]:
+    """Rebuilds the Meta webhook payload that carried a logged event, or None if the event type can't be replayed."""
+    data = log_entry.payload
+    if not isinstance(data, dict):
+        return None
+    event_type = log_entry.event_type or ''
+    metadata = {'phone_number_id': log_entry.phone_number_id_received}
+
+    if event_type == 'message_status':
+        field, value = 'messages', {'messaging_product': 'whatsapp', 'metadata': metadata, 'statuses': [data]}
+    elif event_type.startswith('message_'):
+        field, value = 'messages', {'messaging_product': 'whatsapp', 'metadata': metadata, 'messages': [data]}
+    elif event_type == 'error':
+        field, value = 'messages', {'messaging_product': 'whatsapp', 'metadata': metadata, 'errors': [data]}
+    elif event_type == 'account_update':
+        field, value = 'account_update', data
+    elif event_type == 'template_status':
+        field, value = 'message_template_status_update', data
+    else:
+        return None
+
+    return {
+        'object': 'whatsapp_business_account',
+        'entry': [{'id': log_entry.waba_id_received, 'changes': [{'field': field, 'value': value}]}],
+    }
+
+
+def ordering_key(log_entry) -> str:
+    """The contact a row belongs to; rows with the same key are replayed in order by one worker."""
+    data = log_entry.payload if isinstance(log_entry.payload, dict) else {}
+    if log_entry.event_type == 'message_status':
+        return data.get('recipient_id') or str(log_entry.pk)
+    if (log_entry.event_type or '').startswith('message_'):
+        return data.get('from') or str(log_entry.pk)
+    return str(log_entry.pk)
+
+
+class ReplayEngine:
+    """
+    Replays a WebhookEventLog queryset; see the module docstring.
+
+    `workers` threads run in parallel across contacts, `rate` caps events per second overall,
+    and `dry_run` only reports what would be replayed.
+    """
+
+    def __init__(self, workers: int = 8, rate: Optional[float] = None, dry_run: bool = False,
+                 target_url: Optional[str] = None, app_secret: Optional[str] = None, queue_size: int = 500):
+        self.workers = max(1, workers)
+        self.rate = rate
+        self.dry_run = dry_run
+        self.target_url = target_url
+        self.app_secret = app_secret
+        self.queue_size = queue_size
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def run(self, queryset, limit: Optional[int] = None) -> Counter:
+        """
+        Replays every row of `queryset`, or the first `limit` in received_at order. Returns counts of
+        'read', 'replayed', 'failed', 'skipped' and per event type.
+        """
+        rows = queryset.select_related('app_config', 'payload_blob').order_by('received_at', 'id')
+        if limit:
+            rows = rows[:limit]
+        if self.dry_run:
+            for log_entry in rows.iterator(chunk_size=2000):
+                self._count('read')
+                self._count('skipped' if build_payload(log_entry) is None else 'replayed')
+                self._count(f"event_type:{log_entry.event_type}")
+            return self.stats
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        threads = [threading.Thread(target=self._work, args=(q,), name=f"webhook-replay-{i}", daemon=True) for i, q in enumerate(queues)]
+        for thread in threads:
+            thread.start()
+
+        started = time.monotonic()
+        try:
+            for count, log_entry in enumerate(rows.iterator(chunk_size=2000), start=1):
+                if self.rate:
+                    # Even pacing: the n-th event is not handed out before n / rate seconds.
+                    delay = started + count / self.rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self._count('read')
+                # Bounded queues apply backpressure to the cursor when workers fall behind.
+                queues[hash(ordering_key(log_entry)) % self.workers].put(log_entry)
+                if count % _PROGRESS_EVERY == 0:
+                    logger.info(f"Webhook replay: {count} events read, {dict(self.stats)}")
+        finally:
+            for q in queues:
+                q.put(None)
+            for thread in threads:
+                thread.join()
+        return self.stats
+
+    def _work(self, work_queue: queue.Queue):
+        from .services import WebhookProcessor
+
+        processors = {}
+        session = requests.Session() if self.target_url else None
+        try:
+            while True:
+                log_entry = work_queue.get()
+                if log_entry is None:
+                    return
+                payload = build_payload(log_entry)
+                if payload is None or log_entry.app_config is None:
+                    self._count('skipped')
+                    continue
+                try:
+                    if session is not None:
+                        ok = self._post(session, log_entry, payload)
+                    else:
+                        processor = processors.get(log_entry.app_config_id)
+                        if processor is None:
+                            processor = processors[log_entry.app_config_id] = WebhookProcessor(log_entry.app_config, replay=True)
+                        ok = processor.process(payload, replayed_identifier=log_entry.event_identifier)
+                except Exception as e:
+                    logger.error(f"Webhook replay of WebhookEventLog {log_entry.pk} failed: {e}", exc_info=True)
+                    ok = False
+                self._count('replayed' if ok else 'failed')
+                self._count(f"event_type:{log_entry.event_type}")
+        finally:
+            if session is not None:
+                session.close()
+            connections.close_all() # This thread's connections only
+
+    def _post(self, session: requests.Session, log_entry, payload: dict) -> bool:
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        app_secret = self.app_secret or log_entry.app_config.app_secret
+        if app_secret:
+            headers['X-Hub-Signature-256'] = 'sha256=' + hmac.new(app_secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        response = session.post(self.target_url, data=body, headers=headers, timeout=30)
+        if response.status_code != 200:
+            logger.warning(f"Webhook replay of WebhookEventLog {log_entry.pk} to {self.target_url}: HTTP {response.status_code} {response.text[:200]}")
+        return response.status_code == 200
+
+
+def replay_events(log_ids: Iterable[int], **engine_options) -> Counter:
+    """Replays the given WebhookEventLog rows (admin action, API reprocess)."""
+    from .models import WebhookEventLog
+    return ReplayEngine(**engine_options).run(WebhookEventLog.objects.filter(pk__in=list(log_ids)))
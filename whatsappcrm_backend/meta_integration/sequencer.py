@@ -0,0 +1,236 @@
+# whatsappcrm_backend/meta_integration/sequencer.py
+"""
+Per-contact outgoing message sequencer.
+
+Outgoing messages are appended to a Redis list per contact. Whoever takes the contact's lease
+schedules one `drain_contact_send_queue_task`, which sends the queued messages in order, each as
+soon as the previous API call returns and a send token is available (see rate_limiter), and
+gives the lease back once the list is empty. Nothing
+polls the database: the next message is released by the previous send (or, with
+META_SEND_WAIT_FOR_DELIVERY, by its 'delivered' status webhook, with a timeout).
+
+With META_SEND_ASYNC_DISPATCHER the drains run as coroutines in the `run_send_dispatcher` process
+(async_dispatcher.py) instead of Celery tasks: scheduled drains are pushed to a ready list, or a
+sorted set when delayed, which the dispatcher consumes. Leases and ordering work the same either way.
+
+If a worker dies holding a lease, the lease expires and `sweep_send_queues` (beat) restarts the
+contact's queue. Without Redis, messages fall back to `send_whatsapp_message_sequence_task`.
+"""
+import logging
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from whatsappcrm_backend.redis_client import get_redis_client
+from .rate_limiter import LANE_CONVERSATIONAL
+
+logger = logging.getLogger('meta_integration')
+
+QUEUE_KEY = "meta:sendq:{contact_id}"
+LEASE_KEY = "meta:sendq:{contact_id}:lease"
+ACTIVE_CONTACTS_KEY = "meta:sendq:active"
+AWAITING_KEY = "meta:sendq:awaiting:{wamid}"
+READY_KEY = "meta:sendq:ready"
+DELAYED_KEY = "meta:sendq:delayed"
+
+LEASE_SECONDS = 60
+RELEASING_STATUSES = ('delivered', 'read', 'failed')
+
+# Extends the lease only if `token` still holds it.
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('expire', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+# Gives the lease back if the queue is empty. Returns 1 if released, 0 if messages arrived
+# meanwhile (the holder keeps draining), -1 if the lease was lost.
+_RELEASE_IF_IDLE_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return -1
+end
+if redis.call('llen', KEYS[2]) > 0 then
+    return 0
+end
+redis.call('del', KEYS[1])
+redis.call('srem', KEYS[3], ARGV[2])
+return 1
+"""
+# Moves delayed drains that are due onto the ready list.
+_PROMOTE_DUE_SCRIPT = """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('zrem', KEYS[1], unpack(due))
+    redis.call('rpush', KEYS[2], unpack(due))
+end
+return #due
+"""
+_TAKE_SCRIPT = """
+local value = redis.call('get', KEYS[1])
+if value then
+    redis.call('del', KEYS[1])
+end
+return value
+"""
+
+
+def wait_for_delivery() -> bool:
+    return getattr(settings, 'META_SEND_WAIT_FOR_DELIVERY', False)
+
+
+def delivery_timeout() -> int:
+    return getattr(settings, 'META_SEND_DELIVERY_TIMEOUT_SECONDS', 20)
+
+
+def use_async_dispatcher() -> bool:
+    return getattr(settings, 'META_SEND_ASYNC_DISPATCHER', False)
+
+
+def _schedule_drain(contact_id: int, token: str, countdown: float = 0, awaited_wamid: Optional[str] = None) -> None:
+    """Runs a drain of the contact's queue, now or after `countdown` seconds, on Celery or the asyncio dispatcher."""
+    from .tasks import drain_contact_send_queue_task
+
+    if not use_async_dispatcher():
+        args = [contact_id, token] + ([awaited_wamid] if awaited_wamid else [])
+        drain_contact_send_queue_task.apply_async(args=args, countdown=countdown or None)
+        return
+    entry = f"{contact_id}|{token}|{awaited_wamid or ''}"
+    if countdown:
+        get_redis_client().zadd(DELAYED_KEY, {entry: time.time() + countdown})
+    else:
+        get_redis_client().rpush(READY_KEY, entry)
+
+
+def take_ready_drains(count: int, timeout: float) -> List[Tuple[int, str, Optional[str]]]:
+    """
+    Takes up to `count` scheduled drains as (contact_id, lease token, awaited wamid), waiting up to
+    `timeout` seconds for the first one. Used by the asyncio dispatcher.
+    """
+    client = get_redis_client()
+    client.eval(_PROMOTE_DUE_SCRIPT, 2, DELAYED_KEY, READY_KEY, time.time(), 1000)
+    first = client.blpop(READY_KEY, timeout=timeout)
+    if first is None:
+        return []
+    entries = [first[1]] + ((client.lpop(READY_KEY, count - 1) or []) if count > 1 else [])
+    drains = []
+    for entry in entries:
+        contact_id, token, awaited_wamid = entry.split('|', 2)
+        drains.append((int(contact_id), token, awaited_wamid or None))
+    return drains
+
+
+def _kick(client, contact_id: int) -> None:
+    """Schedules a drain for the contact unless one already holds its lease."""
+    token = uuid.uuid4().hex
+    if client.set(LEASE_KEY.format(contact_id=contact_id), token, nx=True, ex=LEASE_SECONDS):
+        _schedule_drain(contact_id, token)
+
+
+def _enqueue(contact_id: int, message_ids: List[int], config_id: int, lane: str) -> None:
+    from .tasks import send_whatsapp_message_sequence_task
+
+    try:
+        client = get_redis_client()
+        pipe = client.pipeline()
+        pipe.rpush(QUEUE_KEY.format(contact_id=contact_id), *[f"{message_id}:{config_id}:{lane}" for message_id in message_ids])
+        pipe.sadd(ACTIVE_CONTACTS_KEY, contact_id)
+        pipe.execute()
+        _kick(client, contact_id)
+    except Exception as e:
+        logger.error(f"Could not queue messages {message_ids} for contact {contact_id} in the send sequencer: {e}. Sending them directly.", exc_info=True)
+        send_whatsapp_message_sequence_task.delay(message_ids, config_id)
+
+
+def dispatch_outgoing_messages(contact_id: int, message_ids: List[int], config_id: int, lane: str = LANE_CONVERSATIONAL) -> None:
+    """
+    Queues a contact's outgoing messages, in the given order, behind any already queued for them.
+    `lane` picks the rate-limit budget (rate_limiter.LANE_BROADCAST for broadcasts).
+    Runs once the current transaction commits, so the drain never looks for uncommitted messages.
+    """
+    if not message_ids:
+        return
+    transaction.on_commit(lambda: _enqueue(contact_id, list(message_ids), config_id, lane))
+
+
+def renew_lease(contact_id: int, token: str, seconds: int = LEASE_SECONDS) -> bool:
+    return bool(get_redis_client().eval(_RENEW_SCRIPT, 1, LEASE_KEY.format(contact_id=contact_id), token, seconds))
+
+
+def peek(contact_id: int) -> Optional[Tuple[int, int, str]]:
+    """The contact's next message as (message_id, config_id, lane), left on the queue until `pop`."""
+    entry = get_redis_client().lindex(QUEUE_KEY.format(contact_id=contact_id), 0)
+    if entry is None:
+        return None
+    message_id, config_id, *lane = entry.split(':')
+    return int(message_id), int(config_id), lane[0] if lane else LANE_CONVERSATIONAL
+
+
+def pop(contact_id: int) -> None:
+    get_redis_client().lpop(QUEUE_KEY.format(contact_id=contact_id))
+
+
+def release_if_idle(contact_id: int, token: str) -> int:
+    return get_redis_client().eval(
+        _RELEASE_IF_IDLE_SCRIPT, 3, LEASE_KEY.format(contact_id=contact_id), QUEUE_KEY.format(contact_id=contact_id),
+        ACTIVE_CONTACTS_KEY, token, contact_id
+    )
+
+
+def defer(contact_id: int, token: str, seconds: float) -> None:
+    """Resumes the contact's queue after `seconds`, keeping the lease meanwhile (rate limits)."""
+    renew_lease(contact_id, token, int(seconds) + LEASE_SECONDS)
+    _schedule_drain(contact_id, token, countdown=seconds)
+
+
+def await_delivery(contact_id: int, token: str, wamid: str) -> None:
+    """Parks the contact's queue until `wamid` is delivered or the timeout passes; the lease is kept meanwhile."""
+    timeout = delivery_timeout()
+    client = get_redis_client()
+    client.set(AWAITING_KEY.format(wamid=wamid), f"{contact_id}|{token}", ex=timeout + LEASE_SECONDS)
+    renew_lease(contact_id, token, timeout + LEASE_SECONDS)
+    _schedule_drain(contact_id, token, countdown=timeout, awaited_wamid=wamid)
+
+
+def stop_awaiting(wamid: str) -> Optional[Tuple[int, str]]:
+    """Ends the wait for `wamid`. Returns (contact_id, lease token) if it was still awaited, i.e. the caller resumes the queue."""
+    value = get_redis_client().eval(_TAKE_SCRIPT, 1, AWAITING_KEY.format(wamid=wamid))
+    if not value:
+        return None
+    contact_id, token = value.split('|', 1)
+    return int(contact_id), token
+
+
+def on_message_status(wamid: str, status_value: str) -> None:
+    """Called for every status webhook: resumes a queue that was waiting for this message's delivery."""
+    if not wait_for_delivery() or not wamid or status_value not in RELEASING_STATUSES:
+        return
+    try:
+        awaited = stop_awaiting(wamid)
+    except Exception as e:
+        logger.warning(f"Send sequencer unavailable for status of WAMID {wamid}: {e}. The queue resumes on its timeout.")
+        return
+    if awaited:
+        contact_id, token = awaited
+        _schedule_drain(contact_id, token)
+
+
+def sweep_send_queues() -> int:
+    """Restarts queues whose drain was lost (expired lease, dead worker). Returns the number restarted."""
+    client = get_redis_client()
+    restarted = 0
+    for contact_id in client.smembers(ACTIVE_CONTACTS_KEY):
+        if not client.llen(QUEUE_KEY.format(contact_id=contact_id)):
+            # Removed only if the queue is still empty and no drain holds the lease.
+            if not client.exists(LEASE_KEY.format(contact_id=contact_id)):
+                client.srem(ACTIVE_CONTACTS_KEY, contact_id)
+            continue
+        if not client.exists(LEASE_KEY.format(contact_id=contact_id)):
+            _kick(client, int(contact_id))
+            restarted += 1
+    if restarted:
+        logger.warning(f"Send sequencer sweep restarted {restarted} stalled contact queue(s).")
+    return restarted
@@ -0,0 +1,225 @@
+# whatsappcrm_backend/meta_integration/status_pipeline.py
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from whatsappcrm_backend.redis_client import get_redis_client
+
+logger = logging.getLogger('meta_integration')
+
+PENDING_STATUSES_KEY = "meta:statuses:pending"
+PENDING_FAILURES_KEY = "meta:statuses:failed"
+FLUSH_SCHEDULED_KEY = "meta:statuses:flush_scheduled"
+
+# Delivery statuses only ever move forward. 'failed' is not on this scale: it is kept apart and
+# applied only to messages that never reached the user.
+STATUS_RANK = {'pending_dispatch': 0, 'sent': 1, 'delivered': 2, 'read': 3}
+FAILABLE_STATUSES = ('pending_dispatch', 'sent')
+
+# Stores ARGV[3] for the wamid only if its rank is higher than what is already pending.
+_RECORD_STATUS_SCRIPT = """
+local current = redis.call('hget', KEYS[1], ARGV[1])
+if current then
+    local current_rank = tonumber(string.match(current, '^(%d+)|'))
+    if current_rank >= tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2] .. '|' .. ARGV[3])
+return 1
+"""
+# Takes everything pending and clears the flush flag in one step, so statuses recorded
+# after this point schedule a new flush.
+_DRAIN_SCRIPT = """
+local statuses = redis.call('hgetall', KEYS[1])
+local failures = redis.call('hgetall', KEYS[2])
+redis.call('del', KEYS[1], KEYS[2], KEYS[3])
+return {statuses, failures}
+"""
+
+
+def is_status_pipeline_enabled() -> bool:
+    return getattr(settings, 'META_STATUS_PIPELINE_ENABLED', False)
+
+
+def _flush_interval() -> int:
+    return getattr(settings, 'META_STATUS_FLUSH_INTERVAL_SECONDS', 2)
+
+
+def record_status(status_data: dict) -> bool:
+    """
+    Adds a status callback to the pending batch, keeping only the most advanced status per wamid,
+    and makes sure a flush is scheduled. Returns False if Redis is unavailable, in which case
+    the caller should apply the status directly.
+    """
+    from .tasks import flush_message_statuses_task
+
+    wamid = status_data.get("id")
+    status_value = status_data.get("status")
+    if not wamid or (status_value not in STATUS_RANK and status_value != 'failed'):
+        return False
+
+    record = {
+        'status': status_value,
+        'timestamp': status_data.get("timestamp"),
+        'conversation_id': (status_data.get('conversation') or {}).get('id') if isinstance(status_data.get('conversation'), dict) else None,
+        'pricing_model': (status_data.get('pricing') or {}).get('pricing_model') if isinstance(status_data.get('pricing'), dict) else None,
+    }
+    try:
+        client = get_redis_client()
+        if status_value == 'failed':
+            record['errors'] = status_data.get('errors')
+            client.hset(PENDING_FAILURES_KEY, wamid, json.dumps(record))
+        else:
+            client.eval(_RECORD_STATUS_SCRIPT, 1, PENDING_STATUSES_KEY, wamid, STATUS_RANK[status_value], json.dumps(record))
+
+        interval = _flush_interval()
+        # Debounce: only the first status of a window schedules the flush. The flag expires on its own
+        # in case the flush task is lost, so statuses can never be stranded.
+        if client.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=interval + 60):
+            flush_message_statuses_task.apply_async(countdown=interval)
+        return True
+    except Exception as e:
+        logger.error(f"Could not queue status '{status_value}' for WAMID {wamid} in Redis: {e}. Applying it directly.", exc_info=True)
+        return False
+
+
+def _parse_timestamp(ts_str):
+    if ts_str and str(ts_str).isdigit():
+        return timezone.make_aware(datetime.fromtimestamp(int(ts_str)))
+    return timezone.now()
+
+
+def _decode(flat_hash: List[str], ranked: bool) -> Dict[str, dict]:
+    decoded = {}
+    for wamid, value in zip(flat_hash[::2], flat_hash[1::2]):
+        if ranked:
+            value = value.split('|', 1)[1]
+        decoded[wamid] = json.loads(value)
+    return decoded
+
+
+def _requeue(statuses: Dict[str, dict], failures: Dict[str, dict]) -> None:
+    """
+    Puts drained statuses back after a failed flush and schedules another one. Statuses recorded
+    meanwhile win if they are more advanced (or, for failures, already there).
+    """
+    from .tasks import flush_message_statuses_task
+
+    client = get_redis_client()
+    pipe = client.pipeline()
+    for wamid, record in statuses.items():
+        pipe.eval(_RECORD_STATUS_SCRIPT, 1, PENDING_STATUSES_KEY, wamid, STATUS_RANK[record['status']], json.dumps(record))
+    for wamid, record in failures.items():
+        pipe.hsetnx(PENDING_FAILURES_KEY, wamid, json.dumps(record))
+    pipe.execute()
+    interval = _flush_interval()
+    if client.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=interval + 60):
+        flush_message_statuses_task.apply_async(countdown=interval)
+
+
+def flush_pending_statuses(batch_size: int = 1000) -> int:
+    """
+    Applies all pending statuses with one bulk_update per batch and sends one realtime event per
+    conversation. Returns the number of messages updated.
+    """
+    statuses, failures = get_redis_client().eval(_DRAIN_SCRIPT, 3, PENDING_STATUSES_KEY, PENDING_FAILURES_KEY, FLUSH_SCHEDULED_KEY)
+    statuses, failures = _decode(statuses, ranked=True), _decode(failures, ranked=False)
+    wamids = list(set(statuses) | set(failures))
+    if not wamids:
+        return 0
+
+    updated_messages = []
+    for start in range(0, len(wamids), batch_size):
+        batch = wamids[start:start + batch_size]
+        try:
+            updated_messages.extend(_apply_batch(batch, statuses, failures))
+        except Exception:
+            # The statuses were taken out of Redis before writing: put back every batch not committed yet.
+            remaining = wamids[start:]
+            logger.error(f"Could not apply {len(remaining)} pending statuses; putting them back for the next flush.", exc_info=True)
+            _requeue(
+                {wamid: statuses[wamid] for wamid in remaining if wamid in statuses},
+                {wamid: failures[wamid] for wamid in remaining if wamid in failures},
+            )
+            _broadcast_status_changes(updated_messages)
+            raise
+
+    logger.info(f"Flushed {len(wamids)} pending statuses: {len(updated_messages)} messages updated.")
+    _broadcast_status_changes(updated_messages)
+    return len(updated_messages)
+
+
+def _apply_batch(batch: List[str], statuses: Dict[str, dict], failures: Dict[str, dict]) -> list:
+    """Writes the pending statuses of one batch of wamids. Returns the messages updated."""
+    from conversations.models import Message
+
+    messages = Message.objects.filter(wamid__in=batch, direction='out').only(
+        'id', 'contact_id', 'wamid', 'status', 'status_timestamp',
+        'conversation_id_from_meta', 'pricing_model_from_meta', 'error_details'
+    )
+    to_update = []
+    for message in messages:
+        changed = False
+        record = statuses.get(message.wamid)
+        # Callbacks can arrive out of order and across flushes: never move a message backwards.
+        if record and STATUS_RANK[record['status']] > STATUS_RANK.get(message.status, -1):
+            message.status = record['status']
+            message.status_timestamp = _parse_timestamp(record['timestamp'])
+            changed = True
+        failure = failures.get(message.wamid)
+        if failure and message.status in FAILABLE_STATUSES:
+            message.status = 'failed'
+            message.status_timestamp = _parse_timestamp(failure['timestamp'])
+            message.error_details = failure.get('errors')
+            record = failure
+            changed = True
+        if not changed:
+            continue
+        if record.get('conversation_id'):
+            message.conversation_id_from_meta = record['conversation_id']
+        if record.get('pricing_model'):
+            message.pricing_model_from_meta = record['pricing_model']
+        to_update.append(message)
+
+    if to_update:
+        with transaction.atomic():
+            Message.objects.bulk_update(
+                to_update,
+                ['status', 'status_timestamp', 'conversation_id_from_meta', 'pricing_model_from_meta', 'error_details']
+            )
+    return to_update
+
+
+def _broadcast_status_changes(messages) -> None:
+    """Sends one 'message_statuses' event per conversation instead of one per message save."""
+    from channels.layers import get_channel_layer
+    from asgiref.sync import async_to_sync
+
+    channel_layer = get_channel_layer()
+    if not channel_layer or not messages:
+        return
+
+    statuses_by_contact = defaultdict(list)
+    for message in messages:
+        statuses_by_contact[message.contact_id].append({
+            'id': message.id,
+            'wamid': message.wamid,
+            'status': message.status,
+            'status_timestamp': message.status_timestamp.isoformat() if message.status_timestamp else None,
+        })
+
+    for contact_id, statuses in statuses_by_contact.items():
+        try:
+            async_to_sync(channel_layer.group_send)(
+                f'conversation_{contact_id}',
+                {'type': 'message_statuses', 'statuses': statuses}
+            )
+        except Exception as e:
+            logger.error(f"Error broadcasting {len(statuses)} status updates to conversation_{contact_id}: {e}", exc_info=True)
@@ -1,145 +1,179 @@
 # whatsappcrm_backend/meta_integration/tasks.py
 
 import logging
+import random
+import time
 from celery import shared_task
 from django.utils import timezone
-from django.db.models import Q
-from datetime import timedelta
 
 from .utils import send_whatsapp_message, send_read_receipt_api
+from .rate_limiter import MetaRateLimitError, acquire_send_token, handle_rate_limit_response
 from .models import MetaAppConfig
 from conversations.models import Message, Contact # To update message status
 
 logger = logging.getLogger(__name__)
 
-@shared_task(bind=True, max_retries=10, default_retry_delay=3) # bind=True gives access to self, retry settings
-def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id: int):
+def _send_outgoing_message(outgoing_msg: Message, active_config: MetaAppConfig) -> bool:
     """
-    Celery task to send a WhatsApp message asynchronously.
-    Updates the Message object's status based on the outcome.
+    Sends an outgoing Message through the Meta API and records the outcome (wamid, status,
+    error_details) on the instance without saving it. Raises on transport or payload errors,
+    so callers can decide whether to retry. Raises MetaRateLimitError, leaving the instance
+    untouched, if Meta rejected the message for sending too fast.
 
-    Args:
-        outgoing_message_id (int): The ID of the outgoing Message object to send.
-        active_config_id (int): The ID of the active MetaAppConfig to use for sending.
+    Returns:
+        True if Meta accepted the message, False if it rejected it.
     """
-    try:
-        outgoing_msg = Message.objects.select_related('contact').get(pk=outgoing_message_id)
-        active_config = MetaAppConfig.objects.get(pk=active_config_id)
-    except Message.DoesNotExist:
+    # content_payload should contain the 'data' part for send_whatsapp_message
+    # and message_type should be the Meta API message type
+    if not isinstance(outgoing_msg.content_payload, dict):
+        raise ValueError("Message content_payload is not a valid dictionary for sending.")
+
+    api_response = send_whatsapp_message(
+        to_phone_number=outgoing_msg.contact.whatsapp_id,
+        message_type=outgoing_msg.message_type, # This should be 'text', 'template', 'interactive'
+        data=outgoing_msg.content_payload, # This is the actual data for the type
+        config=active_config
+    )
+    return _apply_send_response(outgoing_msg, api_response, active_config)
+
+
+def _apply_send_response(outgoing_msg: Message, api_response, active_config: MetaAppConfig) -> bool:
+    """Records a send's outcome on the message (see _send_outgoing_message). Shared with the asyncio dispatcher."""
+    if api_response and api_response.get('messages') and api_response['messages'][0].get('id'):
+        outgoing_msg.wamid = api_response['messages'][0]['id']
+        outgoing_msg.status = 'sent' # Successfully handed off to Meta
+        outgoing_msg.error_details = None # Clear previous errors if any
+        logger.info(f"Message ID {outgoing_msg.id} sent successfully via Meta API. WAMID: {outgoing_msg.wamid}")
+        return True
+
+    handle_rate_limit_response(api_response, active_config.phone_number_id)
+
+    # Handle failure from Meta API
+    error_info = api_response or {'error': 'Meta API call failed or returned unexpected response.'}
+    logger.error(f"Failed to send Message ID {outgoing_msg.id} via Meta API. Response: {error_info}")
+    outgoing_msg.status = 'failed'
+    outgoing_msg.error_details = error_info
+    # Rate-limit rejections were raised above so callers can retry them; other rejections are final.
+    return False
+
+
+@shared_task
+def send_whatsapp_message_task(outgoing_message_id: int, active_config_id: int):
+    """
+    Queues one outgoing message in its contact's send sequencer (see sequencer.py), which sends it
+    after the contact's earlier messages. Kept for callers that only have a message id; new code
+    should call `sequencer.dispatch_outgoing_messages` directly and skip this hop.
+    """
+    from .sequencer import dispatch_outgoing_messages
+
+    contact_id = Message.objects.filter(pk=outgoing_message_id).values_list('contact_id', flat=True).first()
+    if contact_id is None:
         logger.error(f"send_whatsapp_message_task: Message with ID {outgoing_message_id} not found. Task cannot proceed.")
-        return # Cannot retry if message doesn't exist
-    except MetaAppConfig.DoesNotExist:
-        logger.error(f"send_whatsapp_message_task: MetaAppConfig with ID {active_config_id} not found. Task cannot proceed.")
-        # Update message status to failed if config is missing
-        if 'outgoing_msg' in locals():
-            outgoing_msg.status = 'failed'
-            outgoing_msg.error_details = {'error': f'MetaAppConfig ID {active_config_id} not found for sending.'}
-            outgoing_msg.status_timestamp = timezone.now()
-            outgoing_msg.save(update_fields=['status', 'error_details', 'status_timestamp'])
         return
+    dispatch_outgoing_messages(contact_id, [outgoing_message_id], active_config_id)
 
-    if outgoing_msg.direction != 'out':
-        logger.warning(f"send_whatsapp_message_task: Message ID {outgoing_message_id} is not an outgoing message. Skipping.")
-        return
 
-    # Avoid resending if already sent successfully or in a final failed state without retries
-    if outgoing_msg.wamid and outgoing_msg.status == 'sent':
-        logger.info(f"send_whatsapp_message_task: Message ID {outgoing_message_id} (WAMID: {outgoing_msg.wamid}) already marked as sent. Skipping.")
-        return
-    if outgoing_msg.status == 'failed' and self.request.retries >= self.max_retries:
-         logger.warning(f"send_whatsapp_message_task: Message ID {outgoing_message_id} already failed and max retries reached. Skipping.")
-         return
-
-    # To ensure sequential delivery, check for preceding messages that are either:
-    # 1. Still pending dispatch (these should always be sent first).
-    # 2. Were sent recently but not yet confirmed as delivered. We'll wait for a short period
-    #    (e.g., 2 minutes) for the delivery receipt. This prevents sending a new message
-    #    before the previous one is confirmed delivered by WhatsApp's servers.
-    stale_threshold = timezone.now() - timedelta(seconds=20)
-
-    # NEW: Add a threshold for stale pending messages to prevent deadlocks.
-    # If a message has been pending for more than 5 minutes, assume it's stuck and proceed.
-    stale_pending_threshold = timezone.now() - timedelta(minutes=1)
-
-    # Find the specific message causing the halt for better logging
-    # A message is halting if it's a preceding message for the same contact AND
-    # 1. It is still pending dispatch (must wait for it to be sent).
-    # OR
-    # 2. It was sent very recently, and we are waiting for a delivery receipt to ensure order.
-    halting_message = Message.objects.filter(
-        Q(contact=outgoing_msg.contact),
-        Q(direction='out'),
-        Q(id__lt=outgoing_msg.id),
-        (
-            Q(status='pending_dispatch', timestamp__gte=stale_pending_threshold) | # Only wait for RECENTLY created pending messages.
-            Q(status='sent', status_timestamp__gte=stale_threshold) # Wait for recently sent messages to be delivered.
-        )
-    ).order_by('-id').first() # Get the most recent one for logging
-
-    if halting_message:
-        logger.warning(
-            f"send_whatsapp_message_task: Halting message ID {outgoing_message_id} for contact "
-            f"{outgoing_msg.contact.whatsapp_id}. Waiting for preceding message ID {halting_message.id} "
-            f"(Status: {halting_message.status}, Status Time: {halting_message.status_timestamp}, "
-            f"Created: {halting_message.timestamp}). Retrying."
-        )
-        try:
-            raise self.retry() # Uses the task's default_retry_delay
-        except self.MaxRetriesExceededError:
-            logger.error(f"Max retries exceeded for message {outgoing_message_id} while waiting. Marking as failed.")
+# Waits for a send token up to this long are slept through; longer ones reschedule the drain.
+MAX_INLINE_RATE_LIMIT_WAIT_SECONDS = 0.5
+
+
+@shared_task(bind=True, max_retries=10, default_retry_delay=3)
+def drain_contact_send_queue_task(self, contact_id: int, lease_token: str, awaited_wamid: str = None):
+    """
+    Sends a contact's queued outgoing messages in order while holding the contact's sequencer lease,
+    each as soon as the previous API call returns, and releases the lease once the queue is empty.
+    Every send takes a token from the phone number's rate limiter first; longer waits and Meta
+    rate-limit rejections hand the queue to a delayed task instead of blocking the worker.
+
+    With META_SEND_WAIT_FOR_DELIVERY the task stops after each accepted message and is re-run by the
+    message's status webhook, or by the delivery timeout (`awaited_wamid` set) if none arrives.
+    """
+    from . import sequencer
+
+    if awaited_wamid is not None and sequencer.stop_awaiting(awaited_wamid) is None:
+        return # The status webhook already resumed the queue.
+
+    configs = {}
+    while True:
+        if not sequencer.renew_lease(contact_id, lease_token):
+            logger.warning(f"drain_contact_send_queue_task: Lost the send lease for contact {contact_id}. Another drain has taken over.")
+            return
+        head = sequencer.peek(contact_id)
+        if head is None:
+            if sequencer.release_if_idle(contact_id, lease_token) == 0:
+                continue # Messages were queued while releasing.
+            return
+        outgoing_message_id, config_id, lane = head
+
+        outgoing_msg = Message.objects.select_related('contact').filter(pk=outgoing_message_id).first()
+        if outgoing_msg is None:
+            logger.error(f"drain_contact_send_queue_task: Message with ID {outgoing_message_id} not found. Skipping.")
+            sequencer.pop(contact_id)
+            continue
+        if outgoing_msg.direction != 'out':
+            logger.warning(f"drain_contact_send_queue_task: Message ID {outgoing_message_id} is not an outgoing message. Skipping.")
+            sequencer.pop(contact_id)
+            continue
+        if outgoing_msg.wamid and outgoing_msg.status == 'sent':
+            logger.info(f"drain_contact_send_queue_task: Message ID {outgoing_message_id} (WAMID: {outgoing_msg.wamid}) already marked as sent. Skipping.")
+            sequencer.pop(contact_id)
+            continue
+
+        if config_id not in configs:
+            configs[config_id] = MetaAppConfig.objects.filter(pk=config_id).first()
+        active_config = configs[config_id]
+        if active_config is None:
+            logger.error(f"drain_contact_send_queue_task: MetaAppConfig with ID {config_id} not found for Message ID {outgoing_message_id}.")
             outgoing_msg.status = 'failed'
-            outgoing_msg.error_details = {'error': 'Max retries exceeded while waiting for preceding message.'}
+            outgoing_msg.error_details = {'error': f'MetaAppConfig ID {config_id} not found for sending.'}
             outgoing_msg.status_timestamp = timezone.now()
             outgoing_msg.save(update_fields=['status', 'error_details', 'status_timestamp'])
-            return # Explicitly return to prevent fall-through
+            sequencer.pop(contact_id)
+            continue
 
-    logger.info(f"Task send_whatsapp_message_task started for Message ID: {outgoing_message_id}, Contact: {outgoing_msg.contact.whatsapp_id}")
-
-    try:
-        # content_payload should contain the 'data' part for send_whatsapp_message
-        # and message_type should be the Meta API message type
-        if not isinstance(outgoing_msg.content_payload, dict):
-            raise ValueError("Message content_payload is not a valid dictionary for sending.")
-
-        api_response = send_whatsapp_message(
-            to_phone_number=outgoing_msg.contact.whatsapp_id,
-            message_type=outgoing_msg.message_type, # This should be 'text', 'template', 'interactive'
-            data=outgoing_msg.content_payload, # This is the actual data for the type
-            config=active_config
-        )
+        wait = acquire_send_token(active_config.phone_number_id, lane)
+        if 0 < wait <= MAX_INLINE_RATE_LIMIT_WAIT_SECONDS:
+            time.sleep(wait)
+            continue
+        if wait:
+            sequencer.defer(contact_id, lease_token, wait)
+            return
 
-        if api_response and api_response.get('messages') and api_response['messages'][0].get('id'):
-            outgoing_msg.wamid = api_response['messages'][0]['id']
-            outgoing_msg.status = 'sent' # Successfully handed off to Meta
-            outgoing_msg.error_details = None # Clear previous errors if any
-            logger.info(f"Message ID {outgoing_message_id} sent successfully via Meta API. WAMID: {outgoing_msg.wamid}")
-        else:
-            # Handle failure from Meta API
-            error_info = api_response or {'error': 'Meta API call failed or returned unexpected response.'}
-            logger.error(f"Failed to send Message ID {outgoing_message_id} via Meta API. Response: {error_info}")
+        accepted = False
+        retry_exc = None
+        try:
+            accepted = _send_outgoing_message(outgoing_msg, active_config)
+        except MetaRateLimitError as e:
+            # Not sent, so not failed: the message stays at the head until the limit clears.
+            logger.warning(f"Message ID {outgoing_message_id} rejected by Meta rate limit ({e.code}). Retrying in {e.retry_after}s.")
+            sequencer.defer(contact_id, lease_token, e.retry_after)
+            return
+        except Exception as e:
+            logger.error(f"Exception in drain_contact_send_queue_task for Message ID {outgoing_message_id}: {e}", exc_info=True)
             outgoing_msg.status = 'failed'
-            outgoing_msg.error_details = error_info
-            # Retry logic for certain types of failures could be added here
-            # For now, we rely on Celery's built-in retry for RequestException type errors.
-            # If Meta returns a specific error code that indicates a retryable issue, handle it.
-            # Example: if error_info.get('error', {}).get('code') == SOME_RETRYABLE_CODE:
-            #    raise self.retry(exc=ValueError("Meta API retryable error"))
+            outgoing_msg.error_details = {'error': str(e), 'type': type(e).__name__}
+            retry_exc = e
+        finally:
+            outgoing_msg.status_timestamp = timezone.now()
+            outgoing_msg.save(update_fields=['wamid', 'status', 'error_details', 'status_timestamp'])
 
-    except Exception as e:
-        logger.error(f"Exception in send_whatsapp_message_task for Message ID {outgoing_message_id}: {e}", exc_info=True)
-        outgoing_msg.status = 'failed'
-        outgoing_msg.error_details = {'error': str(e), 'type': type(e).__name__}
-        try:
-            # Retry the task if it's a network issue or a temporary problem
-            # Celery will automatically retry based on max_retries and default_retry_delay.
-            raise self.retry(exc=e) # Re-raise to trigger Celery's retry mechanism
-        except self.MaxRetriesExceededError:
-            logger.error(f"Max retries exceeded for sending Message ID {outgoing_message_id}.")
-            # Message is already marked as 'failed', so we just let the finally block save it.
-            pass
-    finally:
-        outgoing_msg.status_timestamp = timezone.now()
-        outgoing_msg.save(update_fields=['wamid', 'status', 'error_details', 'status_timestamp'])
+        if retry_exc is not None:
+            # Checked up front: once retries run out, retry(exc=...) re-raises `exc` rather than
+            # MaxRetriesExceededError, which would leave the message at the head of the queue for good.
+            if self.request.retries < self.max_retries:
+                # The message stays at the head of the queue and the lease is kept, so nothing
+                # for this contact overtakes it while the retry is pending.
+                raise self.retry(exc=retry_exc, args=[contact_id, lease_token])
+            logger.error(f"Max retries exceeded for sending Message ID {outgoing_message_id}. Continuing with the contact's queue.")
+            sequencer.pop(contact_id)
+            # A fresh task, so the next message gets its own retries.
+            drain_contact_send_queue_task.delay(contact_id, lease_token)
+            return
+
+        sequencer.pop(contact_id)
+        if accepted and sequencer.wait_for_delivery():
+            sequencer.await_delivery(contact_id, lease_token, outgoing_msg.wamid)
+            return
 
 
 @shared_task(bind=True, max_retries=3, default_retry_delay=10)
@@ -167,3 +201,158 @@ def send_read_receipt_task(self, wamid: str, config_id: int):
             raise self.retry(exc=e)
         except self.MaxRetriesExceededError:
             logger.error(f"Max retries exceeded for sending read receipt for WAMID {wamid}.")
+
+
+# Reschedules of a read receipt held back by META_READ_RECEIPT_RATE_LIMIT_PER_SECOND before it is dropped,
+# and the cap on the (exponential, jittered) delay between them.
+READ_RECEIPT_RATE_LIMIT_MAX_ATTEMPTS = 8
+READ_RECEIPT_RATE_LIMIT_MAX_DELAY_SECONDS = 30
+
+
+@shared_task(bind=True, max_retries=30, default_retry_delay=1)
+def send_coalesced_read_receipt_task(self, config_id: int, contact_wa_id: str, rate_limited_attempts: int = 0):
+    """
+    Sends one read receipt for the newest message a contact sent during the coalescing window.
+    Scheduled (debounced) by `read_receipts.queue_read_receipt`; see META_READ_RECEIPT_COALESCE_SECONDS.
+    """
+    from .read_receipts import acquire_send_slot, take_pending_receipt, requeue_receipt
+
+    if not acquire_send_slot():
+        if rate_limited_attempts + 1 >= READ_RECEIPT_RATE_LIMIT_MAX_ATTEMPTS:
+            # Receipts are best effort: the contact's next message gets a receipt that covers this one.
+            pending = take_pending_receipt(config_id, contact_wa_id)
+            if pending is not None:
+                logger.warning(
+                    f"Dropping read receipt for WAMID {pending[1]}: still rate limited after "
+                    f"{READ_RECEIPT_RATE_LIMIT_MAX_ATTEMPTS} attempts."
+                )
+            return
+        # Leave the receipt pending: messages arriving meanwhile are coalesced into it. Rescheduled
+        # rather than retried, so waiting for the rate limit doesn't use up the failure retries.
+        # Jittered so the receipts held back in one second don't all come back in the same one.
+        delay = min(2 ** rate_limited_attempts, READ_RECEIPT_RATE_LIMIT_MAX_DELAY_SECONDS)
+        send_coalesced_read_receipt_task.apply_async(
+            args=[config_id, contact_wa_id, rate_limited_attempts + 1], countdown=delay + random.uniform(0, delay)
+        )
+        return
+
+    pending = take_pending_receipt(config_id, contact_wa_id)
+    if pending is None:
+        return # Already sent by an earlier run.
+    message_timestamp, wamid = pending
+
+    try:
+        active_config = MetaAppConfig.objects.get(pk=config_id)
+    except MetaAppConfig.DoesNotExist:
+        logger.error(f"send_coalesced_read_receipt_task: MetaAppConfig with ID {config_id} not found. Dropping read receipt for WAMID {wamid}.")
+        return
+
+    api_response = send_read_receipt_api(wamid=wamid, config=active_config)
+    if not api_response or not api_response.get('success'):
+        # send_read_receipt_api has already logged the error.
+        requeue_receipt(config_id, contact_wa_id, message_timestamp, wamid)
+        try:
+            raise self.retry(countdown=10)
+        except self.MaxRetriesExceededError:
+            logger.error(f"Max retries exceeded for sending read receipt for WAMID {wamid}.")
+
+
+@shared_task(bind=True, max_retries=10, default_retry_delay=3)
+def send_whatsapp_message_sequence_task(self, outgoing_message_ids: list, active_config_id: int):
+    """
+    Sends a contact's outgoing messages strictly in the given order, each one as soon as the
+    previous API call returns. Used for the multi-message replies produced by one flow engine run,
+    instead of one task per message staggered by a fixed countdown.
+
+    On a transport error the task retries with only the messages that have not been sent yet,
+    so order is kept and nothing is sent twice.
+    """
+    try:
+        active_config = MetaAppConfig.objects.get(pk=active_config_id)
+    except MetaAppConfig.DoesNotExist:
+        logger.error(f"send_whatsapp_message_sequence_task: MetaAppConfig with ID {active_config_id} not found. Task cannot proceed.")
+        Message.objects.filter(pk__in=outgoing_message_ids, status='pending_dispatch').update(
+            status='failed', status_timestamp=timezone.now(),
+            error_details={'error': f'MetaAppConfig ID {active_config_id} not found for sending.'}
+        )
+        return
+
+    messages_by_id = Message.objects.select_related('contact').in_bulk(outgoing_message_ids)
+
+    for index, outgoing_message_id in enumerate(outgoing_message_ids):
+        outgoing_msg = messages_by_id.get(outgoing_message_id)
+        if outgoing_msg is None:
+            logger.error(f"send_whatsapp_message_sequence_task: Message with ID {outgoing_message_id} not found. Skipping.")
+            continue
+        if outgoing_msg.direction != 'out':
+            logger.warning(f"send_whatsapp_message_sequence_task: Message ID {outgoing_message_id} is not an outgoing message. Skipping.")
+            continue
+        if outgoing_msg.wamid and outgoing_msg.status == 'sent':
+            logger.info(f"send_whatsapp_message_sequence_task: Message ID {outgoing_message_id} (WAMID: {outgoing_msg.wamid}) already marked as sent. Skipping.")
+            continue
+
+        retry_exc = None
+        try:
+            _send_outgoing_message(outgoing_msg, active_config)
+        except Exception as e:
+            logger.error(f"Exception in send_whatsapp_message_sequence_task for Message ID {outgoing_message_id}: {e}", exc_info=True)
+            outgoing_msg.status = 'failed'
+            outgoing_msg.error_details = {'error': str(e), 'type': type(e).__name__}
+            retry_exc = e
+        finally:
+            outgoing_msg.status_timestamp = timezone.now()
+            outgoing_msg.save(update_fields=['wamid', 'status', 'error_details', 'status_timestamp'])
+
+        if retry_exc is not None:
+            remaining_ids = list(outgoing_message_ids[index:])
+            # retry(exc=...) re-raises `exc` once retries run out, so check the count up front.
+            if self.request.retries < self.max_retries:
+                # Resume from the failed message so the rest of the sequence keeps its order.
+                raise self.retry(exc=retry_exc, args=[remaining_ids, active_config_id])
+            logger.error(f"Max retries exceeded for sending Message ID {outgoing_message_id}. Continuing with the rest of the sequence.")
+            if remaining_ids[1:]:
+                # A fresh task, so the remaining messages get their own retries.
+                send_whatsapp_message_sequence_task.delay(remaining_ids[1:], active_config_id)
+            return
+
+
+@shared_task
+def flush_message_statuses_task():
+    """
+    Applies the status callbacks coalesced by `status_pipeline.record_status` since the last flush.
+    Scheduled (debounced) by the pipeline itself; see META_STATUS_PIPELINE_ENABLED.
+    """
+    from .status_pipeline import flush_pending_statuses
+    flush_pending_statuses()
+
+
+@shared_task
+def sweep_send_queues_task():
+    """Restarts contact send queues whose drain task was lost. Scheduled every 30 seconds (CELERY_BEAT_SCHEDULE)."""
+    from .sequencer import sweep_send_queues
+    return sweep_send_queues()
+
+
+@shared_task
+def maintain_webhook_log_partitions_task():
+    """Creates upcoming WebhookEventLog partitions and removes expired ones. Scheduled daily (CELERY_BEAT_SCHEDULE)."""
+    from .partitions import maintain_partitions
+    result = maintain_partitions()
+    logger.info(f"WebhookEventLog partition maintenance: created {len(result['created'])}, removed {len(result['removed'])}.")
+    return result
+
+
+@shared_task
+def prune_payload_blobs_task():
+    """Deletes compressed payloads no longer referenced by any message or webhook log. Scheduled daily (CELERY_BEAT_SCHEDULE)."""
+    from .payload_store import prune_orphaned_blobs
+    return prune_orphaned_blobs()
+
+
+@shared_task
+def replay_webhook_events_task(log_ids: list):
+    """Replays the given WebhookEventLog rows through WebhookProcessor (admin action / API reprocess)."""
+    from .replay import replay_events
+    stats = replay_events(log_ids, workers=4)
+    logger.info(f"Replayed {len(log_ids)} webhook event(s): {dict(stats)}")
+    return dict(stats)
@@ -1,3 +1,616 @@
-from django.test import TestCase
+import asyncio
+import json
+import queue
+import unittest
+import uuid
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from celery.exceptions import Retry
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from meta_integration import async_dispatcher, dedup, payload_store, rate_limiter, replay, sequencer, status_pipeline
+from meta_integration.models import MetaAppConfig, WebhookEventKey, WebhookEventLog
+from meta_integration.services import WebhookProcessor
+from meta_integration.management.commands.run_webhook_ingestion import Command as IngestionCommand
+
+
+class WebhookIngestionAcknowledgementTests(SimpleTestCase):
+    def _run_batch(self, process_result):
+        command = IngestionCommand()
+        command._configs = {1: mock.Mock()}
+        entries = [('1-0', {'config_id': '1', 'body': '{}'})]
+        with mock.patch('meta_integration.management.commands.run_webhook_ingestion.WebhookProcessor') as processor_cls, \
+                mock.patch('meta_integration.management.commands.run_webhook_ingestion.ingestion') as ingestion:
+            processor_cls.return_value.parse_body.return_value = {'object': 'whatsapp_business_account'}
+            processor_cls.return_value.process.return_value = process_result
+            command._process_batch(entries, reclaimed=False, max_deliveries=5)
+        return ingestion
+
+    def test_processed_entry_is_acknowledged(self):
+        ingestion = self._run_batch(process_result=True)
+        ingestion.acknowledge.assert_called_once_with(['1-0'])
+
+    def test_failed_entry_stays_pending(self):
+        ingestion = self._run_batch(process_result=False)
+        ingestion.acknowledge.assert_called_once_with([])
+
+
+class RedisTestCase(SimpleTestCase):
+    """Runs against the configured Redis (the Lua scripts can't be faked); skipped if it isn't reachable."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from whatsappcrm_backend.redis_client import get_redis_client
+        try:
+            get_redis_client().ping()
+        except Exception as e:
+            raise unittest.SkipTest(f"Redis unavailable: {e}")
+        cls.redis = get_redis_client()
+
+    def setUp(self):
+        self.suffix = uuid.uuid4().hex[:12]
+
+    def tearDown(self):
+        keys = list(self.redis.scan_iter(f"*{self.suffix}*"))
+        if keys:
+            self.redis.delete(*keys)
+
+
+@override_settings(
+    META_SEND_RATE_LIMIT_PER_SECOND=2, META_SEND_RATE_LIMIT_BURST=2, META_SEND_BROADCAST_RATE_LIMIT_PER_SECOND=1,
+    META_SEND_RATE_LIMIT_RECOVERY_PER_SECOND=0.05, META_SEND_RATE_LIMIT_MIN_FACTOR=0.1, META_SEND_RATE_LIMIT_COOLDOWN_SECONDS=1,
+)
+class SendRateLimiterTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.phone_number_id = f"test-pn-{self.suffix}"
+
+    def _factor(self):
+        return float(self.redis.hget(rate_limiter.FACTOR_KEY.format(phone_number_id=self.phone_number_id), 'value'))
+
+    def test_burst_is_sent_then_wait_is_computed_from_rate(self):
+        self.assertEqual(rate_limiter.acquire_send_token(self.phone_number_id), 0)
+        self.assertEqual(rate_limiter.acquire_send_token(self.phone_number_id), 0)
+        wait = rate_limiter.acquire_send_token(self.phone_number_id)
+        # One token refills in 1/rate = 0.5s; the first two calls took a few ms of it.
+        self.assertGreater(wait, 0.3)
+        self.assertLessEqual(wait, 0.5)
+
+    def test_waiting_takes_no_token(self):
+        rate_limiter.acquire_send_token(self.phone_number_id)
+        rate_limiter.acquire_send_token(self.phone_number_id)
+        first_wait = rate_limiter.acquire_send_token(self.phone_number_id)
+        second_wait = rate_limiter.acquire_send_token(self.phone_number_id)
+        self.assertLessEqual(second_wait, first_wait)
+
+    def test_broadcasts_also_draw_from_the_broadcast_bucket(self):
+        self.assertEqual(rate_limiter.acquire_send_token(self.phone_number_id, rate_limiter.LANE_BROADCAST), 0)
+        self.assertGreater(rate_limiter.acquire_send_token(self.phone_number_id, rate_limiter.LANE_BROADCAST), 0)
+        # The conversational lane still has the rest of the number's burst.
+        self.assertEqual(rate_limiter.acquire_send_token(self.phone_number_id), 0)
+
+    def test_throttling_halves_the_factor_once_per_cooldown(self):
+        rate_limiter.record_rate_limited(self.phone_number_id)
+        self.assertAlmostEqual(self._factor(), 0.5, places=2)
+        # Throttles of sends that were already in flight don't cut the rate again.
+        rate_limiter.record_rate_limited(self.phone_number_id)
+        self.assertAlmostEqual(self._factor(), 0.5, places=2)
+
+        self.redis.delete(rate_limiter.COOLDOWN_KEY.format(phone_number_id=self.phone_number_id))
+        rate_limiter.record_rate_limited(self.phone_number_id)
+        self.assertAlmostEqual(self._factor(), 0.25, places=2)
+
+    def test_sends_wait_for_the_cooldown(self):
+        rate_limiter.record_rate_limited(self.phone_number_id)
+        wait = rate_limiter.acquire_send_token(self.phone_number_id)
+        self.assertGreater(wait, 0.5)
+        self.assertLessEqual(wait, 1)
+
+    def test_rate_limit_responses_raise(self):
+        with self.assertRaises(rate_limiter.MetaRateLimitError) as raised:
+            rate_limiter.handle_rate_limit_response({'error': {'code': 130429}}, self.phone_number_id)
+        self.assertEqual(raised.exception.retry_after, 1)
+        self.assertAlmostEqual(self._factor(), 0.5, places=2)
+
+        # A pair rate limit only concerns one contact: the number's rate is left alone.
+        other_number = f"test-pn-pair-{self.suffix}"
+        with self.assertRaises(rate_limiter.MetaRateLimitError):
+            rate_limiter.handle_rate_limit_response({'error': {'code': rate_limiter.PAIR_RATE_LIMIT_ERROR_CODE}}, other_number)
+        self.assertFalse(self.redis.exists(rate_limiter.FACTOR_KEY.format(phone_number_id=other_number)))
+
+        rate_limiter.handle_rate_limit_response({'error': {'code': 100}}, self.phone_number_id)
+
+
+class SendSequencerTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        # Contact ids only appear in key names; a random one keeps tests apart from real queues.
+        self.contact_id = int(self.suffix, 16)
+        self.token = f"token-{self.suffix}"
+        self.lease_key = sequencer.LEASE_KEY.format(contact_id=self.contact_id)
+        self.queue_key = sequencer.QUEUE_KEY.format(contact_id=self.contact_id)
+
+    def tearDown(self):
+        self.redis.srem(sequencer.ACTIVE_CONTACTS_KEY, self.contact_id)
+        self.redis.delete(self.lease_key, self.queue_key)
+        super().tearDown()
+
+    def _hold_lease(self):
+        self.redis.set(self.lease_key, self.token, ex=sequencer.LEASE_SECONDS)
+        self.redis.sadd(sequencer.ACTIVE_CONTACTS_KEY, self.contact_id)
+
+    def test_enqueue_keeps_order_and_schedules_one_drain(self):
+        with mock.patch.object(sequencer, '_schedule_drain') as schedule_drain:
+            sequencer._enqueue(self.contact_id, [11, 12], 1, rate_limiter.LANE_CONVERSATIONAL)
+            sequencer._enqueue(self.contact_id, [13], 1, rate_limiter.LANE_BROADCAST)
+        schedule_drain.assert_called_once()
+        self.assertEqual(sequencer.peek(self.contact_id), (11, 1, rate_limiter.LANE_CONVERSATIONAL))
+        sequencer.pop(self.contact_id)
+        sequencer.pop(self.contact_id)
+        self.assertEqual(sequencer.peek(self.contact_id), (13, 1, rate_limiter.LANE_BROADCAST))
+
+    def test_renew_lease_only_for_its_holder(self):
+        self._hold_lease()
+        self.assertTrue(sequencer.renew_lease(self.contact_id, self.token, 120))
+        self.assertGreater(self.redis.ttl(self.lease_key), sequencer.LEASE_SECONDS)
+        self.assertFalse(sequencer.renew_lease(self.contact_id, 'another-token'))
+
+    def test_release_if_idle(self):
+        self._hold_lease()
+        self.redis.rpush(self.queue_key, f"1:1:{rate_limiter.LANE_CONVERSATIONAL}")
+        self.assertEqual(sequencer.release_if_idle(self.contact_id, self.token), 0)
+        self.assertTrue(self.redis.exists(self.lease_key))
+
+        sequencer.pop(self.contact_id)
+        self.assertEqual(sequencer.release_if_idle(self.contact_id, self.token), 1)
+        self.assertFalse(self.redis.exists(self.lease_key))
+        self.assertFalse(self.redis.sismember(sequencer.ACTIVE_CONTACTS_KEY, self.contact_id))
+
+    def test_release_if_idle_after_losing_the_lease(self):
+        self.redis.set(self.lease_key, 'another-token', ex=sequencer.LEASE_SECONDS)
+        self.assertEqual(sequencer.release_if_idle(self.contact_id, self.token), -1)
+        self.assertEqual(self.redis.get(self.lease_key), 'another-token')
+
+    def test_awaited_delivery_resumes_once(self):
+        self._hold_lease()
+        wamid = f"wamid.{self.suffix}"
+        with mock.patch.object(sequencer, '_schedule_drain'):
+            sequencer.await_delivery(self.contact_id, self.token, wamid)
+        self.assertEqual(sequencer.stop_awaiting(wamid), (self.contact_id, self.token))
+        # The timeout drain finds the wait already ended and leaves the queue to the resumed drain.
+        self.assertIsNone(sequencer.stop_awaiting(wamid))
+
+
+class WebhookDedupTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.event_key = f"wamid.{self.suffix}"
+
+    def test_checking_does_not_mark(self):
+        self.assertFalse(dedup.is_seen(self.event_key))
+        # A delivery still being processed must not hide its redelivery.
+        self.assertFalse(dedup.is_seen(self.event_key))
+        self.assertFalse(self.redis.exists(dedup.SEEN_KEY.format(event_key=self.event_key)))
+
+    def test_marked_event_is_seen(self):
+        dedup.mark_seen([self.event_key])
+        self.assertTrue(self.redis.exists(dedup.SEEN_KEY.format(event_key=self.event_key)))
+        self.assertTrue(dedup.is_seen(self.event_key))
+
+
+class DrainSendQueueRetryTests(SimpleTestCase):
+    """A message that keeps failing must not block its contact's queue once its retries run out."""
+
+    def _run(self, retries):
+        from meta_integration import tasks
+
+        outgoing_msg = mock.Mock(direction='out', wamid=None, status='pending_dispatch')
+        with mock.patch.object(sequencer, 'renew_lease', return_value=True), \
+                mock.patch.object(sequencer, 'peek', return_value=(1, 1, rate_limiter.LANE_CONVERSATIONAL)), \
+                mock.patch.object(sequencer, 'pop') as pop, \
+                mock.patch.object(tasks, 'Message') as message_cls, \
+                mock.patch.object(tasks, 'MetaAppConfig') as config_cls, \
+                mock.patch.object(tasks, 'acquire_send_token', return_value=0), \
+                mock.patch.object(tasks, '_send_outgoing_message', side_effect=ValueError('boom')), \
+                mock.patch.object(tasks.drain_contact_send_queue_task, 'delay') as delay, \
+                mock.patch.object(tasks.drain_contact_send_queue_task, 'retry', side_effect=Retry()) as retry:
+            message_cls.objects.select_related.return_value.filter.return_value.first.return_value = outgoing_msg
+            config_cls.objects.filter.return_value.first.return_value = mock.Mock(phone_number_id='pn')
+            tasks.drain_contact_send_queue_task.apply(args=[7, 'token'], retries=retries)
+        return pop, delay, retry
+
+    def test_failed_send_is_retried_in_place(self):
+        pop, delay, retry = self._run(retries=0)
+        retry.assert_called_once()
+        pop.assert_not_called()
+        delay.assert_not_called()
+
+    def test_exhausted_retries_move_the_queue_on(self):
+        from meta_integration.tasks import drain_contact_send_queue_task
+
+        pop, delay, retry = self._run(retries=drain_contact_send_queue_task.max_retries)
+        retry.assert_not_called()
+        pop.assert_called_once_with(7)
+        delay.assert_called_once_with(7, 'token')
+
+
+class MessageSequenceRetryTests(SimpleTestCase):
+    """The no-Redis fallback must still send the rest of a sequence after one message exhausts its retries."""
+
+    def _run(self, retries):
+        from meta_integration import tasks
+
+        messages = {pk: mock.Mock(direction='out', wamid=None, status='pending_dispatch') for pk in (1, 2, 3)}
+        with mock.patch.object(tasks, 'Message') as message_cls, \
+                mock.patch.object(tasks, 'MetaAppConfig'), \
+                mock.patch.object(tasks, '_send_outgoing_message', side_effect=ValueError('boom')), \
+                mock.patch.object(tasks.send_whatsapp_message_sequence_task, 'delay') as delay, \
+                mock.patch.object(tasks.send_whatsapp_message_sequence_task, 'retry', side_effect=Retry()) as retry:
+            message_cls.objects.select_related.return_value.in_bulk.return_value = messages
+            tasks.send_whatsapp_message_sequence_task.apply(args=[[1, 2, 3], 9], retries=retries)
+        return delay, retry
+
+    def test_failed_message_is_retried_with_the_rest(self):
+        delay, retry = self._run(retries=0)
+        self.assertEqual(retry.call_args.kwargs['args'], [[1, 2, 3], 9])
+        delay.assert_not_called()
+
+    def test_exhausted_retries_continue_with_the_rest(self):
+        from meta_integration.tasks import send_whatsapp_message_sequence_task
+
+        delay, retry = self._run(retries=send_whatsapp_message_sequence_task.max_retries)
+        retry.assert_not_called()
+        delay.assert_called_once_with([2, 3], 9)
+
+
+class ReadReceiptRateLimitTests(SimpleTestCase):
+    def _run(self, attempts):
+        from meta_integration import read_receipts, tasks
+
+        task = tasks.send_coalesced_read_receipt_task
+        with mock.patch.object(read_receipts, 'acquire_send_slot', return_value=False), \
+                mock.patch.object(read_receipts, 'take_pending_receipt', return_value=(1700000000, 'wamid.X')) as take, \
+                mock.patch.object(task, 'apply_async') as apply_async:
+            task.apply(args=[9, '263770000000', attempts])
+        return take, apply_async
+
+    def test_rate_limited_receipt_backs_off(self):
+        from meta_integration import tasks
+
+        countdowns = []
+        for attempts in range(3):
+            take, apply_async = self._run(attempts)
+            take.assert_not_called()
+            self.assertEqual(apply_async.call_args.kwargs['args'], [9, '263770000000', attempts + 1])
+            countdowns.append(apply_async.call_args.kwargs['countdown'])
+        for attempts, countdown in enumerate(countdowns):
+            self.assertGreaterEqual(countdown, 2 ** attempts)
+            self.assertLessEqual(countdown, 2 ** (attempts + 1))
+        _, apply_async = self._run(tasks.READ_RECEIPT_RATE_LIMIT_MAX_ATTEMPTS - 2)
+        self.assertLessEqual(apply_async.call_args.kwargs['countdown'], 2 * tasks.READ_RECEIPT_RATE_LIMIT_MAX_DELAY_SECONDS)
+
+    def test_receipt_is_dropped_after_the_last_attempt(self):
+        from meta_integration import tasks
+
+        take, apply_async = self._run(tasks.READ_RECEIPT_RATE_LIMIT_MAX_ATTEMPTS - 1)
+        apply_async.assert_not_called()
+        take.assert_called_once_with(9, '263770000000')
+
+
+class GraphRequestErrorKindTests(SimpleTestCase):
+    def test_classification(self):
+        from meta_integration.graph_client import request_error_kind
+
+        self.assertEqual(request_error_kind(None), 'transport')
+        self.assertIsNone(request_error_kind(200))
+        self.assertEqual(request_error_kind(429), 'http_4xx')
+        self.assertEqual(request_error_kind(503), 'http_5xx')
+
+
+@mock.patch('meta_integration.services.is_seen', return_value=False)
+class WebhookEventKeyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.config = MetaAppConfig.objects.create(
+            name='key-table-test', verify_token='verify', access_token='token', phone_number_id='111', waba_id='222'
+        )
+
+    def _payload(self, wamid, status=None):
+        value = {'metadata': {'phone_number_id': '111'}}
+        if status:
+            value['statuses'] = [{'id': wamid, 'status': status, 'timestamp': '1700000000'}]
+        else:
+            value['messages'] = [{'id': wamid, 'from': '263770000003', 'type': 'text', 'text': {'body': 'hi'}}]
+        return {'object': 'whatsapp_business_account', 'entry': [{'id': '222', 'changes': [{'field': 'messages', 'value': value}]}]}
+
+    def _deliver(self, payload):
+        processor = WebhookProcessor(self.config)
+        base_log_defaults = {'app_config': self.config, 'payload_object_type': payload['object']}
+        return processor._write_event_logs(processor._collect_events(payload, base_log_defaults))
+
+    def test_first_delivery_claims_the_key_and_logs_the_event(self, is_seen):
+        [event] = self._deliver(self._payload('wamid.KEY1'))
+        self.assertTrue(event.should_process)
+        self.assertTrue(WebhookEventKey.objects.filter(app_config=self.config, event_identifier='wamid.KEY1').exists())
+        self.assertEqual(WebhookEventLog.objects.filter(event_identifier='wamid.KEY1').count(), 1)
+
+    def test_redelivery_of_a_handled_message_is_skipped(self, is_seen):
+        [first] = self._deliver(self._payload('wamid.KEY2'))
+        WebhookEventLog.objects.filter(pk=first.log_entry.pk).update(processing_status='processed')
+
+        [redelivery] = self._deliver(self._payload('wamid.KEY2'))
+        self.assertFalse(redelivery.should_process)
+        self.assertEqual(redelivery.log_entry.pk, first.log_entry.pk)
+        self.assertEqual(WebhookEventKey.objects.filter(event_identifier='wamid.KEY2').count(), 1)
+        log_rows = WebhookEventLog.objects.filter(event_identifier='wamid.KEY2')
+        self.assertEqual([row.processing_status for row in log_rows], ['processed'])
+
+    def test_redelivery_of_a_failed_message_reuses_its_row(self, is_seen):
+        [first] = self._deliver(self._payload('wamid.KEY3'))
+        WebhookEventLog.objects.filter(pk=first.log_entry.pk).update(processing_status='error')
+
+        [redelivery] = self._deliver(self._payload('wamid.KEY3'))
+        self.assertTrue(redelivery.should_process)
+        self.assertEqual(redelivery.log_entry.pk, first.log_entry.pk)
+        self.assertEqual(WebhookEventLog.objects.filter(event_identifier='wamid.KEY3').count(), 1)
+
+    def test_redelivered_status_updates_its_row(self, is_seen):
+        [first] = self._deliver(self._payload('wamid.KEY4', status='delivered'))
+        [redelivery] = self._deliver(self._payload('wamid.KEY4', status='delivered'))
+        self.assertTrue(redelivery.should_process)
+        self.assertEqual(redelivery.log_entry.pk, first.log_entry.pk)
+        self.assertEqual(WebhookEventLog.objects.filter(event_identifier='wamid.KEY4_delivered').count(), 1)
+
+    def test_repeated_event_within_one_payload_is_logged_once(self, is_seen):
+        payload = self._payload('wamid.KEY5')
+        messages = payload['entry'][0]['changes'][0]['value']['messages']
+        messages.append(dict(messages[0]))
+        events = self._deliver(payload)
+        self.assertEqual(len({id(event.log_entry) for event in events}), 1)
+        self.assertEqual(WebhookEventLog.objects.filter(event_identifier='wamid.KEY5').count(), 1)
+
+
+class StatusRecordTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wamid = f"wamid.{self.suffix}"
+        flush_task = mock.patch('meta_integration.tasks.flush_message_statuses_task')
+        flush_task.start()
+        self.addCleanup(flush_task.stop)
+
+    def tearDown(self):
+        self.redis.hdel(status_pipeline.PENDING_STATUSES_KEY, self.wamid)
+        self.redis.hdel(status_pipeline.PENDING_FAILURES_KEY, self.wamid)
+        super().tearDown()
+
+    def _pending_status(self):
+        return json.loads(self.redis.hget(status_pipeline.PENDING_STATUSES_KEY, self.wamid).split('|', 1)[1])['status']
+
+    def test_older_status_does_not_replace_a_newer_one(self):
+        self.assertTrue(status_pipeline.record_status({'id': self.wamid, 'status': 'read', 'timestamp': '1700000002'}))
+        status_pipeline.record_status({'id': self.wamid, 'status': 'delivered', 'timestamp': '1700000001'})
+        self.assertEqual(self._pending_status(), 'read')
+
+    def test_requeued_status_does_not_replace_a_newer_one(self):
+        status_pipeline.record_status({'id': self.wamid, 'status': 'read', 'timestamp': '1700000002'})
+        status_pipeline._requeue({self.wamid: {'status': 'sent', 'timestamp': '1700000000'}}, {})
+        self.assertEqual(self._pending_status(), 'read')
+
+
+class StatusApplyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from conversations.models import Contact
+        cls.contact = Contact.objects.create(whatsapp_id='263770000004', name='Chipo')
+
+    def _message(self, wamid, status):
+        from conversations.models import Message
+        return Message.objects.create(contact=self.contact, direction='out', wamid=wamid, status=status)
+
+    def _apply(self, statuses=None, failures=None):
+        statuses, failures = statuses or {}, failures or {}
+        return status_pipeline._apply_batch(list(set(statuses) | set(failures)), statuses, failures)
+
+    def test_status_moves_forward(self):
+        message = self._message('wamid.S1', 'sent')
+        updated = self._apply({'wamid.S1': {'status': 'delivered', 'timestamp': '1700000000', 'conversation_id': 'c1'}})
+        self.assertEqual([m.pk for m in updated], [message.pk])
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'delivered')
+        self.assertEqual(message.conversation_id_from_meta, 'c1')
+
+    def test_status_never_moves_backwards(self):
+        message = self._message('wamid.S2', 'read')
+        for status in ('delivered', 'sent', 'read'):
+            self.assertEqual(self._apply({'wamid.S2': {'status': status, 'timestamp': '1700000000'}}), [])
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'read')
+
+    def test_failure_only_applies_before_delivery(self):
+        delivered = self._message('wamid.S3', 'delivered')
+        sent = self._message('wamid.S4', 'sent')
+        failure = {'status': 'failed', 'timestamp': '1700000000', 'errors': [{'code': 131026}]}
+        updated = self._apply(failures={'wamid.S3': failure, 'wamid.S4': failure})
+        self.assertEqual([m.pk for m in updated], [sent.pk])
+        delivered.refresh_from_db()
+        sent.refresh_from_db()
+        self.assertEqual(delivered.status, 'delivered')
+        self.assertEqual(sent.status, 'failed')
+        self.assertEqual(sent.error_details, [{'code': 131026}])
+
+
+class WebhookReplayTests(SimpleTestCase):
+    def _log_entry(self, pk, event_type='message_text', payload=None, config_id=1):
+        return SimpleNamespace(
+            pk=pk, event_type=event_type, event_identifier=f"evt-{pk}",
+            payload={'id': f"wamid.R{pk}", 'from': '263770000007'} if payload is None else payload,
+            phone_number_id_received='111', waba_id_received='222',
+            app_config=mock.Mock(), app_config_id=config_id,
+        )
+
+    def test_build_payload_wraps_message_and_status(self):
+        message = replay.build_payload(self._log_entry(1))
+        value = message['entry'][0]['changes'][0]['value']
+        self.assertEqual(value['messages'], [{'id': 'wamid.R1', 'from': '263770000007'}])
+        self.assertEqual(value['metadata'], {'phone_number_id': '111'})
+        status = replay.build_payload(self._log_entry(2, 'message_status', {'id': 'wamid.R2', 'recipient_id': '263770000008'}))
+        self.assertIn('statuses', status['entry'][0]['changes'][0]['value'])
+        self.assertIsNone(replay.build_payload(self._log_entry(3, 'unknown')))
+
+    def test_ordering_key_groups_by_contact(self):
+        self.assertEqual(replay.ordering_key(self._log_entry(1)), '263770000007')
+        status = self._log_entry(2, 'message_status', {'id': 'wamid.R2', 'recipient_id': '263770000008'})
+        self.assertEqual(replay.ordering_key(status), '263770000008')
+        self.assertEqual(replay.ordering_key(self._log_entry(3, 'account_update', {})), '3')
+
+    def test_limit_is_applied_in_received_order(self):
+        queryset = mock.MagicMock()
+        rows = queryset.select_related.return_value.order_by.return_value
+        rows.__getitem__.return_value.iterator.return_value = [self._log_entry(1), self._log_entry(2, 'unknown')]
+        stats = replay.ReplayEngine(dry_run=True).run(queryset, limit=2)
+        queryset.select_related.return_value.order_by.assert_called_once_with('received_at', 'id')
+        rows.__getitem__.assert_called_once_with(slice(None, 2))
+        self.assertEqual((stats['read'], stats['replayed'], stats['skipped']), (2, 1, 1))
+
+    def test_in_process_replay_keeps_event_identifier(self):
+        work_queue = queue.Queue()
+        for log_entry in (self._log_entry(1), self._log_entry(2), None):
+            work_queue.put(log_entry)
+        engine = replay.ReplayEngine()
+        with mock.patch('meta_integration.services.WebhookProcessor') as processor_cls, \
+                mock.patch.object(replay, 'connections'):
+            processor_cls.return_value.process.return_value = True
+            engine._work(work_queue)
+        processor_cls.assert_called_once()
+        self.assertEqual(processor_cls.call_args.kwargs, {'replay': True})
+        identifiers = [call.kwargs['replayed_identifier'] for call in processor_cls.return_value.process.call_args_list]
+        self.assertEqual(identifiers, ['evt-1', 'evt-2'])
+        self.assertEqual(engine.stats['replayed'], 2)
+
+    def test_failed_event_is_counted(self):
+        work_queue = queue.Queue()
+        work_queue.put(self._log_entry(1))
+        work_queue.put(None)
+        engine = replay.ReplayEngine()
+        with mock.patch('meta_integration.services.WebhookProcessor') as processor_cls, \
+                mock.patch.object(replay, 'connections'):
+            processor_cls.return_value.process.side_effect = RuntimeError('boom')
+            engine._work(work_queue)
+        self.assertEqual(engine.stats['failed'], 1)
+
+
+class AsyncSendDispatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.dispatcher = async_dispatcher.AsyncSendDispatcher()
+        self.dispatcher._client = mock.Mock(post=mock.AsyncMock())
+        self.message = mock.Mock(id=7, contact=mock.Mock(whatsapp_id='263770000009'), message_type='text', content_payload={'body': 'hi'})
+        patcher = mock.patch.object(async_dispatcher, 'build_message_request', return_value=('https://graph.test/messages', {}, {}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _post(self):
+        with mock.patch.object(async_dispatcher, 'record_request') as record_request:
+            try:
+                return asyncio.run(self.dispatcher._post(self.message, mock.Mock())), record_request
+            except httpx.HTTPError as e:
+                return e, record_request
+
+    def test_post_returns_response_and_records_status(self):
+        self.dispatcher._client.post.return_value = mock.Mock(status_code=200, json=mock.Mock(return_value={'messages': [{'id': 'wamid.A1'}]}))
+        response, record_request = self._post()
+        self.assertEqual(response, {'messages': [{'id': 'wamid.A1'}]})
+        self.assertEqual(record_request.call_args.args[:2] + record_request.call_args.args[3:], ('messages', 'POST', 200))
+
+    def test_post_returns_meta_error_body(self):
+        self.dispatcher._client.post.return_value = mock.Mock(status_code=400, text='bad', json=mock.Mock(return_value={'error': {'code': 100}}))
+        response, record_request = self._post()
+        self.assertEqual(response, {'error': {'code': 100}})
+        self.assertEqual(record_request.call_args.args[3], 400)
+
+    def test_transport_error_is_recorded_and_raised(self):
+        self.dispatcher._client.post.side_effect = httpx.ConnectError('refused')
+        error, record_request = self._post()
+        self.assertIsInstance(error, httpx.ConnectError)
+        self.assertIsNone(record_request.call_args.args[3])
+
+    def _flush(self, results, write_error=None):
+        async def flush():
+            loop = asyncio.get_running_loop()
+            futures = [loop.create_future() for _ in results]
+            self.dispatcher._pending_results = list(zip(results, futures))
+            with mock.patch.object(self.dispatcher, '_write_results', side_effect=write_error) as write_results:
+                await self.dispatcher._flush()
+            return futures, write_results
+        return asyncio.run(flush())
+
+    def test_flush_writes_batch_and_releases_drains(self):
+        results = [mock.Mock(), mock.Mock()]
+        futures, write_results = self._flush(results)
+        write_results.assert_called_once_with(results)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.dispatcher._pending_results, [])
+
+    def test_failed_flush_keeps_results_for_the_next_one(self):
+        results = [mock.Mock(), mock.Mock()]
+        futures, _ = self._flush(results, write_error=RuntimeError('db down'))
+        self.assertFalse(any(future.done() for future in futures))
+        self.assertEqual([message for message, _ in self.dispatcher._pending_results], results)
+
+
+class PayloadMigrationRoundTripTests(TransactionTestCase):
+    """Migrates the JSON payload columns into blobs and back (conversations 0003-0005, meta_integration 0004-0008)."""
+    before = [('meta_integration', '0005_webhookeventkey'), ('conversations', '0003_message_payload_blob')]
+    after = [('meta_integration', '0008_payloadblob_last_referenced_at'), ('conversations', '0005_remove_message_content_payload')]
+
+    def setUp(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("The webhook log migrations need PostgreSQL (partitioned table).")
+        self.addCleanup(self._migrate_to_latest)
+
+    def _migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def _migrate_to_latest(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_payloads_survive_the_round_trip(self):
+        event_payload = {'id': 'wamid.MIG1', 'type': 'text', 'text': {'body': 'Mhoro'}}
+        message_payload = {'text': {'body': 'Mhoro'}, 'ünicode': ['✓', 1.5, None]}
+
+        apps = self._migrate(self.before)
+        config = apps.get_model('meta_integration', 'MetaAppConfig').objects.create(
+            name='migration-test', verify_token='verify', access_token='token', phone_number_id='111', waba_id='222'
+        )
+        log = apps.get_model('meta_integration', 'WebhookEventLog').objects.create(
+            app_config=config, event_identifier='wamid.MIG1', event_type='message_text', payload=event_payload
+        )
+        contact = apps.get_model('conversations', 'Contact').objects.create(whatsapp_id='263770000007')
+        messages = [
+            apps.get_model('conversations', 'Message').objects.create(
+                contact=contact, direction='out', content_payload=message_payload
+            ) for _ in range(2)
+        ]
+
+        apps = self._migrate(self.after)
+        PayloadBlob = apps.get_model('meta_integration', 'PayloadBlob')
+        migrated_log = apps.get_model('meta_integration', 'WebhookEventLog').objects.get(pk=log.pk)
+        codec, data = PayloadBlob.objects.filter(pk=migrated_log.payload_blob_id).values_list('codec', 'data').get()
+        self.assertEqual(payload_store.decode_payload(codec, data), event_payload)
+        message_blob_ids = set(apps.get_model('conversations', 'Message').objects.filter(
+            pk__in=[message.pk for message in messages]
+        ).values_list('payload_blob_id', flat=True))
+        # Identical payloads share one blob, keyed like payloads stored at runtime.
+        self.assertEqual(message_blob_ids, {payload_store.payload_digest(message_payload)})
+
+        apps = self._migrate(self.before)
+        self.assertEqual(apps.get_model('meta_integration', 'WebhookEventLog').objects.get(pk=log.pk).payload, event_payload)
+        for message in apps.get_model('conversations', 'Message').objects.filter(pk__in=[message.pk for message in messages]):
+            self.assertEqual(message.content_payload, message_payload)
@@ -4,8 +4,8 @@ import requests
 import json
 import logging
 from typing import Optional, Tuple
-# from django.conf import settings # No longer using settings for API creds
 from .models import MetaAppConfig # Import the model
+from .graph_client import get_graph_client, graph_api_base_url
 from django.core.exceptions import ObjectDoesNotExist
 
 logger = logging.getLogger(__name__)
@@ -24,6 +24,32 @@ def get_active_meta_config_for_sending():
         logger.critical("CRITICAL: Multiple active Meta App Configurations found. Please fix in Django Admin. Message sending may be unpredictable.")
         return None # Or select the first one, but it's better to enforce a single active config
 
+def build_message_request(to_phone_number: str, message_type: str, data: dict, config: MetaAppConfig) -> Tuple[str, dict, dict]:
+    """
+    Builds the (url, headers, JSON payload) of a Graph API message send. Shared by send_whatsapp_message
+    and the asyncio dispatcher (meta_integration.async_dispatcher).
+    """
+    url = f"{graph_api_base_url()}/{config.api_version}/{config.phone_number_id}/messages"
+
+    headers = {
+        "Authorization": f"Bearer {config.access_token}",
+        "Content-Type": "application/json",
+    }
+
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to_phone_number,
+        "type": message_type,
+        message_type: data,
+    }
+
+    if message_type == "text" and "preview_url" in data:
+        if not isinstance(data["preview_url"], bool):
+            logger.warning(f"Correcting preview_url to boolean for text message. Original: {data['preview_url']}")
+            data["preview_url"] = str(data["preview_url"]).lower() == 'true'
+        payload[message_type]["preview_url"] = data["preview_url"]
+    return url, headers, payload
+
 def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, config: MetaAppConfig = None):
     """
     Sends a WhatsApp message using the Meta Graph API.
@@ -36,7 +62,8 @@ def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, c
         config (MetaAppConfig, optional): The MetaAppConfig instance to use. 
                                           If None, tries to fetch the active one.
     Returns:
-        dict: The JSON response from Meta API, or None if an error occurs.
+        dict: The JSON response from Meta API, Meta's error response (with an 'error' key) if the
+              request was rejected, or None if another error occurs.
     """
     if not config:
         config = get_active_meta_config_for_sending()
@@ -45,39 +72,12 @@ def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, c
         logger.error("Cannot send WhatsApp message: No active MetaAppConfig available.")
         return None
 
-    api_version = config.api_version
-    phone_number_id = config.phone_number_id
-    access_token = config.access_token
-
-    # No need to check settings from django.conf anymore
-    # if not all([api_version, phone_number_id, access_token]):
-    #     logger.error("Meta API settings (version, phone_number_id, access_token) are not configured in the active DB record.")
-    #     return None
-
-    url = f"https://graph.facebook.com/{api_version}/{phone_number_id}/messages"
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to_phone_number,
-        "type": message_type,
-        message_type: data,
-    }
-
-    if message_type == "text" and "preview_url" in data:
-        if not isinstance(data["preview_url"], bool):
-            logger.warning(f"Correcting preview_url to boolean for text message. Original: {data['preview_url']}")
-            data["preview_url"] = str(data["preview_url"]).lower() == 'true'
-        payload[message_type]["preview_url"] = data["preview_url"]
+    url, headers, payload = build_message_request(to_phone_number, message_type, data, config)
 
     logger.debug(f"Sending WhatsApp message via config '{config.name}'. URL: {url}, Payload: {json.dumps(payload)}")
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=20)
+        response = get_graph_client().post(url, 'messages', headers=headers, json=payload, timeout=20)
         response.raise_for_status()
         
         response_json = response.json()
@@ -89,6 +89,7 @@ def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, c
         try:
             error_details = e.response.json()
             logger.error(f"Meta API error details: {error_details}")
+            return error_details # Callers inspect the error code (e.g. rate limits, see rate_limiter)
         except json.JSONDecodeError:
             logger.error("Could not decode Meta API error response as JSON.")
     except requests.exceptions.RequestException as e:
@@ -113,7 +114,7 @@ def send_read_receipt_api(wamid: str, config: MetaAppConfig):
         logger.error("Cannot send read receipt: No MetaAppConfig provided.")
         return None
 
-    url = f"https://graph.facebook.com/{config.api_version}/{config.phone_number_id}/messages"
+    url = f"{graph_api_base_url()}/{config.api_version}/{config.phone_number_id}/messages"
     
     headers = {
         "Authorization": f"Bearer {config.access_token}",
@@ -129,7 +130,7 @@ def send_read_receipt_api(wamid: str, config: MetaAppConfig):
     logger.debug(f"Sending read receipt via config '{config.name}'. URL: {url}, Payload: {json.dumps(payload)}")
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=15)
+        response = get_graph_client().post(url, 'read_receipt', headers=headers, json=payload, timeout=15)
         response.raise_for_status()
         
         response_json = response.json()
@@ -199,11 +200,11 @@ def download_whatsapp_media(wamid: str, config: MetaAppConfig) -> Optional[Tuple
         return None
 
     # 1. Get Media URL
-    get_url_endpoint = f"https://graph.facebook.com/{config.api_version}/{wamid}/"
+    get_url_endpoint = f"{graph_api_base_url()}/{config.api_version}/{wamid}/"
     headers = {"Authorization": f"Bearer {config.access_token}"}
     
     try:
-        response = requests.get(get_url_endpoint, headers=headers, timeout=10)
+        response = get_graph_client().get(get_url_endpoint, 'media_info', headers=headers, timeout=10)
         response.raise_for_status()
         media_info = response.json()
         media_url = media_info.get("url")
@@ -214,8 +215,8 @@ def download_whatsapp_media(wamid: str, config: MetaAppConfig) -> Optional[Tuple
             return None
 
         # 2. Download Media Content from the obtained URL
-        media_response = requests.get(
-            media_url,
+        media_response = get_graph_client().get(
+            media_url, 'media_download',
             headers={"Authorization": f"Bearer {config.access_token}"},
             timeout=20
         )
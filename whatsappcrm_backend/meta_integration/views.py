@@ -10,7 +10,8 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 # get_object_or_404 is used by ViewSets implicitly or can be used directly
 from django.utils import timezone # For WebhookEventLog _save_log and MetaWebhookAPIView handlers
-from datetime import datetime # For WebhookEventLog _handle_message
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta
 from django.db import transaction
 from django.conf import settings # To get APP_SECRET
 
@@ -30,11 +31,10 @@ from .serializers import (
 )
 # from .utils import send_whatsapp_message # send_whatsapp_message_task is used from tasks now
 
-# --- Cross-app imports to be localized or already localized ---
-# from flows.services import process_message_for_flow # Imported locally in _handle_message
-# from conversations.services import get_or_create_contact_by_wa_id # Imported locally in post
-from conversations.models import Message # Imported locally in _handle_message
-from .tasks import send_read_receipt_task
+# --- Payload processing lives in services.WebhookProcessor ---
+from .services import WebhookProcessor
+from .ingestion import is_buffered_ingestion_enabled, enqueue_webhook
+from .tasks import replay_webhook_events_task
 
 logger = logging.getLogger('meta_integration') # Using the app-specific logger from your original file
 
@@ -100,12 +100,47 @@ class WebhookEventLogViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [permissions.IsAdminUser] # Or IsAdminOrReadOnly if non-staff can view
     # filter_backends = [...] # Add if you use django-filter
     filterset_fields = ['event_type', 'processing_status', 'event_identifier', 'phone_number_id_received', 'waba_id_received', 'app_config__name']
-    search_fields = ['payload', 'processing_notes', 'event_identifier', 'message__contact__whatsapp_id', 'message__contact__name']
+    search_fields = ['processing_notes', 'event_identifier', 'message__contact__whatsapp_id', 'message__contact__name']
     ordering_fields = ['received_at', 'processed_at', 'event_type']
 
     def get_serializer_class(self):
         return WebhookEventLogListSerializer if self.action == 'list' else WebhookEventLogSerializer
 
+    # Lower received_at bound of list queries, echoed so clients can tell when the default window was applied.
+    RECEIVED_AFTER_HEADER = 'X-Received-After'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action not in ('list', 'latest'):
+            return queryset
+        # Bound list queries by received_at so they only scan the relevant partitions.
+        # ?received_after=/?received_before= (ISO 8601) override the default window.
+        received_after = self._parse_datetime_param('received_after')
+        received_before = self._parse_datetime_param('received_before')
+        if received_after is None:
+            received_after = timezone.now() - timedelta(days=getattr(settings, 'WEBHOOK_LOG_DEFAULT_WINDOW_DAYS', 7))
+        self.received_after = received_after
+        queryset = queryset.filter(received_at__gte=received_after)
+        if received_before is not None:
+            queryset = queryset.filter(received_at__lt=received_before)
+        return queryset
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        received_after = getattr(self, 'received_after', None)
+        if received_after is not None:
+            response[self.RECEIVED_AFTER_HEADER] = received_after.isoformat()
+        return response
+
+    def _parse_datetime_param(self, name):
+        try:
+            value = parse_datetime(self.request.query_params.get(name, ''))
+        except ValueError:
+            return None
+        if value is not None and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value
+
     @action(detail=False, methods=['get'])
     def latest(self, request):
         count_str = request.query_params.get('count', '25')
@@ -126,22 +161,23 @@ class WebhookEventLogViewSet(viewsets.ReadOnlyModelViewSet):
         if log_entry.processing_status not in ['error', 'failed'] and not log_entry.event_type.startswith('message'):
              return Response({"error": "Only 'message' events or events in 'error'/'failed' state can typically be reprocessed this way."}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Basic reprocessing: Set status to 'pending_reprocessing'
-        # A Celery task or a separate management command would pick these up.
+        # Mark the row and replay it through WebhookProcessor (see meta_integration.replay).
         log_entry.processing_status = 'pending_reprocessing'
         log_entry.processing_notes = (log_entry.processing_notes or "") + \
                                      f"\nManually marked for reprocessing by {request.user} on {timezone.now().isoformat()}."
         log_entry.processed_at = None # Clear processed_at for reprocessing
         log_entry.save(update_fields=['processing_status', 'processing_notes', 'processed_at'])
+        replay_webhook_events_task.delay([log_entry.id])
         logger.info(f"WebhookEventLog {log_entry.id} (Event: {log_entry.event_type}) marked for reprocessing by user {request.user}.")
-        return Response({"message": f"Event {log_entry.id} marked for reprocessing."}, status=status.HTTP_202_ACCEPTED)
+        return Response({"message": f"Event {log_entry.id} queued for reprocessing."}, status=status.HTTP_202_ACCEPTED)
 
 
 @method_decorator(csrf_exempt, name='dispatch')
 class MetaWebhookAPIView(View):
     """
     Handles incoming webhook events from Meta (Facebook/WhatsApp).
-    (Content from your uploaded meta_integration/views.py, with localized imports for flows and conversations)
+    Verifies the signature, then either processes the payload with WebhookProcessor or,
+    with META_WEBHOOK_INGESTION_MODE=buffered, hands it to the ingestion workers.
     """
 
     def _verify_signature(self, request_body_bytes, x_hub_signature_256, app_secret_key):
@@ -166,11 +202,7 @@ class MetaWebhookAPIView(View):
         logger.debug("Webhook signature verified successfully.")
         return True
 
-    @transaction.atomic
     def post(self, request: HttpRequest, *args, **kwargs): # app_id_or_name removed as it's not in urls.py for this view
-        # Local import
-        from conversations.services import get_or_create_contact_by_wa_id
-
         logger.info(f"Webhook POST request received.") # Removed app_id_or_name
         logger.debug(f"Request headers: {request.headers}")
         # logger.debug(f"Request body (raw): {request.body[:1000]}") # Log more if needed
@@ -196,304 +228,19 @@ class MetaWebhookAPIView(View):
             return HttpResponse("Invalid signature", status=403)
 
         raw_payload_str = request.body.decode('utf-8', errors='ignore')
-        try:
-            payload = json.loads(raw_payload_str)
-        except json.JSONDecodeError as e:
-            # ... (logging to WebhookEventLog as in your original code) ...
-            logger.error(f"Invalid JSON in webhook: {e}. Body: {raw_payload_str[:500]}...")
-            WebhookEventLog.objects.create(
-                app_config=active_config, event_type='error',
-                payload={'error': 'Invalid JSON', 'body_snippet': raw_payload_str[:500], 'exception': str(e)},
-                processing_status='error', processing_notes='Failed to parse JSON.'
-            )
-            return HttpResponse("Invalid JSON payload", status=400)
-
-        log_entry = None # Initialize
-        base_log_defaults = {
-            'app_config': active_config, 'payload_object_type': payload.get("object")
-        }
-
-        try:
-            # The complex dispatch logic from your meta_integration/views.py post method
-            # (identifying messages, statuses, errors from payload structure)
-            if payload.get("object") == "whatsapp_business_account":
-                for entry_idx, entry in enumerate(payload.get("entry", [])):
-                    waba_id = entry.get("id")
-                    for change_idx, change in enumerate(entry.get("changes", [])):
-                        value = change.get("value", {})
-                        field = change.get("field")
-                        metadata = value.get("metadata", {})
-                        phone_id = metadata.get("phone_number_id")
-                        logger.info(f"Processing entry[{entry_idx}].change[{change_idx}]: field='{field}', phone_id='{phone_id}'")
-                        log_defaults_for_change = {**base_log_defaults, 'waba_id_received': waba_id, 'phone_number_id_received': phone_id}
-
-                        if field == "messages":
-                            if "messages" in value:
-                                for msg_data in value["messages"]:
-                                    wamid = msg_data.get("id")
-                                    # Use update_or_create for WebhookEventLog to handle retries from Meta
-                                    log_entry, created_log = WebhookEventLog.objects.update_or_create(
-                                        event_identifier=wamid, # Assuming WAMID is unique identifier for message events
-                                        app_config=active_config, # Ensure app_config is part of uniqueness if wamid can repeat across configs
-                                        defaults={
-                                            'payload_object_type': payload.get("object"),
-                                            'waba_id_received': waba_id,
-                                            'phone_number_id_received': phone_id,
-                                            'event_type': f"message_{msg_data.get('type', 'unknown')}",
-                                            'payload': msg_data,
-                                            'processing_status': 'pending' # Reset to pending if reprocessing
-                                        }
-                                    )
-                                    if created_log or log_entry.processing_status in ['pending', 'pending_reprocessing', 'error']: # Process if new or needs reprocessing
-                                        contact_wa_id = msg_data.get("from")
-                                        profile_name = value.get("contacts", [{}])[0].get("profile", {}).get("name", "Unknown")
-                                        contact, _ = get_or_create_contact_by_wa_id(
-                                            wa_id=contact_wa_id,
-                                            name=profile_name,
-                                            meta_app_config=active_config
-                                        )
-                                        self._handle_message(msg_data, metadata, value, active_config, log_entry, contact)
-                                    else:
-                                        logger.info(f"Skipping already processed/ignored WebhookEventLog for WAMID: {wamid} (DB ID: {log_entry.id})")
-                            
-                            elif "statuses" in value:
-                                for status_data in value["statuses"]:
-                                    wamid = status_data.get("id") # This is the WAMID of the message being updated
-                                    status_val = status_data.get("status")
-                                    
-                                    # Create a more unique identifier for status updates to avoid overwriting.
-                                    # A single message (wamid) can have multiple statuses (sent, delivered, read).
-                                    status_identifier = f"{wamid}_{status_val}"
-
-                                    log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                        event_identifier=status_identifier, app_config=active_config,
-                                        defaults={'event_type': 'message_status', 
-                                                  **log_defaults_for_change, 'payload': status_data, 
-                                                  'processing_status': 'pending'}
-                                    )
-                                    self.handle_status_update(status_data, metadata, active_config, log_entry)
-                            # Add elif for "errors" here similar to above if needed
-                            elif "errors" in value:
-                                for error_data in value["errors"]:
-                                    # This is for errors related to a specific message attempt
-                                    error_code = error_data.get('code')
-                                    log_id = f"error_{error_code}_{timezone.now().timestamp()}"
-                                    log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                        event_identifier=log_id, app_config=active_config, event_type='error',
-                                        defaults={**log_defaults_for_change, 'payload': error_data, 'processing_status': 'pending'}
-                                    )
-                                    self.handle_error_notification(error_data, metadata, active_config, log_entry)
-                            else:
-                                logger.warning(f"Change field is 'messages' but no 'messages' or 'statuses' key. Value keys: {value.keys()}")
-                        # Add other field handlers ('message_template_status_update', etc.)
-                        elif field == "account_update":
-                            log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                event_identifier=f"{field}_{value.get('event', 'unknown')}_{entry.get('id', 'unknown')}_{timezone.now().timestamp()}",
-                                app_config=active_config, event_type='account_update',
-                                defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
-                            )
-                            self.handle_account_update(value, metadata, active_config, log_entry)
-                        elif field == "message_template_status_update":
-                            log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                event_identifier=f"{field}_{value.get('message_template_id')}_{value.get('event')}",
-                                app_config=active_config, event_type='template_status',
-                                defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
-                            )
-                            self.handle_template_status_update(value, metadata, active_config, log_entry)
-                        else:
-                            generic_event_id = f"{field}_{entry.get('id', 'unknown')}_{change_idx}_{timezone.now().timestamp()}"
-                            log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                event_identifier=generic_event_id, app_config=active_config, event_type=field or 'unknown_field',
-                                defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
-                            )
-                            logger.warning(f"Unhandled change field '{field}'. Logged with ID {log_entry.id}")
-                            self._save_log(log_entry, 'ignored', f"Unhandled field: {field}")
-
-
-            else: # Other object types
-                generic_event_id = f"{payload.get('object', 'unknown_object')}_{timezone.now().timestamp()}"
-                log_entry, _ = WebhookEventLog.objects.update_or_create(
-                    event_identifier=generic_event_id, app_config=active_config,
-                    defaults={**base_log_defaults, 'payload': payload, 'processing_status': 'pending'}
-                )
-                logger.warning(f"Received webhook for unhandled object type: {payload.get('object')}")
-                self._save_log(log_entry, 'ignored', f"Unhandled object: {payload.get('object')}")
 
+        # In buffered mode the body is only appended to a Redis stream and processed by the
+        # `run_webhook_ingestion` workers, so Meta gets its 200 without waiting on the database.
+        if is_buffered_ingestion_enabled() and enqueue_webhook(active_config.id, raw_payload_str):
             return HttpResponse("EVENT_RECEIVED", status=200)
 
-        except Exception as e: # Catch-all for other unexpected errors during processing
-            logger.error(f"General error processing webhook: {e}", exc_info=True)
-            current_payload_for_log = payload if 'payload' in locals() else {'raw_error_body': raw_payload_str, 'exception_point': 'general_processing'}
-            
-            if log_entry and log_entry.pk: # If log_entry was created
-                self._save_log(log_entry, 'failed', f"General processing error: {str(e)[:250]}")
-            else: # If error happened before log_entry for this specific event part was created
-                 WebhookEventLog.objects.create(
-                    **base_log_defaults,
-                    event_identifier=f"error_{timezone.now().timestamp()}",
-                    processing_status='failed',
-                    payload=current_payload_for_log,
-                    event_type='unhandled_exception',
-                    processing_notes=f"General processing error: {str(e)[:250]}"
-                )
+        processor = WebhookProcessor(active_config)
+        payload = processor.parse_body(raw_payload_str)
+        if payload is None:
+            return HttpResponse("Invalid JSON payload", status=400)
+        if not processor.process(payload):
             return HttpResponse("Internal Server Error processing event.", status=500)
-
-    # _save_log method from your original file
-    def _save_log(self, log_entry: WebhookEventLog, status_val: str, notes: str = None):
-        old_status = log_entry.processing_status
-        log_entry.processing_status = status_val
-        if notes:
-            log_entry.processing_notes = f"{log_entry.processing_notes}\n{notes}" if log_entry.processing_notes else notes
-        log_entry.processed_at = timezone.now()
-        try:
-            log_entry.save(update_fields=['processing_status', 'processing_notes', 'processed_at'])
-            logger.debug(f"WebhookEventLog ID {log_entry.id} status from '{old_status}' to '{status_val}'.")
-        except Exception as e:
-            logger.error(f"Failed to save WebhookEventLog (ID: {log_entry.pk or 'New'}): {e}", exc_info=True)
-
-
-    @transaction.atomic
-    def _handle_message(self, msg_data: dict, metadata: dict, value_entry: dict, active_config: MetaAppConfig, log_entry: WebhookEventLog, contact):
-        # Local imports
-        from conversations.models import Message
-        from flows.tasks import process_flow_for_message_task
-        # Import Contact for type hinting and for the action loop
-        from conversations.models import Contact
-
-        whatsapp_message_id = msg_data.get("id")
-        logger.info(
-            f"Handling message WAMID: {whatsapp_message_id} for Contact ID: {contact.id} "
-            f"({contact.whatsapp_id})."
-        )
-
-        # --- Start of _handle_message logic (ensure this aligns with your intent) ---
-        message_timestamp_str = msg_data.get("timestamp")
-        message_timestamp = None
-        if message_timestamp_str:
-            try: message_timestamp = timezone.make_aware(datetime.fromtimestamp(int(message_timestamp_str)))
-            except ValueError: logger.warning(f"Could not parse message timestamp: {message_timestamp_str}")
-        if not message_timestamp: message_timestamp = timezone.now()
-
-        incoming_msg_obj, msg_created = Message.objects.update_or_create(
-            wamid=whatsapp_message_id,
-            defaults={
-                'contact': contact,
-                'app_config': active_config, # Link message to app config
-                'direction': 'in',
-                'message_type': msg_data.get("type", "unknown"),
-                'content_payload': msg_data,
-                'timestamp': message_timestamp,
-                'status': 'delivered', # Delivered to your system
-                'status_timestamp': message_timestamp,
-            }
-        )
-        if not msg_created:
-            logger.info(f"Incoming message with WAMID {whatsapp_message_id} already exists. Updating timestamp. Processing will continue to check flow state.")
-            # Potentially update timestamp if newer, or other fields if webhook retries with more info
-            incoming_msg_obj.timestamp = message_timestamp
-            incoming_msg_obj.content_payload = msg_data # Update payload in case of retry
-            incoming_msg_obj.save()
-        else:
-            logger.info(f"Saved incoming message (WAMID: {whatsapp_message_id}) as DB ID {incoming_msg_obj.id}")
-        
-        if log_entry and log_entry.pk:
-            log_entry.message = incoming_msg_obj # Link log to message
-            log_entry.processing_status = 'processing_queued'
-            log_entry.save(update_fields=['message', 'processing_status'])
-        
-        try:
-            # --- ARCHITECTURAL CHANGE ---
-            # Instead of processing the flow synchronously, queue a Celery task.
-            # This makes the webhook response immediate.
-            transaction.on_commit(
-                lambda: process_flow_for_message_task.delay(incoming_msg_obj.id)
-            )
-            logger.info(f"Queued process_flow_for_message_task for message {incoming_msg_obj.id}.")
-
-        except Exception as e:
-            # This block catches unexpected errors in the message handling logic itself,
-            # outside of the `process_message_for_flow` service's internal error handling.
-            logger.error(f"Unhandled exception in _handle_message for WAMID {whatsapp_message_id} (Contact: {contact.id}): {e}", exc_info=True)
-            if log_entry and log_entry.pk:
-                self._save_log(log_entry, 'failed', f"Critical error in webhook handler before queueing: {str(e)[:200]}")
-        
-        # --- Send Read Receipt ---
-        self._send_read_receipt(whatsapp_message_id, active_config)
-
-    def _send_read_receipt(self, wamid: str, app_config: MetaAppConfig):
-        """
-        Dispatches a Celery task to send a read receipt for the given message ID.
-        """
-        if not wamid:
-            logger.warning(f"Cannot send read receipt: Missing WAMID.")
-            return
-
-        send_read_receipt_task.delay(
-            wamid=wamid,
-            config_id=app_config.id
-        )
-        logger.info(f"Dispatched read receipt task for WAMID {wamid}.")
-
-
-    # --- Placeholder for other handlers from your original file ---
-    def handle_status_update(self, status_data, metadata, app_config, log_entry: WebhookEventLog):
-        wamid = status_data.get("id"); status_value = status_data.get("status"); ts_str = status_data.get("timestamp")
-        status_ts = timezone.make_aware(datetime.fromtimestamp(int(ts_str))) if ts_str and ts_str.isdigit() else timezone.now()
-        logger.info(f"Status Update: WAMID={wamid}, Status='{status_value}'")
-        notes = [f"Status for WAMID {wamid} is {status_value}."]
-        try: # noqa
-            msg_to_update = Message.objects.filter(wamid=wamid, direction='out').first()
-            if msg_to_update:
-                update_fields_list = ['status', 'status_timestamp']
-                msg_to_update.status = status_value
-                msg_to_update.status_timestamp = status_ts
-                # Extract and store conversation and pricing if present
-                if 'conversation' in status_data and isinstance(status_data['conversation'], dict):
-                    msg_to_update.conversation_id_from_meta = status_data['conversation'].get('id')
-                    update_fields_list.append('conversation_id_from_meta')
-                if 'pricing' in status_data and isinstance(status_data['pricing'], dict):
-                    msg_to_update.pricing_model_from_meta = status_data['pricing'].get('pricing_model')
-                    update_fields_list.append('pricing_model_from_meta')
-                msg_to_update.save(update_fields=update_fields_list)
-                notes.append("DB record updated.")
-                self._save_log(log_entry, 'processed', " ".join(notes))
-            else: self._save_log(log_entry, 'ignored', f"No matching outgoing msg for WAMID {wamid}.")
-        except Exception as e: logger.error(f"Error updating status for WAMID {wamid}: {e}", exc_info=True); self._save_log(log_entry, 'error', str(e))
-
-    def handle_error_notification(self, error_data, metadata, app_config, log_entry: WebhookEventLog):
-        logger.error(f"Received error notification from Meta: {error_data}")
-        self._save_log(log_entry, 'processed', f"Meta error logged: {error_data.get('title')}")
-
-    def handle_template_status_update(self, status_data, metadata, app_config, log_entry: WebhookEventLog):
-        logger.info(f"Template Status Update: {status_data}")
-        self._save_log(log_entry, 'processed', f"Template status '{status_data.get('event')}' for '{status_data.get('message_template_name')}' logged.")
-    
-    def handle_account_update(self, update_data, metadata, app_config, log_entry: WebhookEventLog):
-        event = update_data.get('event')
-        logger.info(f"Account Update Received: Event='{event}', Data: {update_data}")
-        
-        notes = f"Account update event '{event}' received."
-        
-        # You can add specific logic here for different events, like sending an admin email
-        if event == 'DISABLED_UPDATE':
-            is_disabled = update_data.get('is_disabled', False)
-            if is_disabled:
-                logger.critical(f"CRITICAL: WhatsApp Business Account {app_config.waba_id} has been disabled! Reason: {update_data.get('disable_reason')}")
-                notes += f" Account DISABLED. Reason: {update_data.get('disable_reason')}. Immediate action required."
-            else:
-                logger.info(f"Account {app_config.waba_id} is no longer disabled.")
-                notes += " Account is no longer disabled."
-        
-        elif event == 'ACCOUNT_REVIEW_UPDATE':
-            decision = update_data.get('decision')
-            logger.warning(f"Account review update for {app_config.waba_id}: {decision}. Rejection reason: {update_data.get('rejection_reason')}")
-            notes += f" Review decision: {decision}."
-
-        # For now, we just log it as processed.
-        self._save_log(log_entry, 'processed', notes)
-
-    # Add other handlers (handle_referral, handle_system_message, handle_flow_response, etc.) as needed,
-    # ensuring they call self._save_log(log_entry, status, notes)
+        return HttpResponse("EVENT_RECEIVED", status=200)
 
     def get(self, request: HttpRequest, *args, **kwargs): # app_id_or_name removed from signature
         # Handles webhook verification challenge from Meta
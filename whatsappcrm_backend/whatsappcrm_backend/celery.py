@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import celeryd_init, worker_process_shutdown, worker_ready
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatsappcrm_backend.settings')
@@ -14,6 +15,28 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django apps
 app.autodiscover_tasks()
 
+
+# Task metrics (flow engine, Graph API) are recorded in the pool's child processes, which Django's
+# /prometheus/ endpoint never sees. With CELERY_METRICS_PORT set, the worker serves them itself;
+# set PROMETHEUS_MULTIPROC_DIR so the values of all children are aggregated.
+@celeryd_init.connect
+def reset_worker_metrics(**kwargs):
+    from whatsappcrm_backend.metrics_server import clear_multiprocess_dir
+    clear_multiprocess_dir()
+
+
+@worker_ready.connect
+def start_worker_metrics_server(**kwargs):
+    from django.conf import settings
+    from whatsappcrm_backend.metrics_server import start_metrics_server
+    start_metrics_server(getattr(settings, 'CELERY_METRICS_PORT', 0))
+
+
+@worker_process_shutdown.connect
+def release_worker_process_metrics(pid=None, **kwargs):
+    from whatsappcrm_backend.metrics_server import mark_process_dead
+    mark_process_dead(pid or os.getpid())
+
 # Test task with result storage
 @app.task(bind=True)
 def debug_task(self):
@@ -0,0 +1,54 @@
+# whatsappcrm_backend/metrics_server.py
+
+import glob
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def multiprocess_dir():
+    """The prometheus_client multiprocess directory, if this process runs in multiprocess mode."""
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or None
+
+
+def clear_multiprocess_dir() -> None:
+    """Removes the values left by earlier runs. Call once in the parent process, before any child starts."""
+    directory = multiprocess_dir()
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        os.remove(path)
+
+
+def mark_process_dead(pid: int) -> None:
+    """Drops the live-only values of an exited child process (multiprocess mode only)."""
+    if multiprocess_dir():
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+
+
+def start_metrics_server(port: int) -> bool:
+    """
+    Serves Prometheus metrics over HTTP on `port` (0 disables it) for processes that are not behind
+    Django's /prometheus/ endpoint: Celery workers and the long-running management commands.
+    With PROMETHEUS_MULTIPROC_DIR set, the metrics of every process writing to that directory
+    (e.g. a prefork worker's children) are aggregated; otherwise this process's own are served.
+    """
+    if not port:
+        return False
+    from prometheus_client import REGISTRY, CollectorRegistry, start_http_server
+
+    registry = REGISTRY
+    if multiprocess_dir():
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    try:
+        start_http_server(port, registry=registry)
+    except OSError as e:
+        logger.error(f"Could not start the Prometheus metrics server on port {port}: {e}")
+        return False
+    logger.info(f"Serving Prometheus metrics on port {port}{' (multiprocess)' if multiprocess_dir() else ''}.")
+    return True
@@ -0,0 +1,23 @@
+# whatsappcrm_backend/redis_client.py
+
+import threading
+
+import redis
+from django.conf import settings
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis_client() -> redis.Redis:
+    """
+    Returns a process-wide Redis client for application data (locks, queues, counters).
+    The client is thread-safe and keeps its own connection pool; it is created lazily so that
+    importing this module never opens a connection.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _client
@@ -198,6 +198,8 @@ CORS_ALLOWED_ORIGINS_STRING = os.getenv(
 )
 CORS_ALLOWED_ORIGINS = [origin.strip() for origin in CORS_ALLOWED_ORIGINS_STRING.split(',') if origin.strip()]
 CORS_ALLOW_CREDENTIALS = True
+# Lets the frontend read the webhook log window applied to list queries (meta_integration.views).
+CORS_EXPOSE_HEADERS = ['X-Received-After']
 
 # --- Celery Configuration ---
 # Ensure your Redis server is running and accessible at this URL.
@@ -211,6 +213,9 @@ CELERY_TASK_TRACK_STARTED = True # Optional: To track if a task has started
 CELERY_TASK_TIME_LIMIT = int(os.getenv('CELERY_TASK_TIME_LIMIT_SECONDS', '1800')) # Optional: Hard time limit for tasks (e.g., 30 minutes)
 CELERY_RESULT_EXTENDED = True
 CELERY_CACHE_BACKEND = 'django-cache'
+# Port on which each Celery worker serves its Prometheus metrics (flow engine, Graph API); 0 disables.
+# Prefork workers also need PROMETHEUS_MULTIPROC_DIR so the metrics of all child processes are served.
+CELERY_METRICS_PORT = int(os.getenv('CELERY_METRICS_PORT', '0'))
 
 # --- NEW: Celery Task Queues and Routing ---
 # Define queues for different types of workloads.
@@ -231,6 +236,19 @@ CELERY_TASK_ROUTES = {
 }
 
 
+# --- Redis ---
+# Used by the channel layer and for application data such as per-contact processing locks.
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/1')
+
+# --- Cache ---
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "whatsappcrm",
+    },
+}
+
 # --- Channels (WebSocket) Configuration ---
 # For development, you can use the in-memory backend.
 # For production, Redis is strongly recommended.
@@ -242,7 +260,7 @@ CHANNEL_LAYERS = {
             # In a Docker environment, 'localhost' refers to the container itself.
             # You must use the service name of the Redis container (e.g., 'redis') and password
             # as defined in your docker-compose.yml file.
-            "hosts": [os.getenv('REDIS_URL', 'redis://redis:6379/1')],
+            "hosts": [REDIS_URL],
         },
         # Use in-memory for local development if you don't have Redis running
         # "BACKEND": "channels.layers.InMemoryChannelLayer"
@@ -254,12 +272,123 @@ CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 # Celery Beat schedule can be configured here. It is currently empty.
 # Example:
 # CELERY_BEAT_SCHEDULE = { 'sample-task': { 'task': 'myapp.tasks.sample', 'schedule': 30.0, }, }
-CELERY_BEAT_SCHEDULE = {}
+from celery.schedules import crontab
+
+CELERY_BEAT_SCHEDULE = {
+    'maintain-webhook-log-partitions': {
+        'task': 'meta_integration.tasks.maintain_webhook_log_partitions_task',
+        'schedule': crontab(hour=2, minute=15),
+    },
+    # Runs after partition maintenance so blobs of dropped WebhookEventLog partitions are collected the same night.
+    'prune-payload-blobs': {
+        'task': 'meta_integration.tasks.prune_payload_blobs_task',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    # Restarts per-contact send queues whose drain task died with its worker (meta_integration.sequencer).
+    'sweep-send-queues': {
+        'task': 'meta_integration.tasks.sweep_send_queues_task',
+        'schedule': 30.0,
+    },
+    # Restarts per-contact flow queues whose drain died with its worker (flows.dispatch, FLOW_PARTITIONED_DISPATCH).
+    'sweep-flow-queues': {
+        'task': 'flows.tasks.sweep_flow_queues_task',
+        'schedule': 60.0,
+    },
+}
 
 # --- Application-Specific Settings ---
 CONVERSATION_EXPIRY_DAYS = int(os.getenv('CONVERSATION_EXPIRY_DAYS', '60'))
 ADMIN_WHATSAPP_NUMBER = os.getenv('ADMIN_WHATSAPP_NUMBER', None) # e.g., '15551234567'
 
+# When enabled, incoming messages are processed strictly in order per contact: each message is appended
+# to the contact's pending list in Redis and drained by whichever worker holds the contact's lock.
+# Different contacts still run in parallel, so worker concurrency can be raised safely.
+FLOW_PARTITIONED_DISPATCH = os.getenv('FLOW_PARTITIONED_DISPATCH', 'False') == 'True'
+FLOW_DISPATCH_LOCK_TIMEOUT_SECONDS = int(os.getenv('FLOW_DISPATCH_LOCK_TIMEOUT_SECONDS', '300'))
+
+# Models whose 'query_model' flow action results may be cached (actions opt in with "cache_ttl").
+# Cached results are invalidated when a row of the model is saved or deleted.
+FLOW_QUERY_CACHE_MODELS = [
+    'products_and_services.OfferingCategory',
+    'products_and_services.SoftwareProduct',
+    'products_and_services.SoftwareModule',
+    'products_and_services.ProfessionalService',
+    'products_and_services.Device',
+]
+
+# A warning is logged when processing one incoming message runs more DB queries than this (0 disables it).
+# Per-message, per-step and per-action query counts and timings are exported as Prometheus histograms.
+FLOW_QUERY_BUDGET = int(os.getenv('FLOW_QUERY_BUDGET', '50'))
+
+# 'sync': the webhook view processes each payload before responding.
+# 'buffered': the view only verifies the signature and appends the body to a Redis stream, which is
+# drained by `python manage.py run_webhook_ingestion` workers. Falls back to 'sync' if Redis is unavailable.
+META_WEBHOOK_INGESTION_MODE = os.getenv('META_WEBHOOK_INGESTION_MODE', 'sync')
+META_WEBHOOK_STREAM_MAXLEN = int(os.getenv('META_WEBHOOK_STREAM_MAXLEN', '100000'))
+
+# When enabled, 'sent'/'delivered'/'read'/'failed' callbacks are coalesced per wamid in Redis (most advanced
+# status wins) and applied every META_STATUS_FLUSH_INTERVAL_SECONDS with a bulk update, instead of one save each.
+META_STATUS_PIPELINE_ENABLED = os.getenv('META_STATUS_PIPELINE_ENABLED', 'False') == 'True'
+META_STATUS_FLUSH_INTERVAL_SECONDS = int(os.getenv('META_STATUS_FLUSH_INTERVAL_SECONDS', '2'))
+
+# Message and status events already seen within this window (by wamid / '<wamid>_<status>') are dropped
+# before any database work, so Meta's redeliveries are cheap. 0 disables the check.
+META_WEBHOOK_DEDUP_TTL_SECONDS = int(os.getenv('META_WEBHOOK_DEDUP_TTL_SECONDS', '86400'))
+
+# Read receipts are sent once per contact per window, for the newest message only (marking it read marks
+# the earlier ones too). 0 sends one receipt per message. Receipt sends are capped per second across workers.
+META_READ_RECEIPT_COALESCE_SECONDS = int(os.getenv('META_READ_RECEIPT_COALESCE_SECONDS', '3'))
+META_READ_RECEIPT_RATE_LIMIT_PER_SECOND = int(os.getenv('META_READ_RECEIPT_RATE_LIMIT_PER_SECOND', '20'))
+
+# Base URL for all Graph API calls. Point it at a stand-in API on stacks used to replay production webhooks
+# (manage.py replay_webhook_events --target-url ...) so that replies never reach real users.
+META_GRAPH_API_BASE_URL = os.getenv('META_GRAPH_API_BASE_URL', 'https://graph.facebook.com')
+# Every worker process keeps one pooled keep-alive session for Graph API calls (meta_integration.graph_client).
+META_GRAPH_API_POOL_SIZE = int(os.getenv('META_GRAPH_API_POOL_SIZE', '10'))
+META_GRAPH_API_CONNECT_TIMEOUT = float(os.getenv('META_GRAPH_API_CONNECT_TIMEOUT', '5'))
+META_GRAPH_API_READ_TIMEOUT = float(os.getenv('META_GRAPH_API_READ_TIMEOUT', '20'))
+# Outgoing messages are sent in order per contact by a Redis-backed sequencer (meta_integration.sequencer).
+# By default the next message goes out as soon as Meta accepts the previous one; when enabled, the sequencer
+# waits for the previous message's 'delivered' status webhook instead, up to the timeout.
+META_SEND_WAIT_FOR_DELIVERY = os.getenv('META_SEND_WAIT_FOR_DELIVERY', 'False') == 'True'
+META_SEND_DELIVERY_TIMEOUT_SECONDS = int(os.getenv('META_SEND_DELIVERY_TIMEOUT_SECONDS', '20'))
+# When enabled, the sequencer's queues are drained by the asyncio dispatcher (`manage.py run_send_dispatcher`)
+# instead of Celery tasks, with hundreds of sends in flight per process.
+META_SEND_ASYNC_DISPATCHER = os.getenv('META_SEND_ASYNC_DISPATCHER', 'False') == 'True'
+# Cluster-wide send rate per phone_number_id (meta_integration.rate_limiter); 0 disables the limiter. Set it to
+# the number's Cloud API throughput tier. Broadcasts get at most their own rate out of it, so the remainder stays
+# available to conversations. A throughput error from Meta halves the rate and pauses sends for the cooldown;
+# the rate then recovers by the given fraction of the limit per second, never below the minimum factor.
+META_SEND_RATE_LIMIT_PER_SECOND = int(os.getenv('META_SEND_RATE_LIMIT_PER_SECOND', '80'))
+META_SEND_RATE_LIMIT_BURST = int(os.getenv('META_SEND_RATE_LIMIT_BURST', '80'))
+META_SEND_BROADCAST_RATE_LIMIT_PER_SECOND = int(os.getenv('META_SEND_BROADCAST_RATE_LIMIT_PER_SECOND', '60'))
+META_SEND_RATE_LIMIT_COOLDOWN_SECONDS = float(os.getenv('META_SEND_RATE_LIMIT_COOLDOWN_SECONDS', '1'))
+META_SEND_RATE_LIMIT_RECOVERY_PER_SECOND = float(os.getenv('META_SEND_RATE_LIMIT_RECOVERY_PER_SECOND', '0.05'))
+META_SEND_RATE_LIMIT_MIN_FACTOR = float(os.getenv('META_SEND_RATE_LIMIT_MIN_FACTOR', '0.1'))
+# How long a contact's queue pauses after Meta reports too many messages to that one user (error 131056).
+META_SEND_PAIR_RATE_LIMIT_BACKOFF_SECONDS = int(os.getenv('META_SEND_PAIR_RATE_LIMIT_BACKOFF_SECONDS', '10'))
+
+# Contacts resolved on the webhook path are cached in Redis (wa_id -> id, name, app config) for this long.
+CONTACT_CACHE_TTL_SECONDS = int(os.getenv('CONTACT_CACHE_TTL_SECONDS', '3600'))
+# Contact.last_seen updates from messages are coalesced in Redis and applied in bulk this often.
+CONTACT_LAST_SEEN_FLUSH_INTERVAL_SECONDS = int(os.getenv('CONTACT_LAST_SEEN_FLUSH_INTERVAL_SECONDS', '5'))
+# Media that flow steps send by a fixed link is uploaded to WhatsApp once and later sends use the media ID
+# (media_manager.link_cache), so Meta doesn't download the URL again for every recipient. Off by default:
+# a changed file behind the link is only picked up when the link is revalidated, every
+# MEDIA_LINK_CACHE_REVALIDATE_SECONDS (sends go out by link meanwhile).
+MEDIA_LINK_CACHE_ENABLED = os.getenv('MEDIA_LINK_CACHE_ENABLED', 'False') == 'True'
+MEDIA_LINK_CACHE_REVALIDATE_SECONDS = int(os.getenv('MEDIA_LINK_CACHE_REVALIDATE_SECONDS', '3600'))
+
+# WebhookEventLog is partitioned by received_at (PostgreSQL). Partitions are created ahead of time and expired
+# ones dropped whole by the daily 'maintain-webhook-log-partitions' beat task (or manage_webhook_log_partitions).
+WEBHOOK_LOG_PARTITION_INTERVAL = os.getenv('WEBHOOK_LOG_PARTITION_INTERVAL', 'week') # 'day' or 'week'
+WEBHOOK_LOG_PARTITIONS_AHEAD = int(os.getenv('WEBHOOK_LOG_PARTITIONS_AHEAD', '4'))
+WEBHOOK_LOG_RETENTION_DAYS = int(os.getenv('WEBHOOK_LOG_RETENTION_DAYS', '90'))
+WEBHOOK_LOG_DETACH_ONLY = os.getenv('WEBHOOK_LOG_DETACH_ONLY', 'False') == 'True' # Keep detached partitions for archiving
+# Admin and API listings of webhook logs only cover this many recent days unless a received_at range is given,
+# so they scan the newest partitions instead of the whole table.
+WEBHOOK_LOG_DEFAULT_WINDOW_DAYS = int(os.getenv('WEBHOOK_LOG_DEFAULT_WINDOW_DAYS', '7'))
+
 
 # --- Logging Configuration ---
 LOGGING = {